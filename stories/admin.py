@@ -1,15 +1,22 @@
 from django.contrib import admin
-from .models import Story, Chapter, Paragraph, ReadingProgress, Payment, NFT, ParagraphView
+from django.db.models import Count, Q
+from .models import Story, Chapter, Paragraph, ReadingProgress, Payment, NFT, ParagraphView, Job, RevenueLedger, PooledWallet, NFTMint, DraftParagraph, CrossmintCollection
+from .bitmaps import ParagraphBitmap
+from .search import matching_paragraph_ids, tokenize
+from .tracking import uses_bitmap_storage
 
 @admin.register(Story)
 class StoryAdmin(admin.ModelAdmin):
     list_display = ('title', 'author', 'created_at')
+    list_select_related = ('author',)
     search_fields = ('title', 'author__username')
     list_filter = ('created_at',)
 
 @admin.register(Chapter)
 class ChapterAdmin(admin.ModelAdmin):
-    list_display = ('story', 'title', 'chapter_number', 'created_at')
+    list_display = ('story', 'title', 'chapter_number', 'page_count', 'paragraph_count', 'created_at')
+    list_select_related = ('story',)
+    readonly_fields = ('page_count', 'paragraph_count', 'page_index')
     search_fields = ('title', 'story__title')
     list_filter = ('created_at',)
     ordering = ['story', 'chapter_number']
@@ -17,10 +24,21 @@ class ChapterAdmin(admin.ModelAdmin):
 @admin.register(Paragraph)
 class ParagraphAdmin(admin.ModelAdmin):
     list_display = ('chapter', 'page', 'paragraph_number', 'is_locked', 'nft_owner', 'preview_text')
-    search_fields = ('chapter__title', 'text')
+    list_select_related = ('chapter__story', 'nft_owner')
+    search_fields = ('chapter__title',)
     list_filter = ('is_locked', 'chapter__story', 'page')
     ordering = ['chapter', 'page', 'paragraph_number']
 
+    def get_search_results(self, request, queryset, search_term):
+        # Text is matched through the search index instead of a LIKE scan
+        terms = list(dict.fromkeys(tokenize(search_term)))
+        if not terms:
+            return super().get_search_results(request, queryset, search_term)
+        matches = queryset.filter(
+            Q(id__in=matching_paragraph_ids(terms)) | Q(chapter__title__icontains=search_term)
+        )
+        return matches, False
+
     def preview_text(self, obj):
         return obj.text[:50] + '...' if len(obj.text) > 50 else obj.text
     preview_text.short_description = 'Text Preview'
@@ -28,17 +46,27 @@ class ParagraphAdmin(admin.ModelAdmin):
 @admin.register(ReadingProgress)
 class ReadingProgressAdmin(admin.ModelAdmin):
     list_display = ('user', 'story', 'last_accessed', 'viewed_count')
+    list_select_related = ('user', 'story')
     search_fields = ('user__username', 'story__title')
     list_filter = ('last_accessed', 'story')
     filter_horizontal = ('viewed_paragraphs',)
 
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if uses_bitmap_storage():
+            return queryset
+        return queryset.annotate(viewed_total=Count('viewed_paragraphs'))  # Count in the list query, not per row
+
     def viewed_count(self, obj):
-        return obj.viewed_paragraphs.count()
+        if uses_bitmap_storage():
+            return len(ParagraphBitmap.from_bytes(obj.viewed_bitmap))
+        return obj.viewed_total
     viewed_count.short_description = 'Paragraphs Viewed'
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ('user', 'paragraph', 'amount', 'payment_date', 'successful')
+    list_select_related = ('user', 'paragraph__chapter__story')
     search_fields = ('user__username', 'paragraph__chapter__story__title')
     list_filter = ('successful', 'payment_date')
     ordering = ['-payment_date']
@@ -46,19 +74,73 @@ class PaymentAdmin(admin.ModelAdmin):
 @admin.register(NFT)
 class NFTAdmin(admin.ModelAdmin):
     list_display = ('paragraph', 'owner', 'mint_date', 'revenue_share_percentage')
+    list_select_related = ('paragraph__chapter__story', 'owner')
     search_fields = ('owner__username', 'paragraph__chapter__story__title')
     list_filter = ('mint_date', 'revenue_share_percentage')
     ordering = ['-mint_date']
 
+@admin.register(RevenueLedger)
+class RevenueLedgerAdmin(admin.ModelAdmin):
+    list_display = ('paragraph', 'total_revenue', 'owner_share', 'payment_count', 'updated_at')
+    list_select_related = ('paragraph__chapter__story',)
+    search_fields = ('paragraph__chapter__story__title',)
+    readonly_fields = ('paragraph', 'total_revenue', 'owner_share', 'payment_count', 'updated_at')
+    ordering = ['-updated_at']
+
+@admin.register(PooledWallet)
+class PooledWalletAdmin(admin.ModelAdmin):
+    list_display = ('address', 'chain', 'created_at', 'reader', 'claimed_at')
+    list_select_related = ('reader',)
+    search_fields = ('address', 'reader__email')
+    list_filter = (('claimed_at', admin.EmptyFieldListFilter), 'chain')
+    ordering = ['-created_at']
+
+@admin.register(NFTMint)
+class NFTMintAdmin(admin.ModelAdmin):
+    list_display = ('paragraph', 'owner', 'status', 'attempts', 'updated_at')
+    list_select_related = ('paragraph__chapter__story', 'owner')
+    search_fields = ('crossmint_id', 'paragraph__chapter__story__title', 'last_error')
+    list_filter = ('status',)
+    ordering = ['-updated_at']
+
+@admin.register(CrossmintCollection)
+class CrossmintCollectionAdmin(admin.ModelAdmin):
+    list_display = ('env', 'chain', 'collection_id', 'created_at')
+
+@admin.register(DraftParagraph)
+class DraftParagraphAdmin(admin.ModelAdmin):
+    list_display = ('chapter', 'previous_paragraph', 'status', 'generation_ms', 'updated_at')
+    list_select_related = ('chapter__story',)
+    list_filter = ('status',)
+    raw_id_fields = ('chapter', 'previous_paragraph')
+    ordering = ['-updated_at']
+
+class ChapterListFilter(admin.RelatedFieldListFilter):
+    """
+    Chapter filter that loads each chapter's story in the same query, since
+    the chapter labels include the story title.
+    """
+    def field_choices(self, field, request, model_admin):
+        ordering = self.field_admin_ordering(field, request, model_admin) or ('story', 'chapter_number')
+        chapters = Chapter.objects.select_related('story').order_by(*ordering)
+        return [(chapter.pk, str(chapter)) for chapter in chapters]
+
 @admin.register(ParagraphView)
 class ParagraphViewAdmin(admin.ModelAdmin):
     list_display = ('user', 'story', 'chapter', 'paragraph', 'view_order', 'viewed_at')
     search_fields = ('user__username', 'story__title', 'chapter__title')
-    list_filter = ('viewed_at', 'story', 'chapter')
+    list_filter = ('viewed_at', 'story', ('chapter', ChapterListFilter))
     ordering = ['user', 'view_order']
     raw_id_fields = ('user', 'story', 'chapter', 'paragraph')  # Helps with performance for large datasets
 
     def get_queryset(self, request):
         return super().get_queryset(request).select_related(
-            'user', 'story', 'chapter', 'paragraph'
+            'user', 'story', 'chapter__story', 'paragraph__chapter__story'
         )  # Optimize database queries
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'dedupe_key', 'status', 'attempts', 'run_after', 'created_at', 'finished_at')
+    search_fields = ('task', 'dedupe_key', 'last_error')
+    list_filter = ('status', 'task')
+    ordering = ['-created_at']
@@ -7,3 +7,7 @@ class StoriesConfig(AppConfig):
 
     def ready(self):
         import stories.signals  # Import the signals
+        import stories.tasks  # Register background job handlers
+        import stories.wallets
+        import stories.minting
+        import stories.speculation
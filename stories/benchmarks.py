@@ -0,0 +1,602 @@
+"""
+Benchmarks run with ``manage.py benchmark``. Each benchmark builds its own
+data inside a transaction that is rolled back afterwards, except threaded
+benchmarks, which need their data committed and clean up after themselves.
+"""
+import base64
+import json
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+from openai import OpenAI
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from .bitmaps import ParagraphBitmap
+from .models import Story, Chapter, Paragraph, ChapterSummary, ParagraphView, ReadingProgress, Payment
+from .context import build_chapter_context
+from .sequences import allocate_view_order
+from .views import ChapterViewSet, ParagraphViewSet, ReadingProgressViewSet, StoryViewSet
+from .pagination import KeysetPagination, encode_cursor
+from .cache import chapter_page_key
+from .context import estimate_tokens
+from .link_analysis import analyze_batch, analyze_links_in_batches
+from .term_index import TermAutomaton, annotate_locally, index_links, story_automaton
+from .search import index_paragraphs, search_paragraphs
+from .renderers import FastJSONRenderer
+from .serializers import ParagraphSerializer, ValuesSerializer
+
+# Benchmark name -> (callable, default dataset sizes, run in a rolled back transaction)
+registry = {}
+
+PARAGRAPH_TEXT = (
+    "The lanterns of the harbour flickered as Mara crossed the square, the ledger "
+    "still warm under her arm and the tide already turning behind her."
+)
+
+
+def benchmark(name, sizes, rollback=True):
+    """
+    Register a benchmark. The function is called once per dataset size and
+    returns a dict of measurements to report.
+    """
+    def decorator(func):
+        registry[name] = (func, sizes, rollback)
+        return func
+    return decorator
+
+
+def timed(func, repeat=5):
+    """
+    Best wall-clock time of ``repeat`` calls to func, in milliseconds, and the
+    result of the last call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def make_user(prefix='bench'):
+    return get_user_model().objects.create_user(username=f"{prefix}-{uuid.uuid4().hex[:12]}")
+
+
+def make_chapter(paragraph_count, per_page=10, author=None):
+    """
+    Create a story with a single chapter of paragraph_count paragraphs, without
+    firing save signals, and index its pages.
+    """
+    author = author or make_user()
+    story = Story.objects.create(title='Benchmark story', description='Benchmark', author=author)
+    chapter = Chapter.objects.create(story=story, title='Benchmark chapter', chapter_number=1)
+    Paragraph.objects.bulk_create(
+        Paragraph(
+            chapter=chapter,
+            text=PARAGRAPH_TEXT,
+            page=i // per_page + 1,
+            paragraph_number=i % per_page + 1,
+            is_locked=False,
+        )
+        for i in range(paragraph_count)
+    )
+    chapter.refresh_from_db()
+    return chapter
+
+
+@benchmark('context', sizes=[100, 1000, 5000, 20000])
+def context_benchmark(size):
+    """
+    Prompt build time and size for generate_next_page: the bounded context
+    builder against joining the whole chapter.
+    """
+    chapter = make_chapter(size)
+    last_page = chapter.paragraphs.order_by('-page').values_list('page', flat=True).first()
+    ChapterSummary.objects.create(
+        chapter=chapter, text=PARAGRAPH_TEXT * 5, page=last_page, paragraph_number=1
+    )
+
+    def full_chapter():
+        return "\n".join(p.text for p in Paragraph.objects.filter(
+            chapter=chapter, page__lte=last_page
+        ).order_by('page', 'paragraph_number'))
+
+    full_ms, full_context = timed(full_chapter)
+    bounded_ms, bounded_context = timed(lambda: build_chapter_context(chapter, last_page))
+    return {
+        'full_ms': full_ms,
+        'full_tokens': estimate_tokens(full_context),
+        'bounded_ms': bounded_ms,
+        'bounded_tokens': estimate_tokens(bounded_context),
+    }
+
+
+def call_view(viewset, actions, user, method='get', path='/', data=None, headers=None, **kwargs):
+    """
+    Call a viewset action directly, bypassing URL routing and middleware.
+    """
+    # localhost is allowed whenever DEBUG is on, unlike the factory's testserver,
+    # and views that build absolute URLs need an allowed host
+    request = getattr(APIRequestFactory(SERVER_NAME='localhost'), method)(path, data, headers=headers, format='json')
+    force_authenticate(request, user=user)
+    return viewset.as_view(actions)(request, **kwargs)
+
+
+def make_views(user, chapter, count):
+    """
+    Give user a history of count paragraph views in chapter.
+    """
+    paragraphs = list(chapter.paragraphs.all())
+    ParagraphView.objects.bulk_create(
+        (
+            ParagraphView(
+                user=user,
+                story=chapter.story,
+                chapter=chapter,
+                paragraph=paragraphs[i % len(paragraphs)],
+                view_order=i + 1,
+            )
+            for i in range(count)
+        ),
+        batch_size=5000
+    )
+
+
+@benchmark('view_order', sizes=[100, 10000, 50000])
+def view_order_benchmark(size):
+    """
+    ParagraphViewSet.retrieve for a user with size prior views, and the cost of
+    the old Max('view_order') lookup against the counter it was replaced by.
+    """
+    user = make_user()
+    chapter = make_chapter(100, author=user)
+    make_views(user, chapter, size)
+    allocate_view_order(user.id)
+    paragraph_id = chapter.paragraphs.values_list('id', flat=True).first()
+
+    max_ms, _ = timed(lambda: ParagraphView.objects.filter(user=user).aggregate(Max('view_order')))
+    counter_ms, _ = timed(lambda: allocate_view_order(user.id))
+    retrieve_ms, _ = timed(lambda: call_view(ParagraphViewSet, {'get': 'retrieve'}, user, pk=paragraph_id), repeat=20)
+    return {
+        'max_aggregate_ms': max_ms,
+        'counter_ms': counter_ms,
+        'retrieve_ms': retrieve_ms,
+    }
+
+
+@benchmark('viewed', sizes=[1000, 10000, 100000])
+def viewed_benchmark(size):
+    """
+    Reading a progress row's viewed set of size paragraphs from the M2M table
+    against the compressed bitmap, and the size of each on the wire.
+    """
+    user = make_user()
+    chapter = make_chapter(size, author=user)
+    ids = list(chapter.paragraphs.values_list('id', flat=True))
+    progress = ReadingProgress.objects.create(user=user, story=chapter.story)
+    Through = ReadingProgress.viewed_paragraphs.through
+    Through.objects.bulk_create(
+        (Through(readingprogress_id=progress.id, paragraph_id=paragraph_id) for paragraph_id in ids),
+        batch_size=5000
+    )
+    progress.viewed_bitmap = ParagraphBitmap(ids).to_bytes()
+    progress.save(update_fields=['viewed_bitmap'])
+
+    def load_bitmap():
+        blob = ReadingProgress.objects.values_list('viewed_bitmap', flat=True).get(id=progress.id)
+        return ParagraphBitmap.from_bytes(blob)
+
+    m2m_list_ms, m2m_ids = timed(lambda: list(progress.viewed_paragraphs.values_list('id', flat=True)))
+    m2m_count_ms, _ = timed(lambda: progress.viewed_paragraphs.count())
+    bitmap_list_ms, _ = timed(lambda: list(load_bitmap()))
+    bitmap_count_ms, _ = timed(lambda: len(load_bitmap()))
+    bitmap = load_bitmap()
+    member_ms, _ = timed(lambda: all(paragraph_id in bitmap for paragraph_id in ids[::100]))
+    return {
+        'm2m_list_ms': m2m_list_ms,
+        'm2m_count_ms': m2m_count_ms,
+        'bitmap_list_ms': bitmap_list_ms,
+        'bitmap_count_ms': bitmap_count_ms,
+        'bitmap_member_us': member_ms * 1000 / len(ids[::100]),
+        'id_list_bytes': len(json.dumps(m2m_ids)),
+        'bitmap_bytes': len(base64.b64encode(bitmap.to_bytes())),
+    }
+
+
+@benchmark('chapter_page', sizes=[10, 50, 200])
+def chapter_page_benchmark(size):
+    """
+    ChapterViewSet.paragraphs for a page of size paragraphs: a cold cache, a
+    warm cache and an If-None-Match revalidation answered with 304.
+    """
+    user = make_user()
+    chapter = make_chapter(size * 3, per_page=size, author=user)
+
+    def fetch(headers=None):
+        response = call_view(
+            ChapterViewSet, {'get': 'paragraphs'}, user, data={'page': 2}, headers=headers, pk=chapter.id
+        )
+        response.render()
+        return response
+
+    def cold():
+        cache.delete(chapter_page_key(chapter.id, 2))
+        return fetch()
+
+    cold_ms, response = timed(cold)
+    warm_ms, _ = timed(fetch, repeat=20)
+    not_modified_ms, not_modified = timed(lambda: fetch({'If-None-Match': response['ETag']}), repeat=20)
+    assert not_modified.status_code == 304
+    return {
+        'cold_ms': cold_ms,
+        'warm_ms': warm_ms,
+        'not_modified_ms': not_modified_ms,
+        'body_bytes': len(response.content),
+    }
+
+
+@benchmark('unlock', sizes=[1, 4, 16], rollback=False)
+def unlock_benchmark(size):
+    """
+    size threads each trying to unlock every paragraph of a 200 paragraph
+    chapter, with a fresh Idempotency-Key per attempt. Reports throughput and
+    checks that every paragraph was charged exactly once.
+    """
+    user = make_user()
+    try:
+        chapter = make_chapter(200, author=user)
+        chapter.paragraphs.update(is_locked=True)
+        ids = list(chapter.paragraphs.values_list('id', flat=True))
+        barrier = threading.Barrier(size)
+        statuses = []
+
+        def worker(i):
+            try:
+                barrier.wait()
+                offset = i * len(ids) // size
+                for paragraph_id in ids[offset:] + ids[:offset]:
+                    response = call_view(
+                        ParagraphViewSet, {'post': 'unlock'}, user, method='post', data={'amount': '1.00'},
+                        headers={'Idempotency-Key': uuid.uuid4().hex}, pk=paragraph_id
+                    )
+                    statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(size)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        charged = Payment.objects.filter(paragraph__chapter=chapter).values('paragraph_id').distinct().count()
+        return {
+            'attempts_per_s': len(statuses) / elapsed,
+            'unlocks': statuses.count(200),
+            'rejected': statuses.count(400),
+            'payments': Payment.objects.filter(paragraph__chapter=chapter).count(),
+            'paragraphs_charged': charged,
+        }
+    finally:
+        user.delete()
+
+
+class FakeLinkModelServer:
+    """
+    Local stand-in for the chat completions API that answers link analysis
+    requests, single or batched, by linking the first word of each paragraph.
+    Each reply takes request_latency seconds plus token_latency per output
+    token, roughly like a hosted model.
+    """
+
+    def __init__(self, request_latency=0.05, token_latency=0.0002):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                paragraphs = json.loads(body['messages'][1]['content'])
+                content = json.dumps({'paragraphs': [
+                    {'id': p['id'], 'html': '<a href="/wiki/{0}">{0}</a> {1}'.format(*p['text'].split(' ', 1))}
+                    for p in paragraphs
+                ]})
+                time.sleep(request_latency + token_latency * estimate_tokens(content))
+                payload = json.dumps({
+                    'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                    'choices': [{
+                        'index': 0, 'finish_reason': 'stop',
+                        'message': {'role': 'assistant', 'content': content},
+                    }],
+                }).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return OpenAI(base_url=f"http://127.0.0.1:{self.httpd.server_port}/v1", api_key='sk-bench', max_retries=0)
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@benchmark('link_analysis', sizes=[20, 100, 300])
+def link_analysis_benchmark(size):
+    """
+    Link analysis of size paragraphs against a fake model server: one request
+    per paragraph in sequence, as the per-paragraph job does, against packed
+    batches sent concurrently.
+    """
+    chapter = make_chapter(size)
+    paragraphs = chapter.paragraphs.all()
+    rows = list(paragraphs.values_list('id', 'text'))
+
+    with FakeLinkModelServer() as client:
+        start = time.perf_counter()
+        for row in rows:
+            analyze_batch([row], client, 'gpt-4')
+        single_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        totals = analyze_links_in_batches(paragraphs, client=client)
+        batched_s = time.perf_counter() - start
+
+    return {
+        'single_requests': len(rows),
+        'single_per_s': len(rows) / single_s,
+        'batched_requests': totals['requests'],
+        'batched_per_s': len(rows) / batched_s,
+        'annotated': totals['annotated'],
+    }
+
+
+@benchmark('term_index', sizes=[100, 1000, 10000])
+def term_index_benchmark(size):
+    """
+    Linking paragraphs from a story term index of size phrases, against one
+    request per paragraph to a fake model server. Also reports how long the
+    automaton takes to compile from the database.
+    """
+    chapter = make_chapter(20)
+    story_id = chapter.story_id
+    terms = [(f"Place{i}", f"/wiki/Place{i}") for i in range(size - 3)]
+    terms += [("Mara", "/wiki/Mara"), ("harbour", "/wiki/Harbour"), ("ledger", "/wiki/Ledger")]
+    index_links({story_id: terms})
+
+    start = time.perf_counter()
+    story_automaton(story_id)
+    build_ms = (time.perf_counter() - start) * 1000
+    # Compile time alone, without the query
+    start = time.perf_counter()
+    TermAutomaton(terms)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    iterations = 2000
+    start = time.perf_counter()
+    for _ in range(iterations):
+        annotate_locally(story_id, PARAGRAPH_TEXT)
+    local_s = time.perf_counter() - start
+
+    rows = list(chapter.paragraphs.values_list('id', 'text'))
+    with FakeLinkModelServer() as client:
+        start = time.perf_counter()
+        for row in rows:
+            analyze_batch([row], client, 'gpt-4')
+        llm_s = time.perf_counter() - start
+
+    return {
+        'build_ms': build_ms,
+        'compile_ms': compile_ms,
+        'local_us': local_s / iterations * 1e6,
+        'local_per_s': iterations / local_s,
+        'llm_per_s': len(rows) / llm_s,
+    }
+
+
+@benchmark('search', sizes=[1000, 10000, 100000])
+def search_benchmark(size):
+    """
+    Ranked search through the inverted index against the LIKE scan the admin
+    used to run, over size paragraphs drawn from a Zipf-like vocabulary. Pass
+    --sizes 1000000 for a corpus of millions; indexing it takes a while.
+    """
+    rng = random.Random(size)
+    vocabulary = [f"word{i}" for i in range(20000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    chapter = make_chapter(0)
+
+    for offset in range(0, size, 10000):
+        count = min(10000, size - offset)
+        Paragraph.objects.bulk_create(
+            Paragraph(
+                chapter=chapter,
+                text=" ".join(rng.choices(vocabulary, weights, k=40)),
+                page=(offset + i) // 10 + 1,
+                paragraph_number=(offset + i) % 10 + 1,
+                is_locked=False,
+            )
+            for i in range(count)
+        )
+    rows = list(chapter.paragraphs.order_by('id').values_list('id', 'text'))
+    start = time.perf_counter()
+    for offset in range(0, len(rows), 1000):
+        index_paragraphs(rows[offset:offset + 1000])
+    index_s = time.perf_counter() - start
+    cache.delete('stories:search-stats')
+    # Autovacuum can't see the uncommitted rows, so planner statistics are
+    # gathered by hand
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE stories_paragraph, stories_paragraphterm')
+
+    # A rare term, a mid-frequency pair and a common pair
+    queries = {'rare': 'word15000', 'pair': 'word300 word900', 'common': 'word1 word2'}
+    results = {'index_paragraphs_per_s': size / index_s}
+    for label, query in queries.items():
+        results[f'{label}_ms'], _ = timed(lambda: search_paragraphs(query))
+    results['like_ms'], _ = timed(
+        lambda: list(Paragraph.objects.filter(text__icontains='word15000').values_list('id', flat=True)[:20]),
+        repeat=3
+    )
+    return results
+
+
+@benchmark('pagination', sizes=[10000, 100000, 500000])
+def pagination_benchmark(size):
+    """
+    navigation_history for a user with size views: the first page against
+    the deepest one (page 10,000 at 500,000 views), fetched by cursor and,
+    for comparison, by the OFFSET query it replaces.
+    """
+    user = make_user()
+    chapter = make_chapter(100, author=user)
+    make_views(user, chapter, size)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE stories_paragraphview')
+
+    page_size = KeysetPagination.page_size
+    last_page = size // page_size
+    params = {'story': chapter.story_id}
+    deep_params = dict(params, cursor=encode_cursor([(last_page - 1) * page_size]))
+
+    def history(data):
+        response = call_view(ReadingProgressViewSet, {'get': 'navigation_history'}, user, data=data)
+        assert len(response.data['results']) == page_size
+        return response
+
+    first_ms, _ = timed(lambda: history(params))
+    deep_ms, _ = timed(lambda: history(deep_params))
+    offset_ms, _ = timed(lambda: list(
+        ParagraphView.objects.filter(user=user, story_id=chapter.story_id).order_by('view_order').values(
+            'paragraph_id', 'chapter_id', 'view_order', 'viewed_at'
+        )[(last_page - 1) * page_size:last_page * page_size]
+    ))
+    return {
+        'deepest_page': last_page,
+        'first_page_ms': first_ms,
+        'deep_cursor_ms': deep_ms,
+        'deep_offset_ms': offset_ms,
+    }
+
+
+@benchmark('bundle', sizes=[1000, 10000, 50000])
+def bundle_benchmark(size):
+    """
+    StoryViewSet.bundle for a story of size paragraphs, gzipped and plain,
+    and a delta after editing ten paragraphs, against reading the story page
+    by page through ChapterViewSet.paragraphs with a cold cache.
+    """
+    user = make_user()
+    chapter = make_chapter(size, author=user)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE stories_paragraph')
+
+    def bundle(data=None, headers=None):
+        response = call_view(
+            StoryViewSet, {'get': 'bundle'}, user, data=data, headers=headers, pk=chapter.story_id
+        )
+        return response, b''.join(response.streaming_content)
+
+    gzip_ms, (response, gzipped) = timed(lambda: bundle(headers={'Accept-Encoding': 'gzip'}), repeat=3)
+    plain_ms, (_, plain) = timed(bundle, repeat=3)
+
+    version = response['X-Bundle-Version']
+    edited = list(chapter.paragraphs.order_by('?').values_list('id', flat=True)[:10])
+    Paragraph.objects.filter(id__in=edited).update(text='Edited.', updated_at=timezone.now())
+    delta_ms, (_, delta) = timed(
+        lambda: bundle(data={'since': version}, headers={'Accept-Encoding': 'gzip'}), repeat=3
+    )
+
+    def page_by_page():
+        cache.clear()
+        total, page = 0, 1
+        while True:
+            response = call_view(ChapterViewSet, {'get': 'paragraphs'}, user, data={'page': page}, pk=chapter.id)
+            response.render()
+            total += len(response.content)
+            if not response.data['has_next']:
+                return total
+            page += 1
+
+    pages_ms, pages_bytes = timed(page_by_page, repeat=1)
+    return {
+        'bundle_gzip_ms': gzip_ms,
+        'bundle_gzip_bytes': len(gzipped),
+        'bundle_plain_ms': plain_ms,
+        'bundle_plain_bytes': len(plain),
+        'delta_gzip_ms': delta_ms,
+        'delta_gzip_bytes': len(delta),
+        'page_by_page_ms': pages_ms,
+        'page_by_page_bytes': pages_bytes,
+    }
+
+
+def peak_allocation(func):
+    """
+    Peak memory allocated by Python during a call to func, in kilobytes.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark('serialization', sizes=[1000, 10000, 100000])
+def serialization_benchmark(size):
+    """
+    Reading, serializing and rendering size paragraphs: model instances
+    through ParagraphSerializer and JSONRenderer, as list endpoints did,
+    against values() rows through ValuesSerializer and FastJSONRenderer, in
+    full and cut down to id and text with ?fields=.
+    """
+    chapter = make_chapter(size)
+    queryset = chapter.paragraphs.order_by('id')
+
+    def model_serializer():
+        return JSONRenderer().render(ParagraphSerializer(list(queryset), many=True).data)
+
+    def values_serializer(fields=None):
+        serializer = ValuesSerializer(Paragraph, fields)
+        return FastJSONRenderer().render(serializer.to_representation(serializer.values(queryset)))
+
+    model_ms, model_body = timed(model_serializer, repeat=3)
+    values_ms, values_body = timed(values_serializer, repeat=3)
+    sparse_ms, sparse_body = timed(lambda: values_serializer(['id', 'text']), repeat=3)
+    assert json.loads(model_body) == json.loads(values_body)
+    return {
+        'model_ms': model_ms,
+        'values_ms': values_ms,
+        'sparse_ms': sparse_ms,
+        'model_per_s': size / model_ms * 1000,
+        'values_per_s': size / values_ms * 1000,
+        'model_peak_kb': peak_allocation(model_serializer),
+        'values_peak_kb': peak_allocation(values_serializer),
+        'sparse_peak_kb': peak_allocation(lambda: values_serializer(['id', 'text'])),
+        'sparse_bytes_ratio': len(sparse_body) / len(values_body),
+    }
@@ -0,0 +1,100 @@
+import struct
+import zlib
+
+
+class ParagraphBitmap:
+    """
+    Set of paragraph ids stored as a bitmap starting at the lowest id in the
+    set. Ids are global, so the bitmap spans every paragraph created between
+    the lowest and highest id in the set, other stories' included; zlib
+    squeezes the long runs of unset bits that leaves when it is serialized.
+
+    Membership is a single byte lookup; cardinality and union work on the
+    whole bitmap as one integer.
+    """
+    HEADER = struct.Struct('<Q')
+
+    def __init__(self, ids=()):
+        self.base = 0
+        self.bits = bytearray()
+        for paragraph_id in sorted(set(ids)):
+            self.add(paragraph_id)
+
+    @classmethod
+    def from_int(cls, base, value):
+        bitmap = cls()
+        if value:
+            bitmap.base = base
+            bitmap.bits = bytearray(value.to_bytes((value.bit_length() + 7) // 8, 'little'))
+        return bitmap
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load a bitmap produced by to_bytes(). Empty or missing data is an empty set.
+        """
+        bitmap = cls()
+        if data:
+            raw = zlib.decompress(bytes(data))
+            (bitmap.base,) = cls.HEADER.unpack_from(raw)
+            bitmap.bits = bytearray(raw[cls.HEADER.size:])
+        return bitmap
+
+    def to_bytes(self):
+        return zlib.compress(self.HEADER.pack(self.base) + bytes(self.bits))
+
+    def to_int(self, base=None):
+        """
+        The bitmap as an integer whose bit 0 is paragraph ``base``.
+        """
+        value = int.from_bytes(self.bits, 'little')
+        if base is not None and value:
+            value <<= self.base - base
+        return value
+
+    def add(self, paragraph_id):
+        if not self.bits:
+            self.base = paragraph_id
+        elif paragraph_id < self.base:
+            rebased = ParagraphBitmap.from_int(paragraph_id, self.to_int(base=paragraph_id))
+            self.base, self.bits = rebased.base, rebased.bits
+
+        offset = paragraph_id - self.base
+        index = offset >> 3
+        if index >= len(self.bits):
+            self.bits.extend(bytes(index - len(self.bits) + 1))
+        self.bits[index] |= 1 << (offset & 7)
+
+    def update(self, ids):
+        for paragraph_id in ids:
+            self.add(paragraph_id)
+
+    def __contains__(self, paragraph_id):
+        offset = paragraph_id - self.base
+        if offset < 0 or offset >> 3 >= len(self.bits):
+            return False
+        return bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self.to_int().bit_count()
+
+    def __iter__(self):
+        for index, byte in enumerate(self.bits):
+            while byte:
+                low = byte & -byte
+                yield self.base + (index << 3) + low.bit_length() - 1
+                byte ^= low
+
+    def __or__(self, other):
+        if not other.bits:
+            return ParagraphBitmap.from_int(self.base, self.to_int())
+        if not self.bits:
+            return ParagraphBitmap.from_int(other.base, other.to_int())
+        base = min(self.base, other.base)
+        return ParagraphBitmap.from_int(base, self.to_int(base) | other.to_int(base))
+
+    def __eq__(self, other):
+        return isinstance(other, ParagraphBitmap) and list(self) == list(other)
+
+    def __repr__(self):
+        return f"ParagraphBitmap({len(self)} paragraphs from {self.base})"
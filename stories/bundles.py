@@ -0,0 +1,147 @@
+import base64
+import binascii
+import hashlib
+import json
+import zlib
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Max, Q
+
+from .models import Chapter, Paragraph
+from .pagination import CursorEncoder
+
+PARAGRAPH_FIELDS = (
+    'id', 'chapter_id', 'page', 'paragraph_number', 'text', 'text_with_links', 'is_locked', 'nft_owner_id',
+    'updated_at',
+)
+CHAPTER_FIELDS = ('id', 'title', 'chapter_number', 'created_at')
+# Rows fetched per round trip while streaming
+CHUNK_SIZE = 2000
+# Compressed bytes buffered before a chunk is sent
+FLUSH_BYTES = 64 * 1024
+
+
+def bundle_querysets(story_id, first_chapter=None, last_chapter=None):
+    """
+    Chapters and paragraphs of a story, optionally limited to a range of
+    chapter numbers.
+    """
+    chapters = Chapter.objects.filter(story_id=story_id)
+    if first_chapter is not None:
+        chapters = chapters.filter(chapter_number__gte=first_chapter)
+    if last_chapter is not None:
+        chapters = chapters.filter(chapter_number__lte=last_chapter)
+    return chapters, Paragraph.objects.filter(chapter__in=chapters.values('id'))
+
+
+def encode_version(state):
+    return base64.urlsafe_b64encode(json.dumps(state, cls=CursorEncoder).encode()).decode().rstrip('=')
+
+
+def decode_version(version):
+    """
+    [last update, paragraph count, highest paragraph id, outline digest] from
+    a version, or None if it isn't one.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(version + '=' * (-len(version) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(state, list) or len(state) != 4:
+        return None
+    return state
+
+
+def outline_digest(story, chapters):
+    """
+    Short digest of the story and chapter fields a bundle carries besides its
+    paragraphs, so renaming or renumbering either changes the version.
+    """
+    outline = [story.title, story.description, list(chapters.order_by('id').values_list(
+        'id', 'title', 'chapter_number'
+    ))]
+    return hashlib.sha256(json.dumps(outline).encode()).hexdigest()[:16]
+
+
+def bundle_version(story, chapters, paragraphs):
+    """
+    Opaque version of a story's chapters and paragraphs. It changes whenever
+    a paragraph is added, edited or deleted, or the story or a chapter is
+    renamed, and records enough to work out what changed since.
+    """
+    state = paragraphs.aggregate(updated=Max('updated_at'), count=Count('id'), last_id=Max('id'))
+    return encode_version([state['updated'], state['count'], state['last_id'] or 0, outline_digest(story, chapters)])
+
+
+def changed_since(paragraphs, version):
+    """
+    The paragraphs added or edited since version, or None when that can't
+    describe the change: the version is invalid, or paragraphs were deleted.
+    """
+    state = decode_version(version)
+    if state is None:
+        return None
+    updated, count, last_id, _ = state
+    try:
+        totals = paragraphs.aggregate(total=Count('id'), added=Count('id', filter=Q(id__gt=last_id)))
+    except (TypeError, ValueError, ValidationError):
+        return None
+    if totals['total'] != count + totals['added']:
+        return None
+    if updated is None:
+        return paragraphs
+    return paragraphs.filter(Q(updated_at__gt=updated) | Q(id__gt=last_id))
+
+
+def bundle_records(story, chapters, paragraphs, version, since=None, delta=False):
+    """
+    Records of a bundle: a header, every chapter, the paragraphs in reading
+    order and an end record with the paragraph count. delta marks a bundle
+    holding only the paragraphs changed since an earlier version; it still
+    carries the story and every chapter, so edits to those reach the client
+    as well. Rows are read with values() and iterator(), so memory stays flat
+    however long the story.
+    """
+    yield {
+        'type': 'bundle',
+        'story': {
+            'id': story.id, 'title': story.title, 'description': story.description,
+            'author': story.author_id, 'created_at': story.created_at,
+        },
+        'version': version,
+        'since': since,
+        'delta': delta,
+    }
+    for chapter in chapters.order_by('chapter_number').values(*CHAPTER_FIELDS).iterator(chunk_size=CHUNK_SIZE):
+        yield {'type': 'chapter', **chapter}
+    count = 0
+    rows = paragraphs.order_by('chapter_id', 'page', 'paragraph_number').values(*PARAGRAPH_FIELDS)
+    for paragraph in rows.iterator(chunk_size=CHUNK_SIZE):
+        count += 1
+        yield {'type': 'paragraph', **paragraph}
+    yield {'type': 'end', 'paragraphs': count}
+
+
+def ndjson(records):
+    for record in records:
+        yield json.dumps(record, cls=CursorEncoder, separators=(',', ':')).encode() + b'\n'
+
+
+def gzip_stream(chunks, level=6, flush_bytes=FLUSH_BYTES):
+    """
+    Gzip a stream of byte strings, sending compressed output in pieces of
+    about flush_bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            buffer.append(compressed)
+            buffered += len(compressed)
+            if buffered >= flush_bytes:
+                yield b''.join(buffer)
+                buffer, buffered = [], 0
+    buffer.append(compressor.flush())
+    yield b''.join(buffer)
@@ -0,0 +1,54 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.utils.encoders import JSONEncoder
+
+CHAPTER_PAGE_TIMEOUT = getattr(settings, 'STORIES_CHAPTER_PAGE_CACHE_TIMEOUT', 60 * 60)
+
+
+def chapter_page_key(chapter_id, page):
+    return f"stories:chapter-page:{chapter_id}:{page}"
+
+
+def make_etag(data):
+    """
+    Strong ETag for response data, taken from its canonical JSON encoding.
+    """
+    encoded = json.dumps(data, cls=JSONEncoder, sort_keys=True, separators=(',', ':'))
+    return f'"{hashlib.sha256(encoded.encode()).hexdigest()}"'
+
+
+def variant_etag(etag, variant):
+    """
+    ETag for a variant of the representation etag was made for, such as a
+    subset of its fields.
+    """
+    return f'{etag[:-1]};{variant}"'
+
+
+def get_chapter_page(chapter_id, page):
+    """
+    Cached {'data': ..., 'etag': ...} entry for a chapter page, or None.
+    """
+    return cache.get(chapter_page_key(chapter_id, page))
+
+
+def set_chapter_page(chapter_id, page, data):
+    entry = {'data': data, 'etag': make_etag(data)}
+    cache.set(chapter_page_key(chapter_id, page), entry, CHAPTER_PAGE_TIMEOUT)
+    return entry
+
+
+def invalidate_chapter_pages(chapter_id, pages):
+    """
+    Drop cached entries for the given pages of a chapter. The page before each
+    one is dropped too, since its has_next flag depends on the page existing.
+    """
+    keys = set()
+    for page in pages:
+        keys.add(chapter_page_key(chapter_id, page))
+        if page > 1:
+            keys.add(chapter_page_key(chapter_id, page - 1))
+    cache.delete_many(list(keys))
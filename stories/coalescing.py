@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import connection
+from django.db.models import Max
+
+from .models import Paragraph
+from .speculation import publish_draft
+from .tasks import generate_next_paragraph, stream_next_paragraph
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs one call at a time per key within this process. Calls made while
+    one is in flight wait for it and get its result, or its exception,
+    instead of running themselves.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def join(self, key):
+        """
+        The in-flight call for key, and whether this caller leads it: a
+        leader must finish() the call, anyone else wait() for it.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+        return call, leader
+
+    def finish(self, key, call, result=None, error=None):
+        call.result, call.error = result, error
+        with self.lock:
+            del self.calls[key]
+        call.done.set()
+
+    @staticmethod
+    def wait(call):
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def do(self, key, func):
+        call, leader = self.join(key)
+        if not leader:
+            return self.wait(call)
+
+        try:
+            result = func()
+        except Exception as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result
+
+
+flights = SingleFlight()
+
+
+def advisory_lock_id(name):
+    # pg_advisory_lock takes a signed 64-bit key
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'big', signed=True)
+
+
+@contextmanager
+def advisory_lock(name):
+    """
+    Hold a PostgreSQL session advisory lock on name, so the block runs in one
+    worker process at a time. It is held outside any transaction, for as long
+    as the block takes. Other databases get no cross-process lock.
+    """
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    lock_id = advisory_lock_id(name)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(%s)", [lock_id])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", [lock_id])
+
+
+def following_paragraph(chapter_id, page, previous_paragraph_id, after_id=0):
+    """
+    The paragraph that was added after previous_paragraph_id on page, or the
+    first paragraph of the page when there was no previous paragraph. Only
+    paragraphs with ids above after_id count, so a caller can ignore those
+    that existed before it started.
+    """
+    paragraphs = Paragraph.objects.filter(chapter_id=chapter_id, page=page, id__gt=after_id)
+    if previous_paragraph_id is not None:
+        previous_number = Paragraph.objects.filter(id=previous_paragraph_id).values_list(
+            'paragraph_number', flat=True
+        ).first()
+        paragraphs = paragraphs.filter(paragraph_number__gt=previous_number)
+    return paragraphs.order_by('paragraph_number').first()
+
+
+def generation_lock_name(chapter_id, page, previous_paragraph_id):
+    return f"stories:generate:{chapter_id}:{page}:{previous_paragraph_id}"
+
+
+def generate_with_lock(chapter_id, page, previous_paragraph_id, after_id=0):
+    """
+    Generate the paragraph after previous_paragraph_id unless another worker
+    has done so since after_id, in which case that paragraph is returned
+    instead.
+    """
+    with advisory_lock(generation_lock_name(chapter_id, page, previous_paragraph_id)):
+        existing = following_paragraph(chapter_id, page, previous_paragraph_id, after_id)
+        if existing is not None:
+            logger.info(f"Paragraph after {previous_paragraph_id} was generated by a concurrent request")
+            return existing
+        return publish_draft(chapter_id, previous_paragraph_id) or generate_next_paragraph(
+            chapter_id, previous_paragraph_id
+        )
+
+
+def generation_position(chapter_id, previous_paragraph_id):
+    """
+    The page the paragraph after previous_paragraph_id goes on, and the
+    highest paragraph id on it so far: paragraphs above it were added by
+    requests running at the same time.
+    """
+    if previous_paragraph_id is None:
+        page = 1
+    else:
+        page = Paragraph.objects.filter(id=previous_paragraph_id).values_list('page', flat=True).get()
+    after_id = Paragraph.objects.filter(chapter_id=chapter_id, page=page).aggregate(last=Max('id'))['last'] or 0
+    return page, after_id
+
+
+def generate_paragraph_once(chapter_id, previous_paragraph_id):
+    """
+    Generate the paragraph that follows previous_paragraph_id, coalescing
+    concurrent requests for the same position: within a process they share a
+    single call, and across processes an advisory lock lets the first one
+    generate while the rest wait and return its paragraph.
+    """
+    page, after_id = generation_position(chapter_id, previous_paragraph_id)
+    return flights.do(
+        (chapter_id, page, previous_paragraph_id),
+        lambda: generate_with_lock(chapter_id, page, previous_paragraph_id, after_id)
+    )
+
+
+def published_stream(paragraph):
+    """
+    Token stream for a paragraph that is already saved: its whole text at once.
+    """
+    yield paragraph.text
+    return paragraph
+
+
+def stream_paragraph_once(chapter_id, previous_paragraph_id):
+    """
+    Streaming variant of generate_paragraph_once. The request that generates
+    streams tokens as the model writes them; requests coalesced with it get
+    the saved paragraph's text in one piece once it is done.
+    """
+    page, after_id = generation_position(chapter_id, previous_paragraph_id)
+    key = (chapter_id, page, previous_paragraph_id)
+    call, leader = flights.join(key)
+    if not leader:
+        return (yield from published_stream(flights.wait(call)))
+
+    paragraph, error = None, None
+    try:
+        with advisory_lock(generation_lock_name(chapter_id, page, previous_paragraph_id)):
+            paragraph = following_paragraph(chapter_id, page, previous_paragraph_id, after_id)
+            if paragraph is None:
+                paragraph = publish_draft(chapter_id, previous_paragraph_id)
+            if paragraph is not None:
+                return (yield from published_stream(paragraph))
+            paragraph = yield from stream_next_paragraph(chapter_id, previous_paragraph_id)
+            return paragraph
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if paragraph is None and error is None:
+            # The client went away mid-stream, so nothing was saved
+            error = RuntimeError("Generation was cancelled")
+        flights.finish(key, call, paragraph, error)
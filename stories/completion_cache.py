@@ -0,0 +1,176 @@
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .models import CompletionCacheEntry
+
+
+class MemoryTier:
+    """
+    Per-process LRU of completions, bounded by entry count. Entries older
+    than ttl, if given, are ignored and dropped.
+    """
+    name = 'memory'
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires_at = self.entries.get(key, (None, None))
+            if value is None:
+                return None
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, model=None):
+        expires_at = time.monotonic() + self.ttl.total_seconds() if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DatabaseTier:
+    """
+    Completions shared by all processes in the CompletionCacheEntry table.
+    Entries older than ttl are ignored and deleted. Once the table holds
+    more than max_entries, the least recently used entries are evicted. This
+    check runs every prune_every writes.
+    """
+    name = 'database'
+
+    def __init__(self, max_entries=10000, ttl=timedelta(days=30), prune_every=100):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self.writes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = timezone.now()
+        value = CompletionCacheEntry.objects.filter(
+            key=key, created_at__gte=now - self.ttl
+        ).values_list('response', flat=True).first()
+        if value is not None:
+            CompletionCacheEntry.objects.filter(key=key).update(hits=F('hits') + 1, last_used_at=now)
+        return value
+
+    def set(self, key, value, model=None):
+        now = timezone.now()
+        CompletionCacheEntry.objects.bulk_create(
+            [CompletionCacheEntry(key=key, model=model or '', response=value, created_at=now, last_used_at=now)],
+            update_conflicts=True,
+            unique_fields=['key'],
+            update_fields=['model', 'response', 'created_at', 'last_used_at']
+        )
+        with self.lock:
+            self.writes += 1
+            due = self.writes % self.prune_every == 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        """
+        Delete expired entries, then the least recently used ones beyond
+        max_entries. Returns the number of entries deleted.
+        """
+        deleted, _ = CompletionCacheEntry.objects.filter(created_at__lt=timezone.now() - self.ttl).delete()
+        excess = CompletionCacheEntry.objects.count() - self.max_entries
+        if excess > 0:
+            oldest = list(
+                CompletionCacheEntry.objects.order_by('last_used_at', 'id').values_list('id', flat=True)[:excess]
+            )
+            deleted += CompletionCacheEntry.objects.filter(id__in=oldest).delete()[0]
+        return deleted
+
+    def clear(self):
+        CompletionCacheEntry.objects.all().delete()
+
+
+class CompletionCache:
+    """
+    Chat completions looked up through a list of tiers, fastest first. A hit
+    in a slower tier is copied into the faster ones. Hits per tier and misses
+    are counted for this process.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = list(tiers)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model, messages, temperature):
+        encoded = json.dumps([model, messages, temperature], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode()).hexdigest()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                self.count(f'{tier.name}_hits')
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                return value
+        self.count('misses')
+        return None
+
+    def set(self, key, value, model=None):
+        for tier in self.tiers:
+            tier.set(key, value, model)
+
+    def stats(self):
+        with self.lock:
+            stats = {f'{tier.name}_hits': self.counters[f'{tier.name}_hits'] for tier in self.tiers}
+            stats['misses'] = self.counters['misses']
+        lookups = sum(stats.values())
+        stats['hit_rate'] = (lookups - stats['misses']) / lookups if lookups else 0.0
+        return stats
+
+    def reset_stats(self):
+        with self.lock:
+            self.counters.clear()
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+
+def build_completion_cache():
+    """
+    The completion cache configured by the STORIES_COMPLETION_CACHE_* settings.
+    With STORIES_COMPLETION_CACHE disabled it has no tiers and always misses.
+    """
+    if not getattr(settings, 'STORIES_COMPLETION_CACHE', True):
+        return CompletionCache([])
+    ttl = getattr(settings, 'STORIES_COMPLETION_CACHE_TTL', timedelta(days=30))
+    return CompletionCache([
+        MemoryTier(max_entries=getattr(settings, 'STORIES_COMPLETION_CACHE_MEMORY_ENTRIES', 1024), ttl=ttl),
+        DatabaseTier(max_entries=getattr(settings, 'STORIES_COMPLETION_CACHE_DB_ENTRIES', 10000), ttl=ttl),
+    ])
+
+
+completion_cache = build_completion_cache()
@@ -0,0 +1,90 @@
+from django.db.models import Q
+
+from .models import Paragraph, ChapterSummary
+
+# Rough token budgets for prompt context. Tokens are estimated from character
+# counts so no tokenizer is needed on the request path.
+CONTEXT_TOKEN_BUDGET = 3000
+SUMMARY_BATCH_TOKENS = 1000
+# Upper bound on verbatim paragraphs, so the query can walk the reading order
+# index backwards and stop instead of sorting the whole chapter
+MAX_RECENT_PARAGRAPHS = 100
+CHARS_PER_TOKEN = 4
+# Share of the budget the chapter summary may take when it is used
+SUMMARY_BUDGET_SHARE = 0.5
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def trim_to_tokens(text, max_tokens):
+    """
+    text cut at a word boundary to roughly max_tokens.
+    """
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + '…'
+
+
+def build_chapter_context(chapter, current_page, token_budget=CONTEXT_TOKEN_BUDGET):
+    """
+    Assemble the chapter text that precedes the end of current_page within
+    token_budget. The most recent paragraphs are included verbatim, newest
+    first, until the budget runs out. If older paragraphs had to be left out
+    the chapter's rolling summary, trimmed to a share of the budget, stands in
+    for them; paragraphs it doesn't cover yet are always kept, and the
+    summary's tokens come out of what's left for those it does cover. When
+    generating on an earlier page the summary may run past current_page; it
+    is still used, labelled as covering later events too, rather than losing
+    the older text.
+    """
+    summary, summary_page, summary_number = ChapterSummary.objects.filter(chapter=chapter).values_list(
+        'text', 'page', 'paragraph_number'
+    ).first() or ("", 0, 0)
+    summary = trim_to_tokens(summary, int(token_budget * SUMMARY_BUDGET_SHARE))
+
+    # (text, tokens, whether the summary covers it), newest first
+    recent = []
+    used = 0
+    truncated = False
+    rows = Paragraph.objects.filter(
+        chapter=chapter,
+        page__lte=current_page
+    ).order_by('-page', '-paragraph_number').values_list('page', 'paragraph_number', 'text')[:MAX_RECENT_PARAGRAPHS]
+    for page, paragraph_number, text in rows.iterator(chunk_size=50):
+        tokens = estimate_tokens(text)
+        covered = not summary or (page, paragraph_number) <= (summary_page, summary_number)
+        if covered and used + tokens > token_budget and recent:
+            truncated = True
+            break
+        recent.append((text, tokens, covered))
+        used += tokens
+    else:
+        truncated = len(recent) == MAX_RECENT_PARAGRAPHS
+
+    use_summary = truncated and summary
+    if use_summary:
+        # Make room for the summary from the paragraphs it covers
+        used += estimate_tokens(summary)
+        while used > token_budget and len(recent) > 1 and recent[-1][2]:
+            used -= recent.pop()[1]
+    context = "\n".join(text for text, _, _ in reversed(recent))
+    if use_summary:
+        if summary_page > current_page:
+            heading = "Summary of this chapter, including events that come after this point:"
+        else:
+            heading = "Summary of earlier events in this chapter:"
+        context = f"{heading}\n{summary}\n\nMost recent text:\n{context}"
+    return context
+
+
+def unsummarized_paragraphs(summary):
+    """
+    Paragraphs of the summary's chapter that come after its cursor, in reading order.
+    """
+    return Paragraph.objects.filter(
+        Q(page__gt=summary.page) | Q(page=summary.page, paragraph_number__gt=summary.paragraph_number),
+        chapter_id=summary.chapter_id
+    ).order_by('page', 'paragraph_number')
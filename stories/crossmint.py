@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .models import CrossmintCollection
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth retrying: rate limiting and gateway errors in front of Crossmint
+RETRY_STATUSES = {429, 502, 503, 504}
+# Statuses that mean the request was turned away without being acted on, so
+# even a request that isn't idempotent can be repeated
+REJECTED_STATUSES = {429}
+
+DEFAULT_NFT_METADATA = {
+    "name": "Crossmint Example NFT",
+    "image": "https://www.crossmint.com/assets/crossmint/logo.png",
+    "description": "My NFT created via the mint API!"
+}
+# Using a valid Solana address format
+DEFAULT_RECIPIENT = "solana:5FHwkrdxkN8yPBkLZM1X3jKHgvzxM3T6oF8VyuxWSjAM"
+
+
+def failed_to_connect(error):
+    """
+    Whether a requests exception was raised before the request was sent:
+    the connection timed out or was refused.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class CrossmintClient:
+    """
+    Crossmint API client sharing one keep-alive connection pool across calls
+    and threads. Every request has a connect and read timeout, and requests
+    that fail before reaching Crossmint or are answered with a retryable
+    status are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, api_key=None, env='staging', base_url=None, timeout=(3.05, 30),
+                 max_retries=3, backoff=0.5, max_backoff=10, pool_size=10):
+        self.api_key = api_key
+        self.env = env
+        self.base_url = (base_url or f"https://{env}.crossmint.com/api").rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.collection_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'X-API-KEY': api_key or '', 'Content-Type': 'application/json'})
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before retry number attempt (1-based): a server supplied
+        Retry-After when there is one, otherwise full jitter over an
+        exponentially growing window.
+        """
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def request(self, method, path, idempotent=False, **kwargs):
+        """
+        Send a request and return the decoded JSON body. Raises the requests
+        exception for the last failure once retries are exhausted.
+
+        Requests that aren't idempotent are only retried when they can't have
+        been acted on: the connection failed before sending, or Crossmint
+        answered 429. After a gateway error, a dropped connection or a read
+        timeout the request may already have been carried out, and repeating
+        a mint would mint twice.
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault('timeout', self.timeout)
+        retry_statuses = RETRY_STATUSES if idempotent else REJECTED_STATUSES
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                if not (idempotent or failed_to_connect(e)):
+                    raise
+                if attempt > self.max_retries:
+                    logger.error(f"Crossmint {method} {path} failed after {attempt} attempts: {e}")
+                    raise
+                delay = self.backoff_delay(attempt)
+                logger.warning(f"Crossmint {method} {path} failed, retrying in {delay:.2f}s: {e}")
+            else:
+                if response.status_code not in retry_statuses or attempt > self.max_retries:
+                    if response.status_code >= 400:
+                        logger.error(f"Crossmint {method} {path} returned {response.status_code}: {response.text}")
+                    response.raise_for_status()
+                    return response.json()
+                delay = self.backoff_delay(attempt, response.headers.get('Retry-After'))
+                logger.warning(f"Crossmint {method} {path} returned {response.status_code}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+    def create_wallet(self, signer_public_key):
+        return self.request('POST', 'v1-alpha2/wallets', json={
+            "type": "evm-smart-wallet",
+            "config": {
+                "signer": {
+                    "type": "evm-keypair",
+                    "address": signer_public_key
+                }
+            }
+        })
+
+    def create_collection(self, chain="solana"):
+        return self.request('POST', '2022-06-09/collections/', json={
+            "chain": chain,
+            "metadata": {
+                "name": "Sample NFT Collection",
+                "imageUrl": "https://www.crossmint.com/assets/crossmint/logo.png",
+                "description": "This is a sample NFT collection"
+            },
+            "fungibility": "non-fungible",
+            "transferable": True,
+            "supplyLimit": 123,
+            "reuploadLinkedFiles": True
+        })
+
+    def collection_cache_key(self, chain):
+        return f"stories:crossmint-collection:{self.env}:{chain}"
+
+    def collection_id(self, chain="solana"):
+        """
+        Id of the collection to mint into on chain, created on first use.
+        Configured ids in STORIES_CROSSMINT_COLLECTIONS, keyed by (env, chain),
+        take precedence. Created ids are stored in the database, so every
+        process shares one collection, and cached so later mints cost a
+        single round trip.
+        """
+        configured = getattr(settings, 'STORIES_CROSSMINT_COLLECTIONS', {}).get((self.env, chain))
+        if configured:
+            return configured
+
+        key = self.collection_cache_key(chain)
+        collection_id = cache.get(key)
+        if collection_id:
+            return collection_id
+        with self.collection_lock:
+            collection_id = CrossmintCollection.objects.filter(env=self.env, chain=chain).exclude(
+                collection_id=''
+            ).values_list('collection_id', flat=True).first()
+            if not collection_id:
+                # Created outside any transaction so no lock is held across
+                # the call. Processes racing to create the first collection
+                # all keep whichever one is saved first.
+                created_id = self.create_collection(chain=chain)['id']
+                collection, created = CrossmintCollection.objects.get_or_create(
+                    env=self.env, chain=chain, defaults={'collection_id': created_id}
+                )
+                collection_id = collection.collection_id
+                if created:
+                    logger.info(f"Created Crossmint collection {collection_id} for {self.env}/{chain}")
+                else:
+                    logger.warning(
+                        f"Not using Crossmint collection {created_id}: {collection_id} was saved first for "
+                        f"{self.env}/{chain}"
+                    )
+        transaction.on_commit(lambda: cache.set(key, collection_id, None))
+        return collection_id
+
+    def mint_nft(self, recipient=DEFAULT_RECIPIENT, metadata=None, chain="solana", collection_id=None, nft_id=None):
+        """
+        Mint an NFT. With nft_id the mint is sent as an idempotent PUT under
+        that id, so repeating it can never mint a second token.
+        """
+        collection_id = collection_id or self.collection_id(chain)
+        body = {
+            "metadata": metadata or DEFAULT_NFT_METADATA,
+            "recipient": recipient,
+            "sendNotification": True,
+            "locale": "en-US",
+            "reuploadLinkedFiles": True,
+            "compressed": chain == "solana"
+        }
+        if nft_id:
+            return self.request('PUT', f'2022-06-09/collections/{collection_id}/nfts/{nft_id}', idempotent=True, json=body)
+        return self.request('POST', f'2022-06-09/collections/{collection_id}/nfts', json=body)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncCrossmintClient:
+    """
+    asyncio front end for a CrossmintClient, so calls can be awaited together
+    with asyncio.gather. Each call runs on a worker thread against the shared
+    connection pool; at most pool_size calls are in flight at once.
+    """
+
+    def __init__(self, client=None, **kwargs):
+        self.client = client or CrossmintClient(**kwargs)
+        self.semaphore = None
+
+    async def call(self, func, *args, **kwargs):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.client.pool_size)
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def request(self, method, path, **kwargs):
+        return await self.call(self.client.request, method, path, **kwargs)
+
+    async def create_wallet(self, signer_public_key):
+        return await self.call(self.client.create_wallet, signer_public_key)
+
+    async def create_collection(self, chain="solana"):
+        return await self.call(self.client.create_collection, chain=chain)
+
+    async def collection_id(self, chain="solana"):
+        def lookup():
+            # Worker threads outlive the call, so don't leave them holding a
+            # database connection
+            try:
+                return self.client.collection_id(chain)
+            finally:
+                connection.close()
+
+        return await self.call(lookup)
+
+    async def mint_nft(self, recipient=DEFAULT_RECIPIENT, metadata=None, chain="solana", collection_id=None, nft_id=None):
+        # Resolve the collection once up front so concurrent mints don't queue
+        # behind each other on the collection lock
+        collection_id = collection_id or await self.collection_id(chain)
+        return await self.call(
+            self.client.mint_nft, recipient=recipient, metadata=metadata, chain=chain,
+            collection_id=collection_id, nft_id=nft_id
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.client.close()
+
+
+class AsyncRateLimiter:
+    """
+    Spaces calls at least 1/rate seconds apart, for staying under an API's
+    request rate limit. A rate of None or 0 means no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key=None, env=None):
+    """
+    Shared CrossmintClient for an api key and environment, configured from
+    the STORIES_CROSSMINT_* settings. The key defaults to CROSSMINT_API_KEY.
+    """
+    api_key = api_key or os.environ.get('CROSSMINT_API_KEY')
+    env = env or getattr(settings, 'STORIES_CROSSMINT_ENV', 'staging')
+    with _clients_lock:
+        client = _clients.get((api_key, env))
+        if client is None:
+            client = _clients[(api_key, env)] = CrossmintClient(
+                api_key=api_key,
+                env=env,
+                base_url=getattr(settings, 'STORIES_CROSSMINT_BASE_URL', None),
+                timeout=getattr(settings, 'STORIES_CROSSMINT_TIMEOUT', (3.05, 30)),
+                max_retries=getattr(settings, 'STORIES_CROSSMINT_MAX_RETRIES', 3),
+                pool_size=getattr(settings, 'STORIES_CROSSMINT_POOL_SIZE', 10),
+            )
+    return client
@@ -0,0 +1,169 @@
+import logging
+import random
+import time
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, F, Min
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Task name -> callable. Handlers are registered with the @register decorator.
+registry = {}
+
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 15 * 60
+STALE_AFTER = timedelta(minutes=10)
+
+
+def register(name):
+    """
+    Register a function as a background job handler under ``name``.
+    The handler is called with the job payload as keyword arguments.
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(task, payload=None, dedupe_key=None, run_after=None, max_attempts=5):
+    """
+    Queue a job for the worker. If a pending or running job already exists for
+    ``dedupe_key`` no new job is created and None is returned.
+    """
+    try:
+        with transaction.atomic():
+            return Job.objects.create(
+                task=task,
+                payload=payload or {},
+                dedupe_key=dedupe_key,
+                run_after=run_after or timezone.now(),
+                max_attempts=max_attempts,
+            )
+    except IntegrityError:
+        logger.debug(f"Job {task} already queued for key {dedupe_key}")
+        return None
+
+
+def backoff_delay(attempts):
+    """
+    Exponential backoff with full jitter, capped at BACKOFF_MAX_SECONDS.
+    """
+    ceiling = min(BACKOFF_BASE_SECONDS * (2 ** attempts), BACKOFF_MAX_SECONDS)
+    return timedelta(seconds=random.uniform(BACKOFF_BASE_SECONDS, ceiling))
+
+
+def requeue_stale_jobs(stale_after=STALE_AFTER):
+    """
+    Return jobs left in the running state by a crashed worker to the queue.
+    """
+    cutoff = timezone.now() - stale_after
+    return Job.objects.filter(
+        status=Job.STATUS_RUNNING,
+        started_at__lt=cutoff
+    ).update(status=Job.STATUS_PENDING, run_after=timezone.now())
+
+
+def claim_jobs(limit=1):
+    """
+    Atomically claim up to ``limit`` due jobs. Rows locked by other workers are
+    skipped, so any number of workers can poll the same table.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            Job.objects.select_for_update(skip_locked=True).filter(
+                status=Job.STATUS_PENDING,
+                run_after__lte=now
+            ).order_by('run_after', 'id')[:limit]
+        )
+        if not jobs:
+            return []
+        Job.objects.filter(id__in=[job.id for job in jobs]).update(
+            status=Job.STATUS_RUNNING,
+            started_at=now,
+            attempts=F('attempts') + 1
+        )
+    for job in jobs:
+        job.status = Job.STATUS_RUNNING
+        job.started_at = now
+        job.attempts += 1
+    return jobs
+
+
+def run_job(job):
+    """
+    Execute a claimed job and record the outcome, scheduling a retry on failure.
+    """
+    handler = registry.get(job.task)
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for task '{job.task}'")
+        handler(**job.payload)
+    except Exception as e:
+        logger.error(f"Job {job} failed on attempt {job.attempts}: {e}", exc_info=True)
+        job.last_error = str(e)
+        if job.attempts >= job.max_attempts:
+            job.status = Job.STATUS_FAILED
+            job.finished_at = timezone.now()
+        else:
+            job.status = Job.STATUS_PENDING
+            job.run_after = timezone.now() + backoff_delay(job.attempts)
+        job.save(update_fields=['status', 'run_after', 'finished_at', 'last_error'])
+        return False
+
+    job.status = Job.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'finished_at'])
+    return True
+
+
+def run_worker(batch_size=10, poll_interval=1.0, once=False):
+    """
+    Claim and run jobs until interrupted. With ``once`` the worker drains the
+    currently due jobs and returns the number processed.
+    """
+    processed = 0
+    requeue_stale_jobs()
+    while True:
+        jobs = claim_jobs(batch_size)
+        for job in jobs:
+            run_job(job)
+            processed += 1
+        if not jobs:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+
+
+def queue_stats(window=timedelta(hours=1)):
+    """
+    Summarise queue depth per status and wait/run latency for recently
+    finished jobs.
+    """
+    now = timezone.now()
+    depth = dict(
+        Job.objects.order_by().values('status').annotate(total=Count('id')).values_list('status', 'total')
+    )
+    oldest_pending = Job.objects.filter(
+        status=Job.STATUS_PENDING
+    ).aggregate(oldest=Min('created_at'))['oldest']
+    recent = Job.objects.filter(
+        status=Job.STATUS_DONE,
+        finished_at__gte=now - window
+    ).aggregate(
+        completed=Count('id'),
+        avg_wait=Avg(F('started_at') - F('created_at')),
+        avg_run=Avg(F('finished_at') - F('started_at')),
+    )
+    return {
+        'depth': {status: depth.get(status, 0) for status, _ in Job.STATUS_CHOICES},
+        'oldest_pending_age': (now - oldest_pending) if oldest_pending else None,
+        'completed_last_window': recent['completed'],
+        'avg_wait': recent['avg_wait'],
+        'avg_run': recent['avg_run'],
+    }
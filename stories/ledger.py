@@ -0,0 +1,126 @@
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+from .models import NFT, Payment, RevenueLedger
+
+CENT = Decimal('0.01')
+
+
+def owner_share(amount, revenue_share_percentage):
+    return (Decimal(amount) * Decimal(revenue_share_percentage) / 100).quantize(CENT)
+
+
+def record_payment(payment):
+    """
+    Save a new payment and, if it succeeded, add it to its paragraph's ledger
+    row. The owner's share is worked out first and saved with the payment,
+    so reconciling can add up the same rounded shares even after the
+    percentage changes. Must run in a transaction so the two can't drift
+    apart. Returns the saved payment.
+    """
+    amount = Decimal(str(payment.amount))
+    share = None
+    if payment.successful:
+        percentage = NFT.objects.filter(
+            paragraph_id=payment.paragraph_id
+        ).values_list('revenue_share_percentage', flat=True).first()
+        share = owner_share(amount, percentage) if percentage is not None else Decimal(0)
+    payment.owner_share = share
+    payment.save()
+    if not payment.successful:
+        return payment
+
+    while True:
+        updated = RevenueLedger.objects.filter(paragraph_id=payment.paragraph_id).update(
+            total_revenue=F('total_revenue') + amount,
+            owner_share=F('owner_share') + share,
+            payment_count=F('payment_count') + 1
+        )
+        if updated:
+            return payment
+        try:
+            with transaction.atomic():
+                RevenueLedger.objects.create(
+                    paragraph_id=payment.paragraph_id,
+                    total_revenue=amount,
+                    owner_share=share,
+                    payment_count=1
+                )
+            return payment
+        except IntegrityError:
+            # A concurrent payment created the row first; add to it instead
+            continue
+
+
+def portfolio(user):
+    """
+    Ledger totals for every NFT the user owns, in one query.
+    """
+    return NFT.objects.filter(owner=user).order_by('id').values(
+        'id',
+        'paragraph_id',
+        'revenue_share_percentage',
+        total_revenue=Coalesce(F('paragraph__revenue_ledger__total_revenue'), Decimal(0)),
+        owner_share=Coalesce(F('paragraph__revenue_ledger__owner_share'), Decimal(0)),
+        payment_count=Coalesce(F('paragraph__revenue_ledger__payment_count'), 0),
+    )
+
+
+def expected_ledger():
+    """
+    Ledger rows recomputed from the Payment table, keyed by paragraph id.
+    Owner shares add up each payment's own rounded share, as record_payment
+    does; payments recorded without one are counted at the NFT's current
+    revenue share percentage.
+    """
+    percentages = dict(NFT.objects.values_list('paragraph_id', 'revenue_share_percentage'))
+    payments = Payment.objects.filter(successful=True).order_by().values_list('paragraph_id', 'amount', 'owner_share')
+
+    expected = {}
+    for paragraph_id, amount, share in payments.iterator(chunk_size=5000):
+        if share is None:
+            percentage = percentages.get(paragraph_id)
+            share = owner_share(amount, percentage) if percentage is not None else Decimal(0)
+        row = expected.get(paragraph_id)
+        if row is None:
+            row = expected[paragraph_id] = RevenueLedger(
+                paragraph_id=paragraph_id, total_revenue=Decimal(0), owner_share=Decimal(0), payment_count=0
+            )
+        row.total_revenue += amount
+        row.owner_share += share
+        row.payment_count += 1
+    return expected
+
+
+def reconcile(fix=False):
+    """
+    Compare the ledger with totals recomputed from payments. Returns a list of
+    (paragraph_id, ledger row or None, expected row or None) for every
+    mismatch, and with ``fix`` rewrites the ledger to match.
+    """
+    fields = ('total_revenue', 'owner_share', 'payment_count')
+    expected = expected_ledger()
+    actual = {row.paragraph_id: row for row in RevenueLedger.objects.iterator()}
+
+    mismatches = []
+    for paragraph_id in sorted(expected.keys() | actual.keys()):
+        have, want = actual.get(paragraph_id), expected.get(paragraph_id)
+        if have is None or want is None or any(getattr(have, f) != getattr(want, f) for f in fields):
+            mismatches.append((paragraph_id, have, want))
+
+    if fix and mismatches:
+        with transaction.atomic():
+            RevenueLedger.objects.filter(
+                paragraph_id__in=[paragraph_id for paragraph_id, _, want in mismatches if want is None]
+            ).delete()
+            RevenueLedger.objects.bulk_create(
+                [want for _, have, want in mismatches if want is not None],
+                batch_size=1000,
+                update_conflicts=True,
+                unique_fields=['paragraph'],
+                update_fields=list(fields)
+            )
+    return mismatches
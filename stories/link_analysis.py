@@ -0,0 +1,202 @@
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import tasks
+from .cache import invalidate_chapter_pages
+from .context import estimate_tokens
+from .models import Paragraph
+from .term_index import annotate_locally, extract_links, index_links, validate_link_html
+
+logger = logging.getLogger(__name__)
+
+# Prompt tokens of paragraph text per request. The reply repeats every
+# paragraph with markup added, so prompt and reply together stay well inside
+# GPT-4's 8k context.
+BATCH_TOKEN_BUDGET = 2500
+MAX_BATCH_PARAGRAPHS = 20
+
+BATCH_SYSTEM_PROMPT = """You are an AI that identifies important words or phrases that could be wiki-style links.
+You will receive a JSON array of paragraphs, each with an "id" and "text". For every paragraph select 2-4
+significant nouns or phrases that could lead to interesting related content and wrap each one in
+<a href="/wiki/Phrase_With_Underscores">phrase</a>. Do not change any other text.
+Respond with only a JSON object of the form {"paragraphs": [{"id": <id>, "html": "<paragraph with links>"}]},
+with one entry for every paragraph you were given."""
+
+def pack_batches(paragraphs, token_budget=BATCH_TOKEN_BUDGET, max_paragraphs=MAX_BATCH_PARAGRAPHS):
+    """
+    Group (id, text) pairs into batches of at most max_paragraphs whose text
+    fits in token_budget. A paragraph longer than the budget gets a batch
+    of its own.
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for paragraph_id, text in paragraphs:
+        tokens = estimate_tokens(text)
+        if batch and (batch_tokens + tokens > token_budget or len(batch) >= max_paragraphs):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append((paragraph_id, text))
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def parse_batch_response(content):
+    """
+    Map paragraph ids to html from a batch reply, tolerating a Markdown code
+    fence around the JSON.
+    """
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1].rsplit("```", 1)[0]
+    data = json.loads(content)
+    return {int(item['id']): item['html'] for item in data['paragraphs']}
+
+
+class BatchTruncated(Exception):
+    pass
+
+
+def request_batch(batch, client, model):
+    """
+    Annotate one batch with a single completion. Returns valid html by
+    paragraph id and the ids that came back missing or invalid.
+    """
+    response = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": json.dumps([{"id": pid, "text": text} for pid, text in batch])}
+        ],
+        temperature=0.3,
+    )
+    choice = response.choices[0]
+    if choice.finish_reason == 'length':
+        raise BatchTruncated(f"Reply for {len(batch)} paragraphs hit the token limit")
+    html_by_id = parse_batch_response(choice.message.content)
+
+    annotated, rejected = {}, []
+    for paragraph_id, text in batch:
+        html = html_by_id.get(paragraph_id)
+        errors = ["missing from reply"] if html is None else validate_link_html(text, html)
+        if errors:
+            logger.warning(f"Rejected links for paragraph {paragraph_id}: {'; '.join(errors)}")
+            rejected.append(paragraph_id)
+        else:
+            annotated[paragraph_id] = html
+    return annotated, rejected
+
+
+def analyze_batch(batch, client, model):
+    """
+    Annotate a batch, halving it and retrying the halves when the reply was
+    cut off or isn't valid JSON. Returns (annotated, rejected, requests).
+    """
+    try:
+        annotated, rejected = request_batch(batch, client, model)
+        return annotated, rejected, 1
+    except (BatchTruncated, ValueError, KeyError, TypeError) as e:
+        if len(batch) == 1:
+            logger.warning(f"Giving up on paragraph {batch[0][0]}: {e}")
+            return {}, [batch[0][0]], 1
+        logger.info(f"Splitting batch of {len(batch)} paragraphs: {e}")
+        middle = len(batch) // 2
+        annotated, rejected, requests = {}, [], 1
+        for half in (batch[:middle], batch[middle:]):
+            half_annotated, half_rejected, half_requests = analyze_batch(half, client, model)
+            annotated.update(half_annotated)
+            rejected.extend(half_rejected)
+            requests += half_requests
+        return annotated, rejected, requests
+
+
+def save_links(annotated, locations):
+    """
+    Write annotated html with a single bulk update. bulk_update skips the
+    post_save signal, so the cached pages are dropped here.
+    """
+    now = timezone.now()
+    paragraphs = [
+        Paragraph(id=paragraph_id, text_with_links=html, updated_at=now) for paragraph_id, html in annotated.items()
+    ]
+    pages = defaultdict(set)
+    for paragraph_id in annotated:
+        chapter_id, page = locations[paragraph_id]
+        pages[chapter_id].add(page)
+
+    def invalidate_pages():
+        for chapter_id, chapter_pages in pages.items():
+            invalidate_chapter_pages(chapter_id, chapter_pages)
+
+    with transaction.atomic():
+        Paragraph.objects.bulk_update(paragraphs, ['text_with_links', 'updated_at'])
+        transaction.on_commit(invalidate_pages)
+
+
+def analyze_links_in_batches(paragraphs, token_budget=None, max_paragraphs=None, concurrency=None,
+                             client=None, model=None):
+    """
+    Add wiki-style links to every paragraph in the queryset. Paragraphs the
+    story's term index can link on its own are annotated locally; the rest go
+    to the LLM, several paragraphs per completion and up to concurrency
+    completions at once. Results are written, and their links added to the
+    term index, as each batch finishes. Paragraphs whose reply is missing or
+    fails validation are left unchanged and counted as rejected; those in a
+    batch whose request raised are counted as failed.
+
+    Returns a dict of counts: paragraphs, local, batches, requests,
+    annotated, rejected and failed. annotated includes local.
+    """
+    token_budget = token_budget or getattr(settings, 'STORIES_LINK_BATCH_TOKENS', BATCH_TOKEN_BUDGET)
+    max_paragraphs = max_paragraphs or getattr(settings, 'STORIES_LINK_BATCH_PARAGRAPHS', MAX_BATCH_PARAGRAPHS)
+    concurrency = concurrency or getattr(settings, 'STORIES_LINK_BATCH_CONCURRENCY', 4)
+    client = client or tasks.client
+    model = model or getattr(settings, 'STORIES_LINK_ANALYSIS_MODEL', 'gpt-4')
+
+    rows = list(paragraphs.order_by('id').values_list('id', 'text', 'chapter_id', 'page', 'chapter__story_id'))
+    locations = {paragraph_id: (chapter_id, page) for paragraph_id, _, chapter_id, page, _ in rows}
+    stories = {paragraph_id: story_id for paragraph_id, _, _, _, story_id in rows}
+
+    local, remaining = {}, []
+    for paragraph_id, text, _, _, story_id in rows:
+        html = annotate_locally(story_id, text)
+        if html is None:
+            remaining.append((paragraph_id, text))
+        else:
+            local[paragraph_id] = html
+    if local:
+        save_links(local, locations)
+    batches = pack_batches(remaining, token_budget, max_paragraphs)
+
+    totals = {
+        'paragraphs': len(rows), 'local': len(local), 'batches': len(batches), 'requests': 0,
+        'annotated': len(local), 'rejected': 0, 'failed': 0
+    }
+    # Only the completions run on worker threads; all database access stays
+    # on this thread
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(analyze_batch, batch, client, model): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                annotated, rejected, requests = future.result()
+            except Exception as e:
+                logger.error(f"Link analysis batch of {len(futures[future])} paragraphs failed: {e}", exc_info=True)
+                totals['failed'] += len(futures[future])
+                continue
+            if annotated:
+                save_links(annotated, locations)
+                links = defaultdict(list)
+                for paragraph_id, html in annotated.items():
+                    links[stories[paragraph_id]].extend(extract_links(html))
+                index_links(links)
+            totals['requests'] += requests
+            totals['annotated'] += len(annotated)
+            totals['rejected'] += len(rejected)
+    return totals
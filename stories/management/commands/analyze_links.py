@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from stories.link_analysis import analyze_links_in_batches
+from stories.models import Paragraph
+
+
+class Command(BaseCommand):
+    help = 'Add wiki-style links to paragraphs, several paragraphs per LLM request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--story', type=int, help='Only paragraphs of this story')
+        parser.add_argument('--chapter', type=int, help='Only paragraphs of this chapter')
+        parser.add_argument('--all', action='store_true', help='Re-analyze paragraphs that already have links')
+        parser.add_argument('--batch-tokens', type=int, help='Paragraph tokens per request')
+        parser.add_argument('--max-batch', type=int, help='Paragraphs per request')
+        parser.add_argument('--concurrency', type=int, help='Requests in flight at once')
+        parser.add_argument('--json', action='store_true', help='Print the totals as JSON')
+
+    def handle(self, *args, **options):
+        paragraphs = Paragraph.objects.all()
+        if options['story']:
+            paragraphs = paragraphs.filter(chapter__story_id=options['story'])
+        if options['chapter']:
+            paragraphs = paragraphs.filter(chapter_id=options['chapter'])
+        if not options['all']:
+            paragraphs = paragraphs.filter(Q(text_with_links__isnull=True) | Q(text_with_links=''))
+
+        totals = analyze_links_in_batches(
+            paragraphs,
+            token_budget=options['batch_tokens'],
+            max_paragraphs=options['max_batch'],
+            concurrency=options['concurrency'],
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(totals))
+            return
+        self.stdout.write(
+            f"{totals['paragraphs']} paragraphs, {totals['local']} linked from the term index, "
+            f"{totals['batches']} batches, {totals['requests']} requests"
+        )
+        style = self.style.WARNING if totals['rejected'] or totals['failed'] else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Annotated {totals['annotated']}, rejected {totals['rejected']}, failed {totals['failed']}"
+        ))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from stories.benchmarks import registry
+
+
+class Command(BaseCommand):
+    help = 'Run performance benchmarks against throwaway data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='Benchmarks to run (default: all)')
+        parser.add_argument('--sizes', nargs='+', type=int, help='Dataset sizes to run each benchmark at')
+
+    def handle(self, *args, **options):
+        names = options['names'] or sorted(registry)
+        unknown = set(names) - set(registry)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}. Available: {', '.join(sorted(registry))}")
+
+        for name in names:
+            func, default_sizes, rollback = registry[name]
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for size in options['sizes'] or default_sizes:
+                if rollback:
+                    with transaction.atomic():
+                        results = func(size)
+                        transaction.set_rollback(True)
+                else:
+                    results = func(size)
+                formatted = '  '.join(
+                    f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}'
+                    for key, value in results.items()
+                )
+                self.stdout.write(f'  size={size:<8} {formatted}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from stories.term_index import rebuild_term_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the term index used for linking paragraphs without the LLM from existing links'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--story', type=int, help='Only rebuild the index of this story')
+
+    def handle(self, *args, **options):
+        count = rebuild_term_index(story_id=options['story'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} terms'))
@@ -0,0 +1,36 @@
+from django.db.models import Count, Min, Sum
+from django.core.management.base import BaseCommand
+from stories.completion_cache import DatabaseTier, completion_cache
+from stories.models import CompletionCacheEntry
+
+
+class Command(BaseCommand):
+    help = 'Show completion cache usage, or prune or clear the database tier'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true', help='Evict expired and least recently used entries')
+        parser.add_argument('--clear', action='store_true', help='Delete every cached completion')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            completion_cache.clear()
+            self.stdout.write(self.style.SUCCESS('Cleared the completion cache'))
+        elif options['prune']:
+            for tier in completion_cache.tiers:
+                if isinstance(tier, DatabaseTier):
+                    self.stdout.write(self.style.SUCCESS(f'Pruned {tier.prune()} entries'))
+
+        totals = CompletionCacheEntry.objects.aggregate(entries=Count('id'), hits=Sum('hits'), oldest=Min('created_at'))
+        self.stdout.write(f"Entries: {totals['entries']}")
+        # Every entry was stored after a miss, so entries approximate misses
+        # since the oldest surviving entry
+        self.stdout.write(f"Database hits: {totals['hits'] or 0}")
+        self.stdout.write(f"Oldest entry: {totals['oldest'] or '-'}")
+        for model, entries, hits in CompletionCacheEntry.objects.order_by('model').values_list('model').annotate(
+            entries=Count('id'), hits=Sum('hits')
+        ):
+            self.stdout.write(f"  {model:<20} {entries} entries, {hits} hits")
+        # Counters are per process, so these cover lookups made in this one
+        stats = completion_cache.stats()
+        lookups = ', '.join(f"{name} {count}" for name, count in stats.items() if name != 'hit_rate')
+        self.stdout.write(f"This process: {lookups}, hit rate {stats['hit_rate']:.0%}")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from stories.speculation import draft_stats
+
+
+class Command(BaseCommand):
+    help = 'Show how often paragraphs generated ahead of time are published'
+
+    def handle(self, *args, **options):
+        stats = draft_stats()
+        self.stdout.write(f"Published: {stats['published']}")
+        self.stdout.write(f"Discarded: {stats['discarded']}")
+        self.stdout.write(f"Failed: {stats['failed']}")
+        self.stdout.write(f"Waiting: {stats['waiting']}")
+        self.stdout.write(f"Hit rate: {stats['hit_rate']:.1%}")
+        self.stdout.write(f"Generation time saved: {stats['saved_ms'] / 1000:.1f}s")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from stories.jobs import queue_stats
+
+
+class Command(BaseCommand):
+    help = 'Show background job queue depth and latency'
+
+    def handle(self, *args, **options):
+        stats = queue_stats()
+        for status, total in stats['depth'].items():
+            self.stdout.write(f'{status:<10} {total}')
+        self.stdout.write(f"Oldest pending job age: {stats['oldest_pending_age'] or '-'}")
+        self.stdout.write(f"Completed in the last hour: {stats['completed_last_window']}")
+        self.stdout.write(f"Average wait before start: {stats['avg_wait'] or '-'}")
+        self.stdout.write(f"Average run time: {stats['avg_run'] or '-'}")
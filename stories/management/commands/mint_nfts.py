@@ -0,0 +1,55 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from stories.jobs import enqueue
+from stories.minting import MissingWallet, mint_paragraphs, paragraphs_to_mint
+
+
+class Command(BaseCommand):
+    help = 'Mint NFTs for every paragraph of a chapter or story, resuming any earlier run'
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--chapter', type=int, help='Chapter id')
+        target.add_argument('--story', type=int, help='Story id')
+        parser.add_argument('--owner', help='Username to own the NFTs (default: the story author)')
+        parser.add_argument('--recipient', help="Wallet locator to mint to (default: the owner's wallet)")
+        parser.add_argument('--chain', default='solana')
+        parser.add_argument('--concurrency', type=int, help='Mints in flight at once')
+        parser.add_argument('--rate', type=float, help='Maximum mints submitted per second')
+        parser.add_argument('--queue', action='store_true', help='Run in the background job worker instead')
+
+    def handle(self, *args, **options):
+        owner = None
+        if options['owner']:
+            try:
+                owner = get_user_model().objects.get(username=options['owner'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No user named {options['owner']}")
+
+        if options['queue']:
+            job = enqueue('mint_nfts', {
+                'chapter_id': options['chapter'],
+                'story_id': options['story'],
+                'owner_id': owner.id if owner else None,
+                'recipient': options['recipient'],
+                'chain': options['chain'],
+                'concurrency': options['concurrency'],
+                'rate': options['rate'],
+            })
+            self.stdout.write(self.style.SUCCESS(f'Queued job {job.id}'))
+            return
+
+        try:
+            totals = mint_paragraphs(
+                paragraphs_to_mint(options['chapter'], options['story']),
+                owner=owner,
+                recipient=options['recipient'],
+                chain=options['chain'],
+                concurrency=options['concurrency'],
+                rate=options['rate'],
+            )
+        except MissingWallet as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Queued {totals['queued']} new paragraphs")
+        style = self.style.WARNING if totals['failed'] else self.style.SUCCESS
+        self.stdout.write(style(f"Minted {totals['minted']}, failed {totals['failed']}"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from stories.page_index import rebuild_page_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute chapter page indexes from their paragraphs, repairing any that have drifted. '
+        'Run after writing paragraphs with raw SQL or anything else that bypasses the ORM'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chapter', type=int, action='append', dest='chapters', help='Only this chapter (repeatable)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Chapters rebuilt per transaction')
+
+    def handle(self, *args, **options):
+        repaired = rebuild_page_index(chapter_ids=options['chapters'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Repaired {repaired} chapter page indexes'))
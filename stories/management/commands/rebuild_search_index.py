@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from stories.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the paragraph search index from scratch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Paragraphs indexed per transaction')
+
+    def handle(self, *args, **options):
+        count = rebuild_search_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} paragraphs'))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from stories.ledger import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recompute paragraph revenue from payments and report differences from the revenue ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Rewrite mismatched ledger rows')
+
+    def handle(self, *args, **options):
+        mismatches = reconcile(fix=options['fix'])
+        for paragraph_id, have, want in mismatches:
+            have_text = f'{have.total_revenue} / {have.owner_share} / {have.payment_count}' if have else 'missing'
+            want_text = f'{want.total_revenue} / {want.owner_share} / {want.payment_count}' if want else 'missing'
+            self.stdout.write(f'Paragraph {paragraph_id}: ledger {have_text}, payments {want_text}')
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS('Revenue ledger matches payments'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'Fixed {len(mismatches)} ledger rows'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{len(mismatches)} ledger rows differ; run with --fix to repair'))
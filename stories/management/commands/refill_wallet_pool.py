@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from stories.wallets import pool_depth, refill_wallet_pool
+
+
+class Command(BaseCommand):
+    help = 'Top up the pool of pre-created wallets handed out at first login'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', type=int, help='Available wallets to fill up to (default: high watermark)')
+        parser.add_argument('--concurrency', type=int, help='Wallets to create in parallel')
+        parser.add_argument('--status', action='store_true', help='Only report pool depth')
+
+    def write_depth(self):
+        depth = pool_depth()
+        self.stdout.write(
+            f"Available: {depth['available']}  Claimed: {depth['claimed']}  "
+            f"Watermarks: {depth['low_watermark']}/{depth['high_watermark']}"
+        )
+        if depth['needs_refill']:
+            self.stdout.write(self.style.WARNING('Pool is below its low watermark'))
+
+    def handle(self, *args, **options):
+        self.write_depth()
+        if options['status']:
+            return
+        added = refill_wallet_pool(target=options['target'], concurrency=options['concurrency'])
+        self.stdout.write(self.style.SUCCESS(f'Added {added} wallets'))
+        self.write_depth()
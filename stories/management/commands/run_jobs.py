@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from stories.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Run the background job worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10, help='Jobs claimed per poll')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain due jobs and exit')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Job worker started')
+        try:
+            processed = run_worker(
+                batch_size=options['batch_size'],
+                poll_interval=options['poll_interval'],
+                once=options['once']
+            )
+        except KeyboardInterrupt:
+            self.stdout.write('Job worker stopped')
+            return
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} jobs'))
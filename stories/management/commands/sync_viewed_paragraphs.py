@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from stories.tracking import sync_viewed_paragraphs
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy viewed paragraphs from the other storage into the one STORIES_VIEWED_PARAGRAPHS_STORAGE selects. '
+        'Run after changing the setting, or views recorded before the switch stay hidden'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=['m2m', 'bitmap'], help='Storage to fill (default: the configured one)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Progress rows synced per transaction')
+
+    def handle(self, *args, **options):
+        synced = sync_viewed_paragraphs(to=options['to'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Synced {synced} reading progress rows'))
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0010_job'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChapterSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(blank=True)),
+                ('page', models.PositiveIntegerField(default=0)),
+                ('paragraph_number', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='paragraph',
+            index=models.Index(fields=['chapter', 'page', 'paragraph_number'], name='paragraph_reading_order_idx'),
+        ),
+        migrations.AddField(
+            model_name='chaptersummary',
+            name='chapter',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='stories.chapter'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0011_chaptersummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParagraphSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.PositiveIntegerField()),
+                ('last_number', models.PositiveIntegerField(default=0)),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='paragraph_sequences', to='stories.chapter')),
+            ],
+            options={
+                'unique_together': {('chapter', 'page')},
+            },
+        ),
+    ]
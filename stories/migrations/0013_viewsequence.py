@@ -0,0 +1,36 @@
+# Generated by Django 5.1.2 on 2026-10-18 11:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_view_sequences(apps, schema_editor):
+    ParagraphView = apps.get_model('stories', 'ParagraphView')
+    ViewSequence = apps.get_model('stories', 'ViewSequence')
+    highest = ParagraphView.objects.order_by().values('user_id').annotate(last=Max('view_order'))
+    ViewSequence.objects.bulk_create(
+        (ViewSequence(user_id=row['user_id'], last_view_order=row['last']) for row in highest.iterator()),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0012_paragraphsequence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_view_order', models.PositiveIntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='view_sequence', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(seed_view_sequences, migrations.RunPython.noop),
+    ]
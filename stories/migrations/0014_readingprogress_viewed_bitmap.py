@@ -0,0 +1,59 @@
+# Generated by Django 5.1.2 on 2026-10-18 12:07
+
+import struct
+import zlib
+
+from django.db import migrations, models
+
+
+def encode_bitmap(ids):
+    """
+    The serialized form of ParagraphBitmap, frozen here so later changes to
+    the class don't change what this migration writes: a little-endian
+    uint64 lowest id, then one bit per id from there, zlib compressed.
+    """
+    base = min(ids)
+    value = 0
+    for paragraph_id in ids:
+        value |= 1 << (paragraph_id - base)
+    return zlib.compress(struct.pack('<Q', base) + value.to_bytes((value.bit_length() + 7) // 8, 'little'))
+
+
+def convert_viewed_paragraphs(apps, schema_editor):
+    """
+    Build each ReadingProgress's viewed_bitmap from its viewed_paragraphs links.
+    """
+    ReadingProgress = apps.get_model('stories', 'ReadingProgress')
+    Through = ReadingProgress.viewed_paragraphs.through
+    links = Through.objects.order_by('readingprogress_id').values_list('readingprogress_id', 'paragraph_id')
+
+    batch = []
+    current_id, ids = None, None
+    for progress_id, paragraph_id in links.iterator(chunk_size=5000):
+        if progress_id != current_id:
+            if current_id is not None:
+                batch.append(ReadingProgress(id=current_id, viewed_bitmap=encode_bitmap(ids)))
+            current_id, ids = progress_id, []
+        ids.append(paragraph_id)
+        if len(batch) >= 1000:
+            ReadingProgress.objects.bulk_update(batch, ['viewed_bitmap'])
+            batch = []
+    if current_id is not None:
+        batch.append(ReadingProgress(id=current_id, viewed_bitmap=encode_bitmap(ids)))
+    ReadingProgress.objects.bulk_update(batch, ['viewed_bitmap'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0013_viewsequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readingprogress',
+            name='viewed_bitmap',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(convert_viewed_paragraphs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:05
+
+import django.db.models.deletion
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def backfill_revenue_ledger(apps, schema_editor):
+    """
+    Ledger rows from successful payments. Owner shares are rounded per
+    payment and added up, as the ledger accrues them.
+    """
+    Payment = apps.get_model('stories', 'Payment')
+    NFT = apps.get_model('stories', 'NFT')
+    RevenueLedger = apps.get_model('stories', 'RevenueLedger')
+    percentages = dict(NFT.objects.values_list('paragraph_id', 'revenue_share_percentage'))
+    rows = {}
+    payments = Payment.objects.filter(successful=True).order_by().values_list('paragraph_id', 'amount')
+    for paragraph_id, amount in payments.iterator(chunk_size=5000):
+        row = rows.get(paragraph_id)
+        if row is None:
+            row = rows[paragraph_id] = RevenueLedger(
+                paragraph_id=paragraph_id, total_revenue=Decimal(0), owner_share=Decimal(0), payment_count=0
+            )
+        row.total_revenue += amount
+        row.owner_share += (amount * percentages.get(paragraph_id, 0) / 100).quantize(Decimal('0.01'))
+        row.payment_count += 1
+    RevenueLedger.objects.bulk_create(rows.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0014_readingprogress_viewed_bitmap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevenueLedger',
+            fields=[
+                ('paragraph', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='revenue_ledger', serialize=False, to='stories.paragraph')),
+                ('total_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('owner_share', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('payment_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_revenue_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0016_unlockrequest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PooledWallet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=255, unique=True)),
+                ('chain', models.CharField(max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('reader', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='pooled_wallet', to='stories.reader')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('claimed_at__isnull', True)), fields=['id'], name='pooled_wallet_available_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0017_pooledwallet'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NFTMint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient', models.CharField(max_length=255)),
+                ('crossmint_id', models.CharField(max_length=255)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('minted', 'Minted'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='nft_mints', to=settings.AUTH_USER_MODEL)),
+                ('paragraph', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='nft_mint', to='stories.paragraph')),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 16:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0019_completioncacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoryTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phrase', models.CharField(max_length=255)),
+                ('href', models.CharField(max_length=500)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='stories.story')),
+            ],
+            options={
+                'unique_together': {('story', 'phrase')},
+            },
+        ),
+    ]
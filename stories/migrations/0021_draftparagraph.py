@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-18 17:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0020_storyterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DraftParagraph',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('page', models.IntegerField()),
+                ('text', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('published', 'Published'), ('discarded', 'Discarded'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('generation_ms', models.PositiveIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drafts', to='stories.chapter')),
+                ('previous_paragraph', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='stories.paragraph')),
+            ],
+            options={
+                'unique_together': {('chapter', 'previous_paragraph')},
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.2 on 2026-10-18 18:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0021_draftparagraph'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParagraphTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('frequency', models.PositiveIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('paragraph', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='stories.paragraph')),
+            ],
+            options={
+                'unique_together': {('term', 'paragraph')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0022_paragraphterm'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', '-payment_date', '-id'], name='payment_user_recent_idx'),
+        ),
+    ]
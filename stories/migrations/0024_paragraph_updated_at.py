@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:50
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0023_payment_user_recent_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paragraph',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='paragraph',
+            index=models.Index(fields=['chapter', 'updated_at'], name='paragraph_chapter_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:05
+
+from itertools import groupby
+
+from django.db import migrations, models
+
+
+def backfill_page_index(apps, schema_editor):
+    Chapter = apps.get_model('stories', 'Chapter')
+    Paragraph = apps.get_model('stories', 'Paragraph')
+    rows = Paragraph.objects.order_by('chapter_id', 'page', 'paragraph_number').values_list(
+        'chapter_id', 'page', 'paragraph_number', 'id'
+    )
+    for chapter_id, chapter_rows in groupby(rows.iterator(chunk_size=2000), key=lambda row: row[0]):
+        index, count = [], 0
+        for _, page, number, paragraph_id in chapter_rows:
+            while len(index) < page:
+                index.append({'paragraphs': 0, 'last_paragraph': None, 'last_number': 0})
+            index[page - 1]['paragraphs'] += 1
+            index[page - 1]['last_paragraph'] = paragraph_id
+            index[page - 1]['last_number'] = number
+            count += 1
+        Chapter.objects.filter(id=chapter_id).update(page_index=index, page_count=len(index), paragraph_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0024_paragraph_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='page_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='page_index',
+            field=models.JSONField(default=list, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='paragraph_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_page_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0025_chapter_page_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paragraphview',
+            name='viewed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
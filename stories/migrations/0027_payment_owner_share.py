@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0026_paragraphview_viewed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='owner_share',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+    ]
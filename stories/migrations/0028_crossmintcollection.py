@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0027_payment_owner_share'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrossmintCollection',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('env', models.CharField(max_length=20)),
+                ('chain', models.CharField(max_length=20)),
+                ('collection_id', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('env', 'chain')},
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.1.2 on 2026-10-18 17:20
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations
+
+
+def backfill_owner_shares(apps, schema_editor):
+    """
+    Give payments recorded before owner shares were stored the share at
+    their NFT's current percentage, rounded per payment, and set each ledger
+    row's owner_share to the sum, as reconciling expects.
+    """
+    Payment = apps.get_model('stories', 'Payment')
+    NFT = apps.get_model('stories', 'NFT')
+    RevenueLedger = apps.get_model('stories', 'RevenueLedger')
+    percentages = dict(NFT.objects.values_list('paragraph_id', 'revenue_share_percentage'))
+
+    batch = []
+    legacy = Payment.objects.filter(successful=True, owner_share__isnull=True).only('id', 'paragraph_id', 'amount')
+    for payment in legacy.iterator(chunk_size=5000):
+        payment.owner_share = (payment.amount * percentages.get(payment.paragraph_id, 0) / 100).quantize(Decimal('0.01'))
+        batch.append(payment)
+        if len(batch) >= 1000:
+            Payment.objects.bulk_update(batch, ['owner_share'])
+            batch = []
+    Payment.objects.bulk_update(batch, ['owner_share'])
+
+    shares = defaultdict(Decimal)
+    payments = Payment.objects.filter(successful=True).order_by().values_list('paragraph_id', 'owner_share')
+    for paragraph_id, share in payments.iterator(chunk_size=5000):
+        shares[paragraph_id] += share
+    ledgers = list(RevenueLedger.objects.filter(paragraph_id__in=shares).only('paragraph_id', 'owner_share'))
+    for ledger in ledgers:
+        ledger.owner_share = shares[ledger.paragraph_id]
+    RevenueLedger.objects.bulk_update(ledgers, ['owner_share'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0028_crossmintcollection'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_owner_shares, migrations.RunPython.noop),
+    ]
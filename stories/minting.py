@@ -0,0 +1,240 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.html import strip_tags
+from django.utils.text import Truncator
+
+from .cache import invalidate_chapter_pages
+from .crossmint import DEFAULT_NFT_METADATA, AsyncCrossmintClient, AsyncRateLimiter, get_client
+from .jobs import register
+from .models import NFT, NFTMint, Paragraph, Reader
+
+logger = logging.getLogger(__name__)
+
+# Mints submitted between checkpoints
+MINT_BATCH_SIZE = 50
+MAX_MINT_ATTEMPTS = 3
+
+
+def crossmint_nft_id(paragraph_id):
+    return f"stories-paragraph-{paragraph_id}"
+
+
+def paragraph_metadata(paragraph):
+    """
+    NFT metadata for a paragraph. Expects chapter and story to be loaded.
+    """
+    chapter = paragraph.chapter
+    story = chapter.story
+    position = f"{chapter.chapter_number}.{paragraph.page}.{paragraph.paragraph_number}"
+    return {
+        # Crossmint caps names at 32 characters
+        "name": f"{Truncator(story.title).chars(31 - len(position))} {position}",
+        "image": getattr(settings, 'STORIES_NFT_IMAGE', DEFAULT_NFT_METADATA['image']),
+        "description": Truncator(strip_tags(paragraph.text)).chars(1000),
+        "attributes": [
+            {"trait_type": "Story", "value": story.title},
+            {"trait_type": "Chapter", "value": chapter.title},
+            {"trait_type": "Chapter number", "value": str(chapter.chapter_number)},
+            {"trait_type": "Page", "value": str(paragraph.page)},
+            {"trait_type": "Paragraph", "value": str(paragraph.paragraph_number)},
+        ],
+    }
+
+
+def paragraphs_to_mint(chapter_id=None, story_id=None):
+    if chapter_id is not None:
+        return Paragraph.objects.filter(chapter_id=chapter_id)
+    return Paragraph.objects.filter(chapter__story_id=story_id)
+
+
+class MissingWallet(Exception):
+    pass
+
+
+def wallet_family(wallet_chain):
+    """
+    'solana' or 'evm' for a Reader.wallet_chain, which holds either a chain
+    or a Crossmint wallet type such as 'evm-smart-wallet'.
+    """
+    return 'solana' if wallet_chain.startswith('solana') else 'evm'
+
+
+def owner_wallets(owner_ids, chain):
+    """
+    Recipient locators for the wallets of the given users, keyed by user id.
+    A user's wallet is the one given to the reader with the same email at
+    login; users without one, or whose wallet can't hold tokens on chain,
+    are left out.
+    """
+    emails = dict(get_user_model().objects.filter(id__in=owner_ids).exclude(email='').values_list('id', 'email'))
+    wallets = {
+        email: address
+        for email, address, wallet_chain in Reader.objects.filter(email__in=emails.values()).exclude(
+            wallet_address=''
+        ).values_list('email', 'wallet_address', 'wallet_chain')
+        if wallet_family(wallet_chain) == wallet_family(chain)
+    }
+    return {
+        user_id: f"{chain}:{wallets[email]}"
+        for user_id, email in emails.items() if email in wallets
+    }
+
+
+def queue_mints(paragraphs, owner=None, recipient=None, chain="solana"):
+    """
+    Create pending checkpoints for paragraphs that have neither an NFT nor a
+    checkpoint yet. NFTs go to owner, or to the story's author by default,
+    and are minted to recipient or else to the owner's wallet. Raises
+    MissingWallet, queuing nothing, if an owner has no wallet on chain.
+    Returns the number of checkpoints created.
+    """
+    candidates = [
+        (paragraph_id, owner.id if owner else author_id)
+        for paragraph_id, author_id in paragraphs.filter(nft__isnull=True, nft_mint__isnull=True).values_list(
+            'id', 'chapter__story__author_id'
+        )
+    ]
+    recipients = {}
+    if not recipient:
+        owner_ids = {owner_id for _, owner_id in candidates}
+        recipients = owner_wallets(owner_ids, chain)
+        missing = owner_ids - recipients.keys()
+        if missing:
+            usernames = get_user_model().objects.filter(id__in=missing).order_by('username').values_list(
+                'username', flat=True
+            )
+            raise MissingWallet(f"No wallet to mint to for {', '.join(usernames)}; pass a recipient")
+
+    created = NFTMint.objects.bulk_create(
+        [
+            NFTMint(
+                paragraph_id=paragraph_id,
+                owner_id=owner_id,
+                recipient=recipient or recipients[owner_id],
+                crossmint_id=crossmint_nft_id(paragraph_id),
+            )
+            for paragraph_id, owner_id in candidates
+        ],
+        batch_size=1000,
+        ignore_conflicts=True
+    )
+    return len(created)
+
+
+async def submit_mints(mints, client, collection_id, chain, concurrency, rate):
+    """
+    Submit a batch of mints, at most concurrency at a time and no faster than
+    rate per second. Returns the Crossmint response or exception for each.
+    """
+    async_client = AsyncCrossmintClient(client)
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = AsyncRateLimiter(rate)
+
+    async def submit(mint):
+        async with semaphore:
+            await limiter.wait()
+            return await async_client.mint_nft(
+                recipient=mint.recipient,
+                metadata=paragraph_metadata(mint.paragraph),
+                chain=chain,
+                collection_id=collection_id,
+                nft_id=mint.crossmint_id
+            )
+
+    return await asyncio.gather(*(submit(mint) for mint in mints), return_exceptions=True)
+
+
+def save_results(mints, results):
+    """
+    Checkpoint a submitted batch and write NFT rows and paragraph owners for
+    the successful mints, all in one transaction. Bulk writes skip the
+    paragraph post_save signal, so the affected cached pages are dropped here.
+    """
+    now = timezone.now()
+    minted = []
+    for mint, result in zip(mints, results):
+        mint.attempts += 1
+        mint.updated_at = now
+        if isinstance(result, Exception):
+            mint.status = NFTMint.STATUS_FAILED
+            mint.last_error = str(result)
+        else:
+            mint.status = NFTMint.STATUS_MINTED
+            mint.last_error = ''
+            mint.paragraph.nft_owner_id = mint.owner_id
+            mint.paragraph.updated_at = now
+            minted.append(mint)
+
+    pages = defaultdict(set)
+    for mint in minted:
+        pages[mint.paragraph.chapter_id].add(mint.paragraph.page)
+
+    def invalidate_pages():
+        for chapter_id, chapter_pages in pages.items():
+            invalidate_chapter_pages(chapter_id, chapter_pages)
+
+    with transaction.atomic():
+        NFTMint.objects.bulk_update(mints, ['status', 'attempts', 'last_error', 'updated_at'])
+        NFT.objects.bulk_create(
+            [NFT(paragraph_id=mint.paragraph_id, owner_id=mint.owner_id) for mint in minted],
+            ignore_conflicts=True
+        )
+        Paragraph.objects.bulk_update([mint.paragraph for mint in minted], ['nft_owner', 'updated_at'])
+        transaction.on_commit(invalidate_pages)
+    return len(minted)
+
+
+def mint_paragraphs(paragraphs, owner=None, recipient=None, chain="solana", concurrency=None, rate=None,
+                    client=None, batch_size=MINT_BATCH_SIZE, max_attempts=MAX_MINT_ATTEMPTS):
+    """
+    Mint an NFT for every paragraph in the queryset that doesn't have one.
+
+    Progress is checkpointed in NFTMint after each batch. Running again picks
+    up pending and failed mints (up to max_attempts); each paragraph is always
+    minted under the same Crossmint id with an idempotent PUT, so a batch
+    that was in flight when a run crashed is safe to resubmit.
+
+    Returns a dict with the number of mints queued, minted and failed.
+    """
+    client = client or get_client()
+    concurrency = concurrency or getattr(settings, 'STORIES_MINT_CONCURRENCY', 5)
+    rate = getattr(settings, 'STORIES_MINT_RATE', 10) if rate is None else rate
+
+    totals = {'queued': queue_mints(paragraphs, owner, recipient, chain), 'minted': 0, 'failed': 0}
+    mint_ids = list(NFTMint.objects.filter(
+        paragraph__in=paragraphs,
+        status__in=[NFTMint.STATUS_PENDING, NFTMint.STATUS_FAILED],
+        attempts__lt=max_attempts
+    ).order_by('paragraph_id').values_list('id', flat=True))
+    if not mint_ids:
+        return totals
+
+    collection_id = client.collection_id(chain)
+    for start in range(0, len(mint_ids), batch_size):
+        mints = list(
+            NFTMint.objects.filter(id__in=mint_ids[start:start + batch_size])
+            .select_related('paragraph__chapter__story')
+            .order_by('paragraph_id')
+        )
+        results = asyncio.run(submit_mints(mints, client, collection_id, chain, concurrency, rate))
+        minted = save_results(mints, results)
+        totals['minted'] += minted
+        totals['failed'] += len(mints) - minted
+        logger.info(f"Minted {totals['minted']} of {len(mint_ids)} paragraphs, {totals['failed']} failed")
+    return totals
+
+
+@register('mint_nfts')
+def mint_nfts(chapter_id=None, story_id=None, owner_id=None, recipient=None, chain="solana", concurrency=None,
+              rate=None):
+    owner = get_user_model().objects.get(id=owner_id) if owner_id is not None else None
+    return mint_paragraphs(
+        paragraphs_to_mint(chapter_id, story_id), owner=owner, recipient=recipient, chain=chain,
+        concurrency=concurrency, rate=rate
+    )
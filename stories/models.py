@@ -1,7 +1,12 @@
-from django.db import models
+from collections import defaultdict
+
+from django.db import models, transaction
+from django.utils import timezone
 from everything.models import User
 from tinymce.models import HTMLField
 
+from .cache import invalidate_chapter_pages
+
 class Story(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField()
@@ -17,6 +22,12 @@ class Chapter(models.Model):
     title = models.CharField(max_length=255)
     chapter_number = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Shape of the chapter, kept up to date as paragraphs are added and deleted
+    # (see stories.page_index). page_index has an entry per page, with its
+    # paragraph count and the id and number of its last paragraph.
+    page_count = models.PositiveIntegerField(default=0, editable=False)
+    paragraph_count = models.PositiveIntegerField(default=0, editable=False)
+    page_index = models.JSONField(default=list, editable=False)
 
     class Meta:
         unique_together = ('story', 'chapter_number')
@@ -26,6 +37,68 @@ class Chapter(models.Model):
         return f"{self.story.title} - Chapter {self.chapter_number}"
 
 
+class ParagraphQuerySet(models.QuerySet):
+    """
+    Keeps chapter page indexes, cached pages and the search index in step
+    with bulk inserts and updates, which skip the save signals that maintain
+    them for single paragraphs.
+    """
+    POSITION_FIELDS = {'chapter', 'chapter_id', 'page', 'paragraph_number'}
+
+    def rebuild_page_index(self, chapter_ids):
+        # Imported here, as page_index imports this module
+        from .page_index import rebuild_page_index
+        if chapter_ids:
+            rebuild_page_index(chapter_ids)
+
+    def index_text(self, rows):
+        # Imported here, as search imports this module
+        from .search import index_paragraphs, search_index_enabled
+        if rows and search_index_enabled():
+            index_paragraphs(rows)
+
+    def invalidate_pages(self, pages):
+        """
+        Drop the cached chapter pages for (chapter_id, page) pairs once the
+        transaction commits.
+        """
+        by_chapter = defaultdict(set)
+        for chapter_id, page in pages:
+            by_chapter[chapter_id].add(page)
+
+        def invalidate():
+            for chapter_id, chapter_pages in by_chapter.items():
+                invalidate_chapter_pages(chapter_id, chapter_pages)
+        if by_chapter:
+            transaction.on_commit(invalidate, using=self.db)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        self.rebuild_page_index({paragraph.chapter_id for paragraph in objs})
+        self.invalidate_pages({(paragraph.chapter_id, paragraph.page) for paragraph in objs})
+        # Backends that don't return ids leave these for rebuild_search_index
+        self.index_text([(paragraph.pk, paragraph.text) for paragraph in objs if paragraph.pk is not None])
+        return objs
+
+    def update(self, **kwargs):
+        # bulk_update() goes through here too
+        positions = list(self.values_list('pk', 'chapter_id', 'page'))
+        rows = super().update(**kwargs)
+        pages = {(chapter_id, page) for _, chapter_id, page in positions}
+        if self.POSITION_FIELDS & kwargs.keys():
+            # The paragraphs' new pages, and chapters if they moved, change too
+            pages |= set(self.model.objects.filter(
+                pk__in=[pk for pk, _, _ in positions]
+            ).values_list('chapter_id', 'page'))
+            self.rebuild_page_index({chapter_id for chapter_id, _ in pages})
+        self.invalidate_pages(pages)
+        if 'text' in kwargs:
+            self.index_text(list(self.model.objects.filter(
+                pk__in=[pk for pk, _, _ in positions]
+            ).values_list('pk', 'text')))
+        return rows
+
+
 class Paragraph(models.Model):
     chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name='paragraphs')
     text = models.TextField()
@@ -34,19 +107,63 @@ class Paragraph(models.Model):
     is_locked = models.BooleanField(default=True)
     nft_owner = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL, related_name='owned_paragraphs')
     text_with_links = HTMLField(blank=True, null=True)
+    # Bulk updates skip auto_now, so they set this themselves
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ParagraphQuerySet.as_manager()
 
     class Meta:
         unique_together = ('chapter', 'paragraph_number', 'page')
         ordering = ['page', 'paragraph_number']
+        indexes = [
+            # Reading order within a chapter
+            models.Index(fields=['chapter', 'page', 'paragraph_number'], name='paragraph_reading_order_idx'),
+            # Changes since a story bundle was built
+            models.Index(fields=['chapter', 'updated_at'], name='paragraph_chapter_updated_idx'),
+        ]
 
     def __str__(self):
         return f"{self.chapter} - Paragraph {self.paragraph_number}"
 
 
+
+
+class ParagraphSequence(models.Model):
+    """
+    Last paragraph number handed out on a chapter page. The row is locked while
+    a number is allocated so concurrent generators never collide.
+    """
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name='paragraph_sequences')
+    page = models.PositiveIntegerField()
+    last_number = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('chapter', 'page')
+
+    def __str__(self):
+        return f"{self.chapter} - Page {self.page} at paragraph {self.last_number}"
+
+class ChapterSummary(models.Model):
+    """
+    Rolling summary of a chapter, used in place of its full text when building
+    prompts. page/paragraph_number mark the last paragraph folded into it.
+    """
+    chapter = models.OneToOneField(Chapter, on_delete=models.CASCADE, related_name='summary')
+    text = models.TextField(blank=True)
+    page = models.PositiveIntegerField(default=0)
+    paragraph_number = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary of {self.chapter} up to page {self.page}, paragraph {self.paragraph_number}"
+
 class ReadingProgress(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reading_progress')
     story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='progress')
     viewed_paragraphs = models.ManyToManyField(Paragraph, related_name='viewed_by')
+    # Compressed ParagraphBitmap of viewed paragraph ids, used instead of
+    # viewed_paragraphs when STORIES_VIEWED_PARAGRAPHS_STORAGE is 'bitmap'
+    viewed_bitmap = models.BinaryField(null=True, blank=True, editable=False)
     last_accessed = models.DateTimeField(auto_now=True)
 
     class Meta:
@@ -62,6 +179,15 @@ class Payment(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)  # Adjust as needed for USDC
     payment_date = models.DateTimeField(auto_now_add=True)
     successful = models.BooleanField(default=True)
+    # The NFT owner's cut, at the revenue share in force when the payment was
+    # recorded. Null for payments that never went through the ledger.
+    owner_share = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # A user's payments, newest first
+            models.Index(fields=['user', '-payment_date', '-id'], name='payment_user_recent_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - Payment for {self.paragraph}"
@@ -77,12 +203,155 @@ class NFT(models.Model):
         return f"NFT of {self.paragraph} owned by {self.owner.username}"
 
 
+class NFTMint(models.Model):
+    """
+    Checkpoint for minting one paragraph in a batch run. Each paragraph is
+    minted under a fixed Crossmint id, so a run that crashed part way can be
+    resumed by resubmitting whatever is still pending without minting twice.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_MINTED = 'minted'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_MINTED, 'Minted'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    paragraph = models.OneToOneField(Paragraph, on_delete=models.CASCADE, related_name='nft_mint')
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='nft_mints')
+    recipient = models.CharField(max_length=255)
+    crossmint_id = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Mint of {self.paragraph} ({self.status})"
+
+
+class CrossmintCollection(models.Model):
+    """
+    Crossmint collection created to mint into, one per environment and chain,
+    so every worker process mints into the same collection.
+    """
+    env = models.CharField(max_length=20)
+    chain = models.CharField(max_length=20)
+    # Blank until Crossmint has answered; the row is locked meanwhile
+    collection_id = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('env', 'chain')
+
+    def __str__(self):
+        return f"{self.env}/{self.chain}: {self.collection_id}"
+
+
+class ParagraphTerm(models.Model):
+    """
+    Posting in the paragraph search index: term appears frequency times in
+    the paragraph, whose indexed text is length terms long.
+    """
+    term = models.CharField(max_length=64)
+    paragraph = models.ForeignKey(Paragraph, on_delete=models.CASCADE, related_name='search_terms')
+    frequency = models.PositiveIntegerField()
+    length = models.PositiveIntegerField()
+
+    class Meta:
+        # Also the index that looks up a term's postings
+        unique_together = ('term', 'paragraph')
+
+    def __str__(self):
+        return f"{self.term} in paragraph {self.paragraph_id}"
+
+
+class DraftParagraph(models.Model):
+    """
+    A paragraph generated ahead of time to follow previous_paragraph, while
+    readers are still on the last page. Published as-is if someone asks for
+    the next paragraph before the chapter has moved on, discarded otherwise.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_READY = 'ready'
+    STATUS_PUBLISHED = 'published'
+    STATUS_DISCARDED = 'discarded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_PUBLISHED, 'Published'),
+        (STATUS_DISCARDED, 'Discarded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name='drafts')
+    previous_paragraph = models.ForeignKey(Paragraph, on_delete=models.CASCADE, related_name='+')
+    page = models.IntegerField()
+    text = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # How long the completion took, which is what publishing the draft saves
+    generation_ms = models.PositiveIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('chapter', 'previous_paragraph')
+
+    def __str__(self):
+        return f"Draft after paragraph {self.previous_paragraph_id} ({self.status})"
+
+
+class RevenueLedger(models.Model):
+    """
+    Running payment totals for a paragraph, updated in the same transaction
+    as each Payment insert. owner_share accrues the NFT owner's cut at the
+    revenue share in force when each payment was made.
+    """
+    paragraph = models.OneToOneField(Paragraph, on_delete=models.CASCADE, primary_key=True, related_name='revenue_ledger')
+    total_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    owner_share = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payment_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Revenue for {self.paragraph}: {self.total_revenue}"
+
+
+class UnlockRequest(models.Model):
+    """
+    An unlock made with an Idempotency-Key. Retries with the same key get the
+    stored response back instead of being charged again; the fingerprint
+    catches a key being reused for a different request.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='unlock_requests')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    paragraph = models.ForeignKey(Paragraph, on_delete=models.CASCADE, related_name='unlock_requests')
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True)
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_unlock_request_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - Unlock {self.key} for {self.paragraph}"
+
+
+
 class ParagraphView(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='paragraph_views')
     story = models.ForeignKey(Story, on_delete=models.CASCADE)
     chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE)
     paragraph = models.ForeignKey(Paragraph, on_delete=models.CASCADE)
-    viewed_at = models.DateTimeField(auto_now_add=True)
+    # Set from the view event, so buffered views keep the time they were read
+    viewed_at = models.DateTimeField(default=timezone.now)
     view_order = models.PositiveIntegerField()
 
     class Meta:
@@ -93,6 +362,18 @@ class ParagraphView(models.Model):
         return f"{self.user.username} - {self.paragraph} - View #{self.view_order}"
 
 
+
+class ViewSequence(models.Model):
+    """
+    Last view_order handed out to a user, so recording a view is a single row
+    update rather than a scan of the user's history.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='view_sequence')
+    last_view_order = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user.username} at view #{self.last_view_order}"
+
 class Reader(models.Model):
     email = models.EmailField(unique=True)
     wallet_address = models.CharField(max_length=255)
@@ -101,3 +382,109 @@ class Reader(models.Model):
 
     def __str__(self):
         return f"Reader: {self.email} ({self.wallet_chain})"
+
+
+class PooledWallet(models.Model):
+    """
+    A wallet created ahead of time by the refill job. New readers claim one
+    at first login instead of waiting on Crossmint.
+    """
+    address = models.CharField(max_length=255, unique=True)
+    chain = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+    reader = models.OneToOneField(Reader, on_delete=models.SET_NULL, null=True, blank=True, related_name='pooled_wallet')
+    claimed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keeps claiming and counting available wallets cheap however many have been handed out
+            models.Index(fields=['id'], condition=models.Q(claimed_at__isnull=True), name='pooled_wallet_available_idx'),
+        ]
+
+    def __str__(self):
+        return f"Wallet {self.address} ({'claimed' if self.claimed_at else 'available'})"
+
+
+class StoryTerm(models.Model):
+    """
+    A phrase the LLM has linked somewhere in a story, and where it linked
+    to. Used to link the same phrases in new paragraphs without the LLM.
+    """
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='terms')
+    phrase = models.CharField(max_length=255)
+    href = models.CharField(max_length=500)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('story', 'phrase')
+
+    def __str__(self):
+        return f"{self.phrase} -> {self.href}"
+
+
+class CompletionCacheEntry(models.Model):
+    """
+    A stored chat completion, keyed by a hash of the model, messages and
+    temperature that produced it. This is the shared tier behind each
+    process's in-memory LRU.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=100)
+    response = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['last_used_at'], name='completion_last_used_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.model} completion {self.key[:12]}"
+
+
+class Job(models.Model):
+    """
+    A unit of background work, stored in the database and executed by the
+    ``run_jobs`` worker process.
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    task = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True)
+    dedupe_key = models.CharField(max_length=255, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['run_after', 'id']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+        ]
+        constraints = [
+            # Only one queued or running job per dedupe key
+            models.UniqueConstraint(
+                fields=['dedupe_key'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='unique_active_job_dedupe_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.id} ({self.status})"
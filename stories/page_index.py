@@ -0,0 +1,136 @@
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import Chapter, Paragraph
+
+INDEX_FIELDS = ('page_count', 'paragraph_count', 'page_index')
+
+
+def empty_page():
+    return {'paragraphs': 0, 'last_paragraph': None, 'last_number': 0}
+
+
+def build_page_index(rows):
+    """
+    Page index of a chapter from its (page, paragraph_number, id) rows in
+    reading order: one entry per page, with the page's paragraph count and
+    the id and number of its last paragraph.
+    """
+    index = []
+    for page, number, paragraph_id in rows:
+        while len(index) < page:
+            index.append(empty_page())
+        entry = index[page - 1]
+        entry['paragraphs'] += 1
+        entry['last_paragraph'] = paragraph_id
+        entry['last_number'] = number
+    return index
+
+
+def page_entry(chapter, page):
+    """
+    Index entry for a page of chapter, or None if the chapter has no such page.
+    """
+    if 1 <= page <= len(chapter.page_index):
+        return chapter.page_index[page - 1]
+    return None
+
+
+def has_page(chapter, page):
+    entry = page_entry(chapter, page)
+    return entry is not None and entry['paragraphs'] > 0
+
+
+def last_paragraph_on_page(chapter, page=None):
+    """
+    Id of the last paragraph on page, by default the chapter's last page, or
+    None if the page is empty.
+    """
+    entry = page_entry(chapter, chapter.page_count if page is None else page)
+    return entry['last_paragraph'] if entry else None
+
+
+def locked_chapter(chapter_id):
+    # FOR NO KEY UPDATE, so it doesn't wait on the key share lock that
+    # inserting a paragraph takes on its chapter
+    return Chapter.objects.select_for_update(no_key=True).only(*INDEX_FIELDS).get(id=chapter_id)
+
+
+def save_page_index(chapter, index):
+    # Pages emptied by deletions at the end of the chapter no longer count
+    while index and not index[-1]['paragraphs']:
+        index.pop()
+    chapter.page_index = index
+    chapter.page_count = len(index)
+    chapter.paragraph_count = sum(entry['paragraphs'] for entry in index)
+    chapter.save(update_fields=INDEX_FIELDS)
+
+
+def record_paragraph_added(paragraph):
+    """
+    Count a new paragraph in its chapter's page index. Runs in the inserting
+    transaction when there is one, and holds the chapter row until it commits.
+    """
+    with transaction.atomic():
+        chapter = locked_chapter(paragraph.chapter_id)
+        index = chapter.page_index
+        while len(index) < paragraph.page:
+            index.append(empty_page())
+        entry = index[paragraph.page - 1]
+        entry['paragraphs'] += 1
+        if paragraph.paragraph_number >= entry['last_number']:
+            entry['last_paragraph'] = paragraph.id
+            entry['last_number'] = paragraph.paragraph_number
+        save_page_index(chapter, index)
+
+
+def record_paragraph_removed(paragraph):
+    """
+    Recount the page a deleted paragraph was on.
+    """
+    with transaction.atomic():
+        try:
+            chapter = locked_chapter(paragraph.chapter_id)
+        except Chapter.DoesNotExist:
+            return
+        rows = list(Paragraph.objects.filter(chapter_id=chapter.id, page=paragraph.page).order_by(
+            'paragraph_number'
+        ).values_list('page', 'paragraph_number', 'id'))
+        index = chapter.page_index
+        if paragraph.page <= len(index):
+            index[paragraph.page - 1] = build_page_index(rows)[-1] if rows else empty_page()
+        save_page_index(chapter, index)
+
+
+def rebuild_page_index(chapter_ids=None, batch_size=500):
+    """
+    Recompute chapter page indexes from their paragraphs, saving those that
+    have drifted. Saves and queryset writes keep indexes current; this is for
+    paragraphs written around the ORM, such as by raw SQL, and for indexes
+    from before those hooks. Returns the number of chapters repaired.
+    """
+    chapters = Chapter.objects.order_by('id')
+    if chapter_ids is not None:
+        chapters = chapters.filter(id__in=chapter_ids)
+    ids = list(chapters.values_list('id', flat=True))
+
+    repaired = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with transaction.atomic():
+            # Lock before reading paragraphs, so an insert can't land in between
+            locked = list(Chapter.objects.select_for_update(no_key=True).filter(id__in=batch).only(*INDEX_FIELDS))
+            rows = defaultdict(list)
+            paragraphs = Paragraph.objects.filter(chapter_id__in=batch).order_by(
+                'chapter_id', 'page', 'paragraph_number'
+            ).values_list('chapter_id', 'page', 'paragraph_number', 'id')
+            for chapter_id, *row in paragraphs.iterator(chunk_size=2000):
+                rows[chapter_id].append(row)
+            for chapter in locked:
+                index = build_page_index(rows[chapter.id])
+                stored = (chapter.page_count, chapter.paragraph_count, chapter.page_index)
+                if stored != (len(index), len(rows[chapter.id]), index):
+                    save_page_index(chapter, index)
+                    repaired += 1
+    return repaired
@@ -0,0 +1,110 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    DjangoJSONEncoder, but keeping microseconds: a cursor must compare equal
+    to the row it came from.
+    """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position, cls=CursorEncoder).encode()).decode()
+
+
+def decode_cursor(cursor, length):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise NotFound("Invalid cursor")
+    if not isinstance(position, list) or len(position) != length:
+        raise NotFound("Invalid cursor")
+    return position
+
+
+def after_position(ordering, position):
+    """
+    Filter for rows that sort after position under ordering, spelled out as
+    (a > x) OR (a = x AND b > y) OR ... so it works on every database.
+    """
+    condition, equal = None, {}
+    for field, value in zip(ordering, position):
+        name = field.lstrip('-')
+        clause = Q(**equal, **{f"{name}__{'lt' if field.startswith('-') else 'gt'}": value})
+        condition = clause if condition is None else condition | clause
+        equal[name] = value
+    return condition
+
+
+class KeysetPagination(BasePagination):
+    """
+    Forward cursor pagination on an indexed, unique ordering. Each page is
+    read with a WHERE on the previous page's last key rather than an OFFSET,
+    so it costs the same however deep the client has paged. Cursors are
+    opaque tokens for the key of the last row served.
+
+    The ordering comes from the view's keyset_ordering, or is passed in for
+    custom actions. It must be unique, and be field names or attnames with a
+    '-' prefix for descending.
+    """
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+
+    def __init__(self, ordering=None):
+        self.ordering = ordering
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def position(self, row):
+        if isinstance(row, dict):
+            return [row[field.lstrip('-')] for field in self.ordering]
+        return [getattr(row, field.lstrip('-')) for field in self.ordering]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.ordering = tuple(self.ordering or view.keyset_ordering)
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                queryset = queryset.filter(after_position(self.ordering, decode_cursor(cursor, len(self.ordering))))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound("Invalid cursor")
+        rows = list(queryset.order_by(*self.ordering)[:page_size + 1])
+
+        self.next_position = self.position(rows[page_size - 1]) if len(rows) > page_size else None
+        return rows[:page_size]
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, encode_cursor(self.next_position)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
@@ -0,0 +1,60 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_OPTIONS = (orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer on orjson, several times faster on large payloads. Output
+    matches JSONRenderer's compact form: datetimes end in Z for UTC, and
+    anything orjson can't encode natively, such as Decimal and lazy strings,
+    goes through DRF's encoder. Indented and ASCII-only output, and servers
+    without orjson, fall back to JSONRenderer.
+    """
+    encoder = JSONRenderer.encoder_class()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (
+            orjson is None or self.ensure_ascii or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped by JSONRenderer so the output is also valid javascript
+        return orjson.dumps(data, default=self.encoder.default, option=ORJSON_OPTIONS).replace(
+            b'\xe2\x80\xa8', b'\\u2028'
+        ).replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+# Renderers for the read-heavy viewsets: the fast renderer ahead of the
+# project's configured ones, which still serve the browsable API
+READ_RENDERERS = [FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES]
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets clients that ask for text/event-stream through content negotiation
+    on the streaming actions, which return the stream themselves. Responses
+    that do go through a renderer, such as errors raised before the stream
+    starts, are sent as a single 'error' event.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return b'event: error\ndata: ' + JSONRenderer().render(data) + b'\n\n'
+
+
+# Renderers for the server-sent event actions: JSON for errors by default, or
+# the event stream for clients that only accept that
+STREAM_RENDERERS = [*READ_RENDERERS, EventStreamRenderer]
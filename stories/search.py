@@ -0,0 +1,197 @@
+import math
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, Sum, Value, When
+from django.db.models.functions import Cast
+from django.utils.html import escape
+
+from .models import Paragraph, ParagraphTerm
+
+TOKEN_PATTERN = re.compile(r"\w+")
+MAX_TERM_LENGTH = 64
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her his i in is it its of on or she that the their them
+they this to was were which with you
+""".split())
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+STATS_CACHE_KEY = 'stories:search-stats'
+STATS_TIMEOUT = 600
+
+SNIPPET_CHARS = 160
+
+
+def search_index_enabled():
+    return getattr(settings, 'STORIES_SEARCH_INDEX', True)
+
+
+def tokenize(text):
+    """
+    Lowercased words of text with stopwords dropped, in order.
+    """
+    return [
+        token for token in TOKEN_PATTERN.findall(text.lower())
+        if token not in STOPWORDS and len(token) <= MAX_TERM_LENGTH
+    ]
+
+
+def postings(paragraph_id, text):
+    tokens = tokenize(text)
+    return [
+        ParagraphTerm(term=term, paragraph_id=paragraph_id, frequency=frequency, length=len(tokens))
+        for term, frequency in Counter(tokens).items()
+    ]
+
+
+def index_paragraphs(rows):
+    """
+    Replace the index entries of paragraphs given as (id, text) pairs.
+    """
+    rows = list(rows)
+    with transaction.atomic():
+        ParagraphTerm.objects.filter(paragraph_id__in=[paragraph_id for paragraph_id, _ in rows]).delete()
+        ParagraphTerm.objects.bulk_create(
+            [posting for paragraph_id, text in rows for posting in postings(paragraph_id, text)],
+            batch_size=1000
+        )
+
+
+def index_paragraph(paragraph):
+    index_paragraphs([(paragraph.id, paragraph.text)])
+
+
+def rebuild_search_index(batch_size=1000):
+    """
+    Index every paragraph from scratch. Returns the number of paragraphs indexed.
+    """
+    ParagraphTerm.objects.all().delete()
+    batch, total = [], 0
+    for row in Paragraph.objects.order_by('id').values_list('id', 'text').iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) == batch_size:
+            index_paragraphs(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        index_paragraphs(batch)
+        total += len(batch)
+    cache.delete(STATS_CACHE_KEY)
+    return total
+
+
+def corpus_stats():
+    """
+    Paragraph count and average indexed length, for BM25. Both take a scan, so
+    they are cached for a while; ranking barely moves as the corpus grows.
+    """
+    stats = cache.get(STATS_CACHE_KEY)
+    if stats is None:
+        paragraphs = Paragraph.objects.count()
+        terms = ParagraphTerm.objects.aggregate(total=Sum('frequency'))['total'] or 0
+        stats = (paragraphs, terms / paragraphs if paragraphs else 1.0)
+        cache.set(STATS_CACHE_KEY, stats, STATS_TIMEOUT)
+    return stats
+
+
+def matching_paragraph_ids(terms):
+    """
+    Subquery of the ids of paragraphs containing every one of terms.
+    """
+    return ParagraphTerm.objects.filter(term__in=terms).values('paragraph_id').annotate(
+        matched=Count('id')
+    ).filter(matched=len(terms)).values('paragraph_id')
+
+
+def snippet(text, terms, width=SNIPPET_CHARS):
+    """
+    Escaped excerpt of text around the first query term, with every query
+    term in it wrapped in <mark>.
+    """
+    words = list(TOKEN_PATTERN.finditer(text))
+    first = next((word for word in words if word.group().lower() in terms), None)
+    start = 0
+    if first is not None and first.start() > width // 3:
+        start = text.rfind(' ', 0, first.start() - width // 3) + 1
+    end = start + width
+    if end >= len(text):
+        end = len(text)
+    elif text.rfind(' ', start, end) > start:
+        end = text.rfind(' ', start, end)
+
+    parts, position = [], start
+    for word in words:
+        if word.start() < start or word.end() > end:
+            continue
+        if word.group().lower() in terms:
+            parts.append(escape(text[position:word.start()]))
+            parts.append(f"<mark>{escape(word.group())}</mark>")
+            position = word.end()
+    parts.append(escape(text[position:end]))
+    return ('...' if start > 0 else '') + ''.join(parts) + ('...' if end < len(text) else '')
+
+
+def search_paragraphs(query, page=1, page_size=20):
+    """
+    Paragraphs containing every term of query, best BM25 match first. Returns
+    one page of results, each with the paragraph's position, its score and a
+    highlighted snippet, and whether there is a next page.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return [], False
+
+    document_frequency = dict(
+        ParagraphTerm.objects.filter(term__in=terms).values_list('term').annotate(Count('id')).order_by()
+    )
+    if len(document_frequency) < len(terms):
+        return [], False
+
+    paragraphs, average_length = corpus_stats()
+    paragraphs = max(paragraphs, max(document_frequency.values()))
+    idf = Case(
+        *[
+            When(term=term, then=Value(math.log(1 + (paragraphs - count + 0.5) / (count + 0.5))))
+            for term, count in document_frequency.items()
+        ],
+        output_field=FloatField()
+    )
+    frequency = Cast('frequency', FloatField())
+    term_weight = frequency * (K1 + 1) / (
+        frequency + K1 * (1 - B) + K1 * B * Cast(F('length'), FloatField()) / average_length
+    )
+
+    offset = (page - 1) * page_size
+    ranked = list(
+        ParagraphTerm.objects.filter(term__in=terms).values('paragraph_id').annotate(
+            matched=Count('id'), score=Sum(idf * term_weight)
+        ).filter(matched=len(terms)).order_by('-score', 'paragraph_id')[offset:offset + page_size + 1]
+    )
+    has_next = len(ranked) > page_size
+    ranked = ranked[:page_size]
+
+    rows = Paragraph.objects.filter(id__in=[row['paragraph_id'] for row in ranked]).values(
+        'id', 'chapter_id', 'chapter__story_id', 'page', 'paragraph_number', 'text'
+    )
+    by_id = {row['id']: row for row in rows}
+    term_set = set(terms)
+    results = []
+    for row in ranked:
+        paragraph = by_id.get(row['paragraph_id'])
+        if paragraph is None:
+            continue
+        results.append({
+            'id': paragraph['id'],
+            'story': paragraph['chapter__story_id'],
+            'chapter': paragraph['chapter_id'],
+            'page': paragraph['page'],
+            'paragraph_number': paragraph['paragraph_number'],
+            'score': round(row['score'], 4),
+            'snippet': snippet(paragraph['text'], term_set),
+        })
+    return results, has_next
@@ -0,0 +1,57 @@
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+
+from .models import Paragraph, ParagraphSequence, ParagraphView, ViewSequence
+
+
+def allocate_paragraph_number(chapter_id, page):
+    """
+    Reserve the next paragraph number on a chapter page.
+
+    Must be called inside transaction.atomic(), with the paragraph inserted in
+    the same transaction: the sequence row stays locked until commit, so only
+    writers to the same page wait on each other. Paragraphs added without the
+    allocator (admin, fixtures) are accounted for by also checking the highest
+    number already in use.
+    """
+    sequence, _ = ParagraphSequence.objects.select_for_update().get_or_create(
+        chapter_id=chapter_id,
+        page=page
+    )
+    highest = Paragraph.objects.filter(
+        chapter_id=chapter_id,
+        page=page
+    ).aggregate(Max('paragraph_number'))['paragraph_number__max'] or 0
+
+    sequence.last_number = max(sequence.last_number, highest) + 1
+    sequence.save(update_fields=['last_number'])
+    return sequence.last_number
+
+
+def allocate_view_order(user_id, count=1):
+    """
+    Reserve the next ``count`` ParagraphView.view_order values for a user with
+    one row update, returning the first of them.
+
+    Like allocate_paragraph_number this must run in the transaction that
+    inserts the views. The user's history is only scanned the first time, to
+    seed the counter for users who have no sequence row yet.
+    """
+    while True:
+        updated = ViewSequence.objects.filter(user_id=user_id).update(
+            last_view_order=F('last_view_order') + count
+        )
+        if updated:
+            last = ViewSequence.objects.filter(user_id=user_id).values_list('last_view_order', flat=True).get()
+            return last - count + 1
+
+        highest = ParagraphView.objects.filter(
+            user_id=user_id
+        ).aggregate(Max('view_order'))['view_order__max'] or 0
+        try:
+            with transaction.atomic():
+                ViewSequence.objects.create(user_id=user_id, last_view_order=highest + count)
+            return highest + 1
+        except IntegrityError:
+            # Another request created the row first; increment it instead
+            continue
@@ -1,17 +1,113 @@
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
 from rest_framework import serializers
 from .models import Story, Chapter, Paragraph, ReadingProgress, Payment, NFT
+from .tracking import uses_bitmap_storage, viewed_paragraph_set
 
-class StorySerializer(serializers.ModelSerializer):
+
+def requested_fields(request, allowed):
+    """
+    Field names asked for with ?fields=a,b, in the order of allowed, or None
+    for all of them. Unknown names are a validation error.
+    """
+    value = request.query_params.get('fields') if request is not None else None
+    if not value:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = sorted(names.difference(allowed))
+    if unknown:
+        raise serializers.ValidationError({'fields': [f"Unknown fields: {', '.join(unknown)}"]})
+    return [name for name in allowed if name in names]
+
+
+def sparse(rows, fields):
+    """
+    Rows already represented as dicts, cut down to fields.
+    """
+    if fields is None:
+        return rows
+    return [{name: row[name] for name in fields} for row in rows]
+
+
+class SparseFieldsMixin:
+    """
+    Limit a serializer's output to the fields named by the request's ?fields=
+    parameter, when it has a request in its context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = requested_fields(self.context.get('request'), self.fields)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class ValuesSerializer:
+    """
+    Read-only stand-in for a fields='__all__' ModelSerializer on hot list
+    paths. It represents values() rows rather than model instances, so no
+    instances are built and no per-field serializer runs, and it gives the
+    same JSON: fields in the same order, foreign keys as ids under the field
+    name, datetimes in the current timezone and decimals as strings.
+    """
+
+    def __init__(self, model, fields=None):
+        selected = [field for field in self.model_fields(model) if fields is None or field.name in fields]
+        self.columns = [(field.name, field.attname) for field in selected]
+        self.decimals = [field.name for field in selected if isinstance(field, models.DecimalField)]
+        self.datetimes = [field.name for field in selected if isinstance(field, models.DateTimeField)]
+
+    @staticmethod
+    def model_fields(model):
+        # Primary key, other columns, then foreign keys, like a ModelSerializer
+        fields = model._meta.concrete_fields
+        return (
+            [field for field in fields if field.primary_key] +
+            [field for field in fields if not field.primary_key and not field.is_relation] +
+            [field for field in fields if not field.primary_key and field.is_relation]
+        )
+
+    @classmethod
+    def field_names(cls, model):
+        return [field.name for field in cls.model_fields(model)]
+
+    def values(self, queryset, *keys):
+        """
+        queryset as values() rows of the serializer's columns, plus the
+        ordering keys, which pagination reads from each row.
+        """
+        return queryset.values(*dict.fromkeys(
+            [attname for _, attname in self.columns] + [key.lstrip('-') for key in keys]
+        ))
+
+    def to_representation(self, rows):
+        columns = self.columns
+        data = [{name: row[attname] for name, attname in columns} for row in rows]
+        converters = [(name, str) for name in self.decimals]
+        if settings.USE_TZ and self.datetimes:
+            # Looked up once, rather than per value as timezone.localtime() does
+            current = timezone.get_current_timezone()
+            converters += [(name, lambda value: value.astimezone(current)) for name in self.datetimes]
+        for row in data if converters else ():
+            for name, convert in converters:
+                if row[name] is not None:
+                    row[name] = convert(row[name])
+        return data
+
+
+class StorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Story
         fields = '__all__'
 
-class ChapterSerializer(serializers.ModelSerializer):
+class ChapterSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Chapter
         fields = '__all__'
 
-class ParagraphSerializer(serializers.ModelSerializer):
+class ParagraphSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Paragraph
         fields = '__all__'
@@ -19,14 +115,20 @@ class ParagraphSerializer(serializers.ModelSerializer):
 class ReadingProgressSerializer(serializers.ModelSerializer):
     class Meta:
         model = ReadingProgress
-        fields = '__all__'
+        exclude = ('viewed_bitmap',)
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if uses_bitmap_storage():
+            data['viewed_paragraphs'] = list(viewed_paragraph_set(instance))
+        return data
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = '__all__'
 
-class NFTSerializer(serializers.ModelSerializer):
+class NFTSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = NFT
         fields = '__all__' 
\ No newline at end of file
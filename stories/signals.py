@@ -1,12 +1,106 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.db import transaction
 from django.dispatch import receiver
-from .models import Paragraph
-from .tasks import analyze_and_add_links
+from .models import Paragraph, ParagraphQuerySet
+from .jobs import enqueue
+from .cache import invalidate_chapter_pages
+from .page_index import rebuild_page_index, record_paragraph_added, record_paragraph_removed
+from .search import index_paragraph, search_index_enabled
+from .speculation import discard_stale_drafts, speculation_enabled
 
 @receiver(post_save, sender=Paragraph)
 def process_paragraph_links(sender, instance, created, **kwargs):
     """
-    When a new paragraph is created, analyze it for potential links.
+    When a new paragraph is created, queue it for link analysis by the job worker.
     """
     if created and not instance.text_with_links:  # Only process if it's new and doesn't have links yet
-        analyze_and_add_links(instance.id)
+        enqueue(
+            'analyze_and_add_links',
+            {'paragraph_id': instance.id},
+            dedupe_key=f"analyze_and_add_links:{instance.id}"
+        )
+
+
+@receiver(post_save, sender=Paragraph)
+def queue_chapter_summary(sender, instance, created, **kwargs):
+    """
+    Keep the chapter's rolling summary up to date as paragraphs are added.
+    """
+    if created:
+        enqueue(
+            'update_chapter_summary',
+            {'chapter_id': instance.chapter_id},
+            dedupe_key=f"update_chapter_summary:{instance.chapter_id}"
+        )
+
+
+@receiver(post_save, sender=Paragraph)
+def discard_drafts(sender, instance, created, **kwargs):
+    """
+    A new paragraph makes any pre-generated draft of what came before it stale.
+    """
+    if created and speculation_enabled():
+        discard_stale_drafts(instance)
+
+
+@receiver(post_save, sender=Paragraph)
+def update_search_index(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Reindex a paragraph for search whenever its text may have changed.
+    Deleted paragraphs drop out of the index with their rows.
+    """
+    if search_index_enabled() and (created or update_fields is None or 'text' in update_fields):
+        index_paragraph(instance)
+
+
+@receiver(pre_save, sender=Paragraph)
+def remember_paragraph_position(sender, instance, update_fields=None, **kwargs):
+    """
+    Note where an existing paragraph was before a save that may move it.
+    """
+    instance.__dict__.pop('_saved_position', None)
+    if instance._state.adding or (update_fields is not None and not ParagraphQuerySet.POSITION_FIELDS & update_fields):
+        return
+    instance._saved_position = Paragraph.objects.filter(pk=instance.pk).values_list(
+        'chapter_id', 'page', 'paragraph_number'
+    ).first()
+
+
+@receiver(post_save, sender=Paragraph)
+def count_added_paragraph(sender, instance, created, **kwargs):
+    """
+    Add a new paragraph to its chapter's page index, or reindex the chapters
+    a paragraph was moved between.
+    """
+    if created:
+        record_paragraph_added(instance)
+        return
+    previous = getattr(instance, '_saved_position', None)
+    if previous is not None and previous != (instance.chapter_id, instance.page, instance.paragraph_number):
+        rebuild_page_index({previous[0], instance.chapter_id})
+
+
+@receiver(post_delete, sender=Paragraph)
+def count_removed_paragraph(sender, instance, origin=None, **kwargs):
+    """
+    Take a deleted paragraph out of its chapter's page index, unless the
+    chapter or story is being deleted along with it.
+    """
+    if isinstance(origin, Paragraph) or getattr(origin, 'model', None) is Paragraph:
+        record_paragraph_removed(instance)
+
+
+@receiver(post_save, sender=Paragraph)
+@receiver(post_delete, sender=Paragraph)
+def invalidate_paragraph_page(sender, instance, **kwargs):
+    """
+    Drop the cached chapter page a paragraph appears on when it changes, and
+    the page it was moved off, if any. This waits for the commit so a
+    concurrent read can't re-cache the old page.
+    """
+    pages = {(instance.chapter_id, instance.page)}
+    # Registered after count_added_paragraph, so the position can go now
+    previous = instance.__dict__.pop('_saved_position', None)
+    if previous is not None:
+        pages.add(previous[:2])
+    Paragraph.objects.invalidate_pages(pages)
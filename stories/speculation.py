@@ -0,0 +1,134 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+
+from . import tasks
+from .jobs import enqueue, register
+from .models import Chapter, DraftParagraph
+from .page_index import last_paragraph_on_page
+
+logger = logging.getLogger(__name__)
+
+# How long asking for a draft after a paragraph suppresses asking again, so
+# readers polling the last page don't each write to the job queue
+SPECULATE_THROTTLE_SECONDS = 300
+
+
+def speculation_enabled():
+    return getattr(settings, 'STORIES_SPECULATIVE_GENERATION', False)
+
+
+def last_paragraph_id(chapter_id):
+    return last_paragraph_on_page(Chapter.objects.only('page_count', 'page_index').get(id=chapter_id))
+
+
+def speculate(chapter_id, previous_paragraph_id):
+    """
+    Queue generation of a draft to follow previous_paragraph_id. Cheap enough
+    to call on every read of a chapter's last page.
+    """
+    if cache.add(f"stories:speculate:{chapter_id}:{previous_paragraph_id}", 1, SPECULATE_THROTTLE_SECONDS):
+        enqueue(
+            'pregenerate_paragraph',
+            {'chapter_id': chapter_id, 'previous_paragraph_id': previous_paragraph_id},
+            dedupe_key=f"pregenerate_paragraph:{chapter_id}:{previous_paragraph_id}"
+        )
+
+
+@register('pregenerate_paragraph')
+def pregenerate_paragraph(chapter_id, previous_paragraph_id):
+    """
+    Generate the draft that follows previous_paragraph_id, unless the chapter
+    has already moved past it or a draft exists. A failed draft is retried.
+    """
+    if previous_paragraph_id is None or last_paragraph_id(chapter_id) != previous_paragraph_id:
+        return None
+    chapter, current_page, messages = tasks.build_next_paragraph_request(chapter_id, previous_paragraph_id)
+    draft, created = DraftParagraph.objects.get_or_create(
+        chapter=chapter, previous_paragraph_id=previous_paragraph_id, defaults={'page': current_page}
+    )
+    if not created:
+        if draft.status != DraftParagraph.STATUS_FAILED:
+            return draft
+        DraftParagraph.objects.filter(id=draft.id).update(status=DraftParagraph.STATUS_PENDING)
+
+    start = time.perf_counter()
+    try:
+        response = tasks.client.chat.completions.create(
+            model="gpt-4",
+            messages=messages,
+            temperature=0.7
+        )
+    except Exception:
+        DraftParagraph.objects.filter(id=draft.id, status=DraftParagraph.STATUS_PENDING).update(
+            status=DraftParagraph.STATUS_FAILED
+        )
+        raise
+    generation_ms = int((time.perf_counter() - start) * 1000)
+
+    # If the chapter moved on while the model was writing, the draft has been
+    # discarded already and stays that way
+    ready = DraftParagraph.objects.filter(id=draft.id, status=DraftParagraph.STATUS_PENDING).update(
+        status=DraftParagraph.STATUS_READY,
+        text=response.choices[0].message.content,
+        generation_ms=generation_ms
+    )
+    if not ready:
+        logger.info(f"Draft after paragraph {previous_paragraph_id} went stale while generating")
+    return draft
+
+
+def publish_draft(chapter_id, previous_paragraph_id):
+    """
+    Save the ready draft that follows previous_paragraph_id as the chapter's
+    next paragraph. Returns the new Paragraph, or None if there is no ready
+    draft to publish.
+    """
+    if not speculation_enabled() or previous_paragraph_id is None:
+        return None
+    with transaction.atomic():
+        draft = DraftParagraph.objects.select_related('chapter').filter(
+            chapter_id=chapter_id, previous_paragraph_id=previous_paragraph_id, status=DraftParagraph.STATUS_READY
+        ).first()
+        # Only one request gets to publish a draft
+        if draft is None or not DraftParagraph.objects.filter(
+            id=draft.id, status=DraftParagraph.STATUS_READY
+        ).update(status=DraftParagraph.STATUS_PUBLISHED):
+            return None
+        paragraph = tasks.save_next_paragraph(draft.chapter, draft.page, draft.text)
+    logger.info(f"Published draft after paragraph {previous_paragraph_id}, saving {draft.generation_ms} ms")
+    return paragraph
+
+
+def discard_stale_drafts(paragraph):
+    """
+    Discard drafts in paragraph's chapter that were written to follow some
+    other paragraph, now that paragraph has been added.
+    """
+    return DraftParagraph.objects.filter(
+        chapter_id=paragraph.chapter_id,
+        status__in=[DraftParagraph.STATUS_PENDING, DraftParagraph.STATUS_READY]
+    ).exclude(previous_paragraph_id=paragraph.id).update(status=DraftParagraph.STATUS_DISCARDED)
+
+
+def draft_stats():
+    """
+    How speculation is paying off: drafts published, discarded and failed,
+    the share of finished drafts that were published, and the generation
+    time readers were spared.
+    """
+    stats = DraftParagraph.objects.aggregate(
+        published=Count('id', filter=Q(status=DraftParagraph.STATUS_PUBLISHED)),
+        discarded=Count('id', filter=Q(status=DraftParagraph.STATUS_DISCARDED)),
+        failed=Count('id', filter=Q(status=DraftParagraph.STATUS_FAILED)),
+        waiting=Count('id', filter=Q(status__in=[DraftParagraph.STATUS_PENDING, DraftParagraph.STATUS_READY])),
+        saved_ms=Coalesce(Sum('generation_ms', filter=Q(status=DraftParagraph.STATUS_PUBLISHED)), 0),
+    )
+    finished = stats['published'] + stats['discarded']
+    stats['hit_rate'] = stats['published'] / finished if finished else 0.0
+    return stats
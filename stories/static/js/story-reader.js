@@ -24,11 +24,22 @@ class StoryReader {
         document.getElementById('backButton').addEventListener('click', () => this.showStoryList());
     }
 
+    async fetchAllPages(url) {
+        // List endpoints are cursor paginated; follow the next links to the end
+        const results = [];
+        while (url) {
+            const response = await fetch(url);
+            const page = await response.json();
+            results.push(...page.results);
+            url = page.next;
+        }
+        return results;
+    }
+
     async fetchStories() {
         try {
             console.log('Fetching stories...');
-            const response = await fetch('/stories/api/stories/');
-            const stories = await response.json();
+            const stories = await this.fetchAllPages('/stories/api/stories/');
             console.log('Stories received:', stories);
             this.renderStories(stories);
         } catch (error) {
@@ -65,8 +76,7 @@ class StoryReader {
 
     async fetchChapters(storyId) {
         try {
-            const response = await fetch(`/stories/api/stories/${storyId}/chapters/`);
-            const chapters = await response.json();
+            const chapters = await this.fetchAllPages(`/stories/api/stories/${storyId}/chapters/`);
             this.renderChapters(chapters);
         } catch (error) {
             console.error('Error fetching chapters:', error);
@@ -245,7 +255,7 @@ class StoryReader {
     async fetchReadingProgress() {
         try {
             const response = await fetch(`/stories/api/reading-progress/?story=${this.currentStory.id}`);
-            const progress = await response.json();
+            const progress = (await response.json()).results;
             if (progress.length > 0) {
                 this.updateProgressBar(progress[0]);
             }
@@ -1,5 +1,12 @@
 from openai import OpenAI
-from .models import Paragraph, Chapter
+from django.db import transaction
+from .models import Paragraph, Chapter, ChapterSummary
+from .jobs import register
+from .crossmint import get_client
+from .completion_cache import completion_cache
+from .term_index import annotate_locally, extract_links, index_links, validate_link_html
+from .sequences import allocate_paragraph_number
+from .context import build_chapter_context, estimate_tokens, unsummarized_paragraphs, SUMMARY_BATCH_TOKENS
 import requests
 import os
 import json
@@ -7,65 +14,133 @@ import json
 # Initialize OpenAI client - it will automatically use OPENAI_API_KEY from environment
 client = OpenAI()
 
+def build_next_paragraph_request(chapter_id, previous_paragraph_id=None):
+    """
+    Build the chat messages for the paragraph that follows previous_paragraph_id.
+    Returns the chapter, the page the new paragraph belongs on and the messages.
+    """
+    chapter = Chapter.objects.get(id=chapter_id)
+
+    # Get context and current page from previous paragraph if it exists
+    context = ""
+    current_page = 1
+    if previous_paragraph_id:
+        previous_paragraph = Paragraph.objects.get(id=previous_paragraph_id)
+        context = previous_paragraph.text
+        current_page = previous_paragraph.page
+
+    # Create the prompt
+    system_prompt = "You are a creative writer continuing a story. Write the next paragraph naturally continuing from the previous text."
+    user_message = f"Previous paragraph: {context}\n\nWrite the next paragraph:"
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    return chapter, current_page, messages
+
+def save_next_paragraph(chapter, current_page, text):
+    """
+    Save generated text as the next paragraph on current_page.
+    """
+    # Number the paragraph at insert time, after the slow LLM call, so the
+    # page's sequence row is only locked for the duration of the insert
+    with transaction.atomic():
+        return Paragraph.objects.create(
+            chapter=chapter,
+            text=text,
+            paragraph_number=allocate_paragraph_number(chapter.id, current_page),
+            page=current_page,
+            is_locked=False
+        )
+
+def stream_completion(messages, temperature):
+    """
+    Yield the content of a streamed chat completion as it arrives.
+    """
+    stream = client.chat.completions.create(
+        model="gpt-4",
+        messages=messages,
+        temperature=temperature,
+        stream=True
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def cached_completion(messages, temperature, model="gpt-4"):
+    """
+    Text of a chat completion, served from the completion cache when the same
+    model, messages and temperature have been answered before. Only meant for
+    low temperature calls, where repeating an earlier answer is acceptable.
+    """
+    key = completion_cache.key(model, messages, temperature)
+    text = completion_cache.get(key)
+    if text is None:
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature
+        )
+        text = response.choices[0].message.content
+        completion_cache.set(key, text, model)
+    return text
+
 def generate_next_paragraph(chapter_id, previous_paragraph_id=None):
     """
     Generate the next paragraph using OpenAI's chat API based on the previous paragraph.
     """
     try:
-        chapter = Chapter.objects.get(id=chapter_id)
-        
-        # Get context and current page from previous paragraph if it exists
-        context = ""
-        current_page = 1
-        if previous_paragraph_id:
-            previous_paragraph = Paragraph.objects.get(id=previous_paragraph_id)
-            context = previous_paragraph.text
-            current_page = previous_paragraph.page
-
-        # Get the next paragraph number for the current page
-        next_paragraph_number = Paragraph.objects.filter(
-            chapter=chapter,
-            page=current_page
-        ).count() + 1
-
-        # Create the prompt
-        system_prompt = "You are a creative writer continuing a story. Write the next paragraph naturally continuing from the previous text."
-        user_message = f"Previous paragraph: {context}\n\nWrite the next paragraph:"
+        chapter, current_page, messages = build_next_paragraph_request(chapter_id, previous_paragraph_id)
 
         # Generate the response
         response = client.chat.completions.create(
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
+            messages=messages,
             temperature=0.7
         )
 
         print(f"Generated paragraph: {response.choices[0].message.content}")
 
-        # Create and save the new paragraph with correct numbering
-        new_paragraph = Paragraph.objects.create(
-            chapter=chapter,
-            text=response.choices[0].message.content,
-            paragraph_number=next_paragraph_number,
-            page=current_page,
-            is_locked=False
-        )
-
-        return new_paragraph
+        return save_next_paragraph(chapter, current_page, response.choices[0].message.content)
 
     except Exception as e:
         print(f"Error generating paragraph: {e}")
         raise
 
+def stream_next_paragraph(chapter_id, previous_paragraph_id=None):
+    """
+    Streaming variant of generate_next_paragraph. Yields text tokens as they are
+    generated and returns the saved Paragraph once the stream has finished.
+    The paragraph is only saved if the stream is consumed to the end.
+    """
+    chapter, current_page, messages = build_next_paragraph_request(chapter_id, previous_paragraph_id)
+
+    tokens = []
+    for token in stream_completion(messages, temperature=0.7):
+        tokens.append(token)
+        yield token
+
+    return save_next_paragraph(chapter, current_page, "".join(tokens))
+
+@register('analyze_and_add_links')
 def analyze_and_add_links(paragraph_id):
     """
     Analyze an existing paragraph for potential wiki-style links and update its HTML version.
     """
     try:
-        paragraph = Paragraph.objects.get(id=paragraph_id)
-        
+        paragraph = Paragraph.objects.select_related('chapter').get(id=paragraph_id)
+        story_id = paragraph.chapter.story_id
+
+        # Phrases already linked elsewhere in the story are linked the same
+        # way without asking the LLM
+        local_links = annotate_locally(story_id, paragraph.text)
+        if local_links is not None:
+            paragraph.text_with_links = local_links
+            paragraph.save(update_fields=['text_with_links', 'updated_at'])
+            print(f"Links added to paragraph {paragraph.id} from the term index")
+            return local_links
+
         # Identify potential link phrases
         system_prompt = """You are an AI that identifies important words or phrases that could be wiki-style links.
         Select 2-4 significant nouns or phrases that could lead to interesting related content.
@@ -73,20 +148,25 @@ def analyze_and_add_links(paragraph_id):
         
         user_message = f"Identify potential link phrases in this text:\n\n{paragraph.text}"
 
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
+        links_data = cached_completion(
+            [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_message}
             ],
             temperature=0.3,
         )
 
-        links_data = response.choices[0].message.content
+        # The reply is shown as HTML and its links are reused elsewhere in
+        # the story, so keep it only if it is the paragraph with safe links
+        errors = validate_link_html(paragraph.text, links_data)
+        if errors:
+            print(f"Rejected links for paragraph {paragraph.id}: {'; '.join(errors)}")
+            return None
 
         # Update the paragraph
         paragraph.text_with_links = links_data
-        paragraph.save()
+        paragraph.save(update_fields=['text_with_links', 'updated_at'])
+        index_links({story_id: extract_links(links_data)})
 
         print(f"Links added to paragraph {paragraph.id}: {links_data}")
 
@@ -96,148 +176,142 @@ def analyze_and_add_links(paragraph_id):
         print(f"Error analyzing paragraph for links: {e}")
         raise
 
+def build_next_page_request(chapter_id, current_page):
+    """
+    Build the chat messages for the first paragraph of the page after current_page.
+    """
+    chapter = Chapter.objects.get(id=chapter_id)
+
+    # Recent paragraphs up to the current page, plus the rolling summary for
+    # anything older that doesn't fit in the prompt budget
+    context = build_chapter_context(chapter, current_page)
+
+    # Create the prompt
+    system_prompt = """You are a creative writer continuing a story. Based on the previous content of this chapter, 
+    write the first paragraph of the next page. Ensure it flows naturally from the previous content while advancing 
+    the story."""
+
+    user_message = f"Previous content of the chapter:\n\n{context}\n\nWrite the first paragraph of the next page:"
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    return chapter, messages
+
+def save_next_page(chapter, current_page, text):
+    """
+    Save generated text as the first paragraph of the page after current_page.
+    """
+    # The first caller gets paragraph 1; a concurrent caller that races it to
+    # the same page is numbered after it instead of failing
+    with transaction.atomic():
+        return Paragraph.objects.create(
+            chapter=chapter,
+            text=text,
+            paragraph_number=allocate_paragraph_number(chapter.id, current_page + 1),
+            page=current_page + 1,
+            is_locked=False
+        )
+
 def generate_next_page(chapter_id, current_page):
     """
     Generate the first paragraph of a new page using OpenAI's chat API based on the chapter's context.
     """
     try:
-        chapter = Chapter.objects.get(id=chapter_id)
-        
-        # Get all paragraphs from the current chapter up to the current page
-        previous_paragraphs = Paragraph.objects.filter(
-            chapter=chapter,
-            page__lte=current_page
-        ).order_by('page', 'paragraph_number')
-        
-        # Combine the text of previous paragraphs
-        context = "\n".join([p.text for p in previous_paragraphs])
-
-        # Create the prompt
-        system_prompt = """You are a creative writer continuing a story. Based on the previous content of this chapter, 
-        write the first paragraph of the next page. Ensure it flows naturally from the previous content while advancing 
-        the story."""
-        
-        user_message = f"Previous content of the chapter:\n\n{context}\n\nWrite the first paragraph of the next page:"
+        chapter, messages = build_next_page_request(chapter_id, current_page)
 
         # Generate the response
         response = client.chat.completions.create(
             model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
+            messages=messages,
             temperature=0.7
         )
 
-        # Create and save the new paragraph
-        new_paragraph = Paragraph.objects.create(
-            chapter=chapter,
-            text=response.choices[0].message.content,
-            paragraph_number=1,  # First paragraph of the new page
-            page=current_page + 1,
-            is_locked=False
-        )
-
-        return new_paragraph
+        return save_next_page(chapter, current_page, response.choices[0].message.content)
 
     except Exception as e:
         print(f"Error generating next page: {e}")
         raise
 
+def stream_next_page(chapter_id, current_page):
+    """
+    Streaming variant of generate_next_page. Yields text tokens as they are
+    generated and returns the saved Paragraph once the stream has finished.
+    """
+    chapter, messages = build_next_page_request(chapter_id, current_page)
+
+    tokens = []
+    for token in stream_completion(messages, temperature=0.7):
+        tokens.append(token)
+        yield token
+
+    return save_next_page(chapter, current_page, "".join(tokens))
+
+@register('update_chapter_summary')
+def update_chapter_summary(chapter_id):
+    """
+    Fold paragraphs added since the last run into the chapter's rolling summary.
+    Paragraphs are folded in batches of roughly SUMMARY_BATCH_TOKENS; a trailing
+    batch smaller than that is left for a later run.
+    """
+    try:
+        summary, _ = ChapterSummary.objects.get_or_create(chapter_id=chapter_id)
+
+        system_prompt = """You maintain a concise running summary of a story chapter. Merge the new passages into 
+        the existing summary, keeping characters, places and open plot threads. Only return the updated summary."""
+
+        batch = []
+        batch_tokens = 0
+        rows = unsummarized_paragraphs(summary).values_list('page', 'paragraph_number', 'text').iterator(chunk_size=50)
+        for page, paragraph_number, text in rows:
+            batch.append(text)
+            batch_tokens += estimate_tokens(text)
+            if batch_tokens < SUMMARY_BATCH_TOKENS:
+                continue
+
+            passages = "\n".join(batch)
+            user_message = f"Current summary:\n{summary.text}\n\nNew passages:\n{passages}\n\nUpdated summary:"
+            summary.text = cached_completion(
+                [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ],
+                temperature=0.3
+            )
+            summary.page = page
+            summary.paragraph_number = paragraph_number
+            summary.save()
+            batch = []
+            batch_tokens = 0
+
+        return summary
+
+    except Exception as e:
+        print(f"Error updating chapter summary: {e}")
+        raise
+
 # Get environment variables
 signer_public_key = os.environ.get('SIGNER_PUBLIC_KEY')
 crossmint_api_key = os.environ.get('CROSSMINT_API_KEY')
 
 def create_wallet(signer_public_key=signer_public_key, api_key=crossmint_api_key):
-    response = requests.post(
-        "https://staging.crossmint.com/api/v1-alpha2/wallets",
-        headers={
-            'X-API-KEY': api_key,
-            'Content-Type': 'application/json'
-        },
-        json={
-            "type": "evm-smart-wallet",
-            "config": {
-                "signer": {
-                    "type": "evm-keypair",
-                    "address": signer_public_key
-                }
-            }
-        }
-    )
-    return response.json()
+    return get_client(api_key).create_wallet(signer_public_key)
 
 def create_nft(api_key=crossmint_api_key, collection_id=None, chain="solana", env="staging"):
-    if not collection_id:
-        collection_response = create_collection(api_key=api_key, chain=chain, env=env)
-        print(f"Collection created: {collection_response}")
-        collection_id = collection_response['id']
-    
-    # Using a valid Solana address format
-    recipient_address = "solana:5FHwkrdxkN8yPBkLZM1X3jKHgvzxM3T6oF8VyuxWSjAM"
-    url = f"https://{env}.crossmint.com/api/2022-06-09/collections/{collection_id}/nfts"
-    
-    headers = {
-        'X-API-KEY': api_key,
-        'Content-Type': 'application/json'
-    }
-    
-    body = {
-        "metadata": {
-            "name": "Crossmint Example NFT",
-            "image": "https://www.crossmint.com/assets/crossmint/logo.png",
-            "description": "My NFT created via the mint API!"
-        },
-        "recipient": recipient_address,
-        "sendNotification": True,
-        "locale": "en-US",
-        "reuploadLinkedFiles": True,
-        "compressed": True  # Including this since we're using Solana
-    }
-    
+    """
+    Mint an NFT into collection_id, or into the cached collection for the
+    chain and environment, creating it only the first time.
+    """
     try:
-        print(f"Sending request to: {url}")
-        print(f"Request body: {body}")
-        response = requests.post(url, headers=headers, json=body)
-        print(f"Response status: {response.status_code}")
-        print(f"Response body: {response.text}")
-        response.raise_for_status()
-        return response.json()
+        return get_client(api_key, env).mint_nft(chain=chain, collection_id=collection_id)
     except requests.exceptions.RequestException as e:
         print(f"Error minting NFT: {str(e)}")
-        if hasattr(e.response, 'text'):
-            print(f"Error details: {e.response.text}")
         raise
 
 def create_collection(api_key=crossmint_api_key, chain="solana", env="staging"):
-    url = f"https://{env}.crossmint.com/api/2022-06-09/collections/"
-
-    payload = {
-        "chain": chain,
-        "metadata": {
-            "name": "Sample NFT Collection",
-            "imageUrl": "https://www.crossmint.com/assets/crossmint/logo.png",
-            "description": "This is a sample NFT collection"
-        },
-        "fungibility": "non-fungible",
-        "transferable": True,
-        "supplyLimit": 123,
-        "reuploadLinkedFiles": True
-    }
-
-    headers = {
-        "X-API-KEY": api_key,
-        "Content-Type": "application/json"
-    }
-
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        print(f"Response status: {response.status_code}")
-        print(f"Response body: {response.text}")
-        response.raise_for_status()
-        return response.json()
+        return get_client(api_key, env).create_collection(chain=chain)
     except requests.exceptions.RequestException as e:
         print(f"Error creating collection: {str(e)}")
-        if hasattr(e.response, 'text'):
-            print(f"Error details: {e.response.text}")
         raise
@@ -0,0 +1,295 @@
+import re
+import threading
+import uuid
+from collections import OrderedDict, defaultdict, deque
+from html.parser import HTMLParser
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import escape, strip_tags
+
+from .models import Paragraph, StoryTerm
+
+# Terms shorter than this are too ambiguous to link without the LLM
+MIN_TERM_LENGTH = 3
+# Most links added to one paragraph, matching what the LLM is asked for
+MAX_LOCAL_LINKS = 4
+# Stories whose compiled automaton each process keeps
+MAX_CACHED_AUTOMATA = 256
+
+
+class LinkExtractor(HTMLParser):
+    """
+    Collects (phrase, href) for every <a href> in a fragment of HTML.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self.href = None
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.href = dict(attrs).get('href')
+            self.text = []
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self.href:
+            phrase = " ".join("".join(self.text).split())
+            if phrase:
+                self.links.append((phrase, self.href))
+            self.href = None
+
+    def handle_data(self, data):
+        if self.href is not None:
+            self.text.append(data)
+
+
+SAFE_HREF = re.compile(r'^(/|#|https?://)')
+
+
+class LinkHTMLValidator(HTMLParser):
+    """
+    Collects the text of an annotated paragraph and any problems with its
+    markup: tags other than <a>, unexpected attributes or hrefs, and
+    unbalanced tags.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.open_tags = []
+        self.errors = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != 'a':
+            self.errors.append(f"<{tag}> is not allowed")
+        for name, value in attrs:
+            if name not in ('href', 'title'):
+                self.errors.append(f"attribute {name} is not allowed")
+            elif name == 'href' and not SAFE_HREF.match(value or ''):
+                self.errors.append(f"href {value!r} is not allowed")
+        self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.errors.append(f"<{tag}/> is not allowed")
+
+    def handle_endtag(self, tag):
+        if not self.open_tags or self.open_tags.pop() != tag:
+            self.errors.append(f"unexpected </{tag}>")
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def validate_link_html(text, html):
+    """
+    Problems with html as a link-annotated version of text: empty when the
+    markup is only balanced <a> tags and the text is otherwise unchanged.
+    """
+    validator = LinkHTMLValidator()
+    validator.feed(html)
+    validator.close()
+    errors = list(validator.errors)
+    if validator.open_tags:
+        errors.append(f"unclosed <{validator.open_tags[-1]}>")
+    if normalize_text("".join(validator.text)) != normalize_text(strip_tags(text)):
+        errors.append("paragraph text was changed")
+    return errors
+
+
+def extract_links(html):
+    extractor = LinkExtractor()
+    extractor.feed(html or "")
+    extractor.close()
+    return extractor.links
+
+
+class TermAutomaton:
+    """
+    Aho-Corasick automaton over a story's linked phrases. Finds every
+    occurrence of every phrase in one pass over the text, however many
+    phrases there are. Matching is case sensitive and only whole words
+    match.
+    """
+
+    def __init__(self, terms):
+        self.terms = dict(terms)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for phrase in self.terms:
+            node = 0
+            for char in phrase:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = next_node
+            self.output[node].append(phrase)
+
+        # Breadth-first, so every node's failure target is final before its
+        # children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def find(self, text):
+        """
+        Non-overlapping whole-word matches as (start, end, phrase), preferring
+        the leftmost and then the longest phrase.
+        """
+        matches = []
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(char, 0)
+            for phrase in self.output[node]:
+                start, end = i - len(phrase) + 1, i + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    matches.append((start, end, phrase))
+
+        matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+        chosen, last_end = [], 0
+        for start, end, phrase in matches:
+            if start >= last_end:
+                chosen.append((start, end, phrase))
+                last_end = end
+        return chosen
+
+    def annotate(self, text, max_links=MAX_LOCAL_LINKS):
+        """
+        HTML for text with the first occurrence of up to max_links distinct
+        phrases linked, and the number of links added.
+        """
+        parts, position, linked = [], 0, set()
+        for start, end, phrase in self.find(text):
+            if phrase in linked:
+                continue
+            parts.append(escape(text[position:start]))
+            parts.append(f'<a href="{escape(self.terms[phrase])}">{escape(text[start:end])}</a>')
+            position = end
+            linked.add(phrase)
+            if len(linked) == max_links:
+                break
+        parts.append(escape(text[position:]))
+        return "".join(parts), len(linked)
+
+
+def version_key(story_id):
+    return f"stories:term-index-version:{story_id}"
+
+
+_automata = OrderedDict()
+_automata_lock = threading.Lock()
+
+
+def story_automaton(story_id):
+    """
+    Compiled automaton for a story's terms. Compiled automata are kept per
+    process, for the STORIES_MAX_CACHED_AUTOMATA most recently used stories,
+    and recompiled when index_links() has changed the story's terms since, as
+    signalled by a version token in the shared cache.
+    """
+    version = cache.get(version_key(story_id))
+    if version is None:
+        # Never trust an automaton compiled without a token: the story's terms
+        # may have changed while the cache entry was missing
+        cache.add(version_key(story_id), uuid.uuid4().hex, None)
+        version = cache.get(version_key(story_id))
+    with _automata_lock:
+        cached = _automata.get(story_id)
+        if cached is not None and cached[0] == version:
+            _automata.move_to_end(story_id)
+            return cached[1]
+    terms = StoryTerm.objects.filter(story_id=story_id).values_list('phrase', 'href')
+    # Terms indexed before hrefs were checked may still be unsafe
+    automaton = TermAutomaton((phrase, href) for phrase, href in terms if SAFE_HREF.match(href))
+    with _automata_lock:
+        _automata[story_id] = (version, automaton)
+        _automata.move_to_end(story_id)
+        while len(_automata) > getattr(settings, 'STORIES_MAX_CACHED_AUTOMATA', MAX_CACHED_AUTOMATA):
+            _automata.popitem(last=False)
+    return automaton
+
+
+def index_links(links_by_story):
+    """
+    Add linked phrases to each story's term index, given as
+    {story_id: [(phrase, href), ...]}. A phrase linked again takes its
+    newest href; links with hrefs validate_link_html wouldn't allow are
+    skipped.
+    """
+    terms = {}
+    for story_id, links in links_by_story.items():
+        for phrase, href in links:
+            # Indexed hrefs are copied into later paragraphs, so only safe ones
+            if MIN_TERM_LENGTH <= len(phrase) <= 255 and len(href) <= 500 and SAFE_HREF.match(href):
+                terms[(story_id, phrase)] = href
+    if not terms:
+        return 0
+
+    StoryTerm.objects.bulk_create(
+        [StoryTerm(story_id=story_id, phrase=phrase, href=href) for (story_id, phrase), href in terms.items()],
+        update_conflicts=True,
+        unique_fields=['story', 'phrase'],
+        update_fields=['href', 'updated_at']
+    )
+    for story_id in {story_id for story_id, _ in terms}:
+        cache.set(version_key(story_id), uuid.uuid4().hex, None)
+    return len(terms)
+
+
+def min_local_links():
+    return getattr(settings, 'STORIES_MIN_LOCAL_LINKS', 2)
+
+
+def annotate_locally(story_id, text):
+    """
+    Link text from the story's term index. Returns the HTML, or None when
+    fewer than STORIES_MIN_LOCAL_LINKS terms matched and the LLM should be
+    asked instead.
+    """
+    html, count = story_automaton(story_id).annotate(text)
+    return html if count >= min_local_links() else None
+
+
+def rebuild_term_index(story_id=None):
+    """
+    Rebuild term indexes from scratch out of every paragraph's links. Returns
+    the number of terms indexed.
+    """
+    paragraphs = Paragraph.objects.exclude(text_with_links__isnull=True).exclude(text_with_links='')
+    terms = StoryTerm.objects.all()
+    if story_id is not None:
+        paragraphs = paragraphs.filter(chapter__story_id=story_id)
+        terms = terms.filter(story_id=story_id)
+
+    links = defaultdict(list)
+    for paragraph_story_id, html in paragraphs.order_by('id').values_list('chapter__story_id', 'text_with_links').iterator():
+        links[paragraph_story_id].extend(extract_links(html))
+    stale = set(terms.values_list('story_id', flat=True).distinct())
+    terms.delete()
+    for stale_story_id in stale - links.keys():
+        cache.set(version_key(stale_story_id), uuid.uuid4().hex, None)
+    return index_links(links)
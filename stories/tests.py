@@ -1,3 +1,2561 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import json
+import re
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, OperationalError, connection
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.translation import gettext_lazy
+import requests
+from openai import OpenAI
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import jobs, minting, tasks, term_index
+from .bitmaps import ParagraphBitmap
+from .coalescing import SingleFlight, generate_with_lock, generation_position, stream_paragraph_once
+from .completion_cache import CompletionCache, DatabaseTier, MemoryTier
+from .context import build_chapter_context, estimate_tokens
+from .crossmint import AsyncCrossmintClient, CrossmintClient
+from .ledger import reconcile
+from .models import (
+    Story, Chapter, Paragraph, ParagraphView, ReadingProgress, Payment, NFT, RevenueLedger, Reader, PooledWallet, Job,
+    NFTMint, CompletionCacheEntry, ChapterSummary, StoryTerm, DraftParagraph, ParagraphTerm, CrossmintCollection
+)
+from .link_analysis import analyze_links_in_batches, pack_batches
+from .minting import MissingWallet, mint_paragraphs
+from .page_index import last_paragraph_on_page, rebuild_page_index
+from .pagination import encode_cursor
+from .renderers import FastJSONRenderer
+from .search import rebuild_search_index, search_paragraphs, snippet, tokenize
+from .serializers import ChapterSerializer, ParagraphSerializer, PaymentSerializer, StorySerializer, ValuesSerializer
+from .speculation import draft_stats, pregenerate_paragraph
+from .term_index import TermAutomaton, extract_links, index_links, story_automaton
+from .tracking import ViewEvent, ViewEventBuffer, sync_viewed_paragraphs
+from .wallets import claim_wallet, pool_depth, refill_wallet_pool
+
+
+class FakeOpenAIServer:
+    """
+    Minimal OpenAI-compatible chat completions server that replies with canned
+    chunks, streamed as server-sent events when the request asks for it.
+    Non-streamed replies can instead be computed from the request by respond.
+    """
+
+    def __init__(self, chunks, respond=None):
+        self.chunks = chunks
+        self.respond = respond
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server.requests.append(body)
+                if body.get('stream'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    for text in server.chunks:
+                        self._write_chunk(f"data: {json.dumps(server.chunk(text))}\n\n")
+                    self._write_chunk("data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                else:
+                    text = server.respond(body) if server.respond else "".join(server.chunks)
+                    payload = json.dumps(server.completion(text)).encode()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+
+            def _write_chunk(self, data):
+                data = data.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}/v1"
+
+    def chunk(self, text):
+        return {
+            'id': 'chatcmpl-test', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'gpt-4',
+            'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}],
+        }
+
+    def completion(self, text):
+        return {
+            'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4',
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        }
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeCrossmintServer:
+    """
+    Stub Crossmint API on a keep-alive HTTP/1.1 server. Records each request
+    and the number of TCP connections it arrived on; statuses queued in
+    failures are returned before any real response.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+        self.methods = []
+        self.failures = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server.lock:
+                    server.requests.append((self.path, self.headers['X-API-KEY'], body))
+                    server.methods.append(self.command)
+                    status = server.failures.pop(0) if server.failures else 200
+                    count = len(server.requests)
+                time.sleep(server.delay)
+                if status != 200:
+                    payload = b'{"error": "unavailable"}'
+                elif self.path.endswith('/wallets'):
+                    payload = json.dumps({'address': f"0x{count:040x}", 'type': 'evm-smart-wallet'}).encode()
+                elif '/nfts' in self.path:
+                    nft_id = self.path.rsplit('/', 1)[1] if self.command == 'PUT' else f"nft-{count}"
+                    payload = json.dumps({'id': nft_id, 'onChain': {'status': 'pending'}}).encode()
+                else:
+                    payload = json.dumps({'id': f"collection-{count}", 'chain': body['chain']}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except BrokenPipeError:
+                    # The client timed out and hung up
+                    self.close_connection = True
+
+            do_PUT = do_POST
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_port}/api"
+
+    def paths(self):
+        return [path for path, _, _ in self.requests]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StoryTestMixin:
+    def create_story(self):
+        self.user = get_user_model().objects.create_user(username='reader', password='secret')
+        self.story = Story.objects.create(title='Genesis', description='A story', author=self.user)
+        self.chapter = Chapter.objects.create(story=self.story, title='Chapter One', chapter_number=1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+def run_concurrently(count, func):
+    """
+    Call func(i) from count threads released at the same moment. Returns the
+    results and any exceptions raised.
+    """
+    barrier = threading.Barrier(count)
+    results, errors = [], []
+
+    def worker(i):
+        try:
+            barrier.wait()
+            results.append(func(i))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def completion_response(text):
+    response = mock.Mock()
+    response.choices = [mock.Mock(message=mock.Mock(content=text))]
+    return response
+
+
+def parse_events(content):
+    events = []
+    for block in content.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        registry = mock.patch.dict(jobs.registry, {'record': self.record, 'explode': self.explode})
+        registry.start()
+        self.addCleanup(registry.stop)
+
+    def record(self, **payload):
+        self.calls.append(payload)
+
+    def explode(self, **payload):
+        raise RuntimeError('boom')
+
+    def make_due(self):
+        Job.objects.filter(status=Job.STATUS_PENDING).update(run_after=timezone.now())
+
+    def test_dedupe_key_allows_one_active_job(self):
+        first = jobs.enqueue('record', {'n': 1}, dedupe_key='record:1')
+        self.assertIsNotNone(first)
+        self.assertIsNone(jobs.enqueue('record', {'n': 1}, dedupe_key='record:1'))
+        self.assertIsNotNone(jobs.enqueue('record', {'n': 2}, dedupe_key='record:2'))
+        # Jobs without a key are never deduplicated
+        self.assertIsNotNone(jobs.enqueue('record'))
+        self.assertIsNotNone(jobs.enqueue('record'))
+
+        jobs.run_job(jobs.claim_jobs(1)[0])
+        # Once the job has finished its key can be queued again
+        self.assertIsNotNone(jobs.enqueue('record', {'n': 1}, dedupe_key='record:1'))
+
+    def test_claims_due_jobs_in_run_after_order(self):
+        now = timezone.now()
+        later = jobs.enqueue('record', {'n': 'later'}, run_after=now - timedelta(seconds=1))
+        earlier = jobs.enqueue('record', {'n': 'earlier'}, run_after=now - timedelta(seconds=10))
+        future = jobs.enqueue('record', {'n': 'future'}, run_after=now + timedelta(hours=1))
+
+        claimed = jobs.claim_jobs(10)
+
+        self.assertEqual([job.id for job in claimed], [earlier.id, later.id])
+        self.assertTrue(all(job.status == Job.STATUS_RUNNING and job.attempts == 1 for job in claimed))
+        self.assertEqual(jobs.claim_jobs(10), [])
+        future.refresh_from_db()
+        self.assertEqual((future.status, future.attempts), (Job.STATUS_PENDING, 0))
+
+    def test_retries_with_backoff_until_max_attempts(self):
+        job = jobs.enqueue('explode', max_attempts=3)
+
+        for attempt in (1, 2):
+            before = timezone.now()
+            self.assertFalse(jobs.run_job(jobs.claim_jobs(1)[0]))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts, job.last_error), (Job.STATUS_PENDING, attempt, 'boom'))
+            delay = job.run_after - before
+            self.assertGreaterEqual(delay, timedelta(seconds=jobs.BACKOFF_BASE_SECONDS))
+            self.assertLessEqual(delay, timedelta(seconds=jobs.BACKOFF_BASE_SECONDS * 2 ** attempt + 1))
+            # Not due again until the backoff has passed
+            self.assertEqual(jobs.claim_jobs(1), [])
+            self.make_due()
+
+        self.assertFalse(jobs.run_job(jobs.claim_jobs(1)[0]))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.STATUS_FAILED, 3))
+        self.assertIsNotNone(job.finished_at)
+        self.make_due()
+        self.assertEqual(jobs.claim_jobs(1), [])
+
+    def test_backoff_is_capped(self):
+        for attempts in (1, 5, 30):
+            delay = jobs.backoff_delay(attempts)
+            self.assertGreaterEqual(delay, timedelta(seconds=jobs.BACKOFF_BASE_SECONDS))
+            self.assertLessEqual(delay, timedelta(seconds=jobs.BACKOFF_MAX_SECONDS))
+
+    def test_requeues_stale_running_jobs(self):
+        stale = jobs.enqueue('record', {'n': 'stale'})
+        fresh = jobs.enqueue('record', {'n': 'fresh'})
+        jobs.claim_jobs(2)
+        Job.objects.filter(id=stale.id).update(started_at=timezone.now() - jobs.STALE_AFTER - timedelta(minutes=1))
+
+        self.assertEqual(jobs.requeue_stale_jobs(), 1)
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, fresh.status), (Job.STATUS_PENDING, Job.STATUS_RUNNING))
+        self.assertEqual([job.id for job in jobs.claim_jobs(1)], [stale.id])
+
+    def test_run_jobs_once_drains_due_jobs(self):
+        jobs.enqueue('record', {'n': 1})
+        jobs.enqueue('record', {'n': 2})
+        jobs.enqueue('missing')
+        jobs.enqueue('record', {'n': 3}, run_after=timezone.now() + timedelta(hours=1))
+
+        out = StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+
+        self.assertIn('Processed 3 jobs', out.getvalue())
+        self.assertEqual(self.calls, [{'n': 1}, {'n': 2}])
+        missing = Job.objects.get(task='missing')
+        self.assertEqual(missing.status, Job.STATUS_PENDING)
+        self.assertIn("No handler registered for task 'missing'", missing.last_error)
+        stats = jobs.queue_stats()
+        self.assertEqual(stats['depth'][Job.STATUS_DONE], 2)
+        self.assertEqual(stats['depth'][Job.STATUS_PENDING], 2)
+        self.assertEqual(stats['completed_last_window'], 2)
+
+
+class ChapterContextTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        self.create_story()
+        patcher = mock.patch('stories.signals.enqueue')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_paragraphs(self, pages, per_page=10, words=80):
+        for page in pages:
+            for number in range(1, per_page + 1):
+                Paragraph.objects.create(
+                    chapter=self.chapter, page=page, paragraph_number=number,
+                    text=f"p{page}-{number} " + "word " * words
+                )
+
+    def test_recent_paragraphs_fill_the_budget(self):
+        self.add_paragraphs([1, 2, 3])
+
+        context = build_chapter_context(self.chapter, 2, token_budget=1000)
+
+        lines = context.split("\n")
+        self.assertLessEqual(sum(estimate_tokens(line) for line in lines), 1000)
+        self.assertEqual(lines[-1].split()[0], 'p2-10')
+        # Newest paragraphs, kept in reading order
+        expected = [f"p{page}-{number}" for page in (1, 2) for number in range(1, 11)][-len(lines):]
+        self.assertEqual([line.split()[0] for line in lines], expected)
+        self.assertLess(len(lines), 20)
+        self.assertNotIn('p3-', context)
+
+    def test_summary_stands_in_for_truncated_text(self):
+        self.add_paragraphs([1, 2])
+        ChapterSummary.objects.create(chapter=self.chapter, text='Mara fled the harbour.', page=1, paragraph_number=10)
+
+        context = build_chapter_context(self.chapter, 2, token_budget=1000)
+        self.assertTrue(context.startswith("Summary of earlier events in this chapter:\nMara fled the harbour."))
+
+        # Nothing left out, so no summary
+        context = build_chapter_context(self.chapter, 2, token_budget=100000)
+        self.assertNotIn('Mara', context)
+        self.assertTrue(context.startswith('p1-1 '))
+
+    def test_summary_ahead_of_current_page_is_kept(self):
+        self.add_paragraphs([1, 2, 3])
+        ChapterSummary.objects.create(chapter=self.chapter, text='Mara fled the harbour.', page=3, paragraph_number=5)
+
+        context = build_chapter_context(self.chapter, 2, token_budget=1000)
+
+        self.assertTrue(context.startswith(
+            "Summary of this chapter, including events that come after this point:\nMara fled the harbour."
+        ))
+        self.assertIn('p2-10', context)
+        self.assertNotIn('p3-', context)
+
+    def test_summary_budget(self):
+        # 102 tokens per paragraph
+        self.add_paragraphs([1, 2])
+        summary = ChapterSummary.objects.create(
+            chapter=self.chapter, text='Mara fled the harbour. ' * 200, page=2, paragraph_number=10
+        )
+
+        # Everything fits, so the unused summary takes nothing from the budget
+        context = build_chapter_context(self.chapter, 2, token_budget=2100)
+        self.assertTrue(context.startswith('p1-1 '))
+        self.assertNotIn('Mara', context)
+
+        # A long summary is trimmed to its share of the budget
+        context = build_chapter_context(self.chapter, 2, token_budget=1000)
+        self.assertLessEqual(sum(estimate_tokens(line) for line in context.split("\n")), 1000)
+        self.assertLess(len(context.split("\n")[1]), len(summary.text))
+        self.assertTrue(context.endswith('p2-10 ' + 'word ' * 80))
+
+    def test_paragraphs_after_the_summary_are_kept(self):
+        self.add_paragraphs([1, 2])
+        ChapterSummary.objects.create(chapter=self.chapter, text='Mara fled the harbour.', page=1, paragraph_number=2)
+
+        context = build_chapter_context(self.chapter, 2, token_budget=1000)
+
+        self.assertTrue(context.startswith("Summary of earlier events in this chapter:\nMara fled the harbour."))
+        self.assertEqual(
+            [line.split()[0] for line in context.split("Most recent text:\n")[1].split("\n")],
+            [f"p{page}-{number}" for page in (1, 2) for number in range(1, 11)][2:]
+        )
+
+    def test_summary_folds_full_batches_and_leaves_the_trailing_one(self):
+        # 250 tokens per paragraph, so a batch is four paragraphs
+        self.add_paragraphs([1, 2], per_page=5, words=200)
+        prompts = []
+
+        def summarize(messages, temperature):
+            prompts.append(messages[1]['content'])
+            return f"summary {len(prompts)}"
+
+        with mock.patch('stories.tasks.cached_completion', side_effect=summarize):
+            summary = tasks.update_chapter_summary(self.chapter.id)
+
+            self.assertEqual(len(prompts), 2)
+            self.assertEqual((summary.text, summary.page, summary.paragraph_number), ('summary 2', 2, 3))
+            self.assertIn('Current summary:\nsummary 1', prompts[1])
+            self.assertEqual(re.findall(r'p(\d-\d) ', prompts[0]), ['1-1', '1-2', '1-3', '1-4'])
+
+            # The trailing two paragraphs wait until there are enough to fold
+            tasks.update_chapter_summary(self.chapter.id)
+            self.assertEqual(len(prompts), 2)
+            self.add_paragraphs([3], per_page=2, words=200)
+            summary = tasks.update_chapter_summary(self.chapter.id)
+
+        self.assertEqual(len(prompts), 3)
+        self.assertEqual(re.findall(r'p(\d-\d) ', prompts[2]), ['2-4', '2-5', '3-1', '3-2'])
+        self.assertEqual((summary.page, summary.paragraph_number), (3, 2))
+
+
+class StreamingGenerationTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        self.create_story()
+        Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+
+    def stream(self, url, **kwargs):
+        with FakeOpenAIServer(['The ', 'story ', 'continues.']) as server:
+            with mock.patch.object(tasks, 'client', OpenAI(base_url=server.base_url, api_key='test')):
+                response = self.client.post(url, **kwargs)
+                content = b"".join(response.streaming_content).decode()
+        return response, parse_events(content)
+
+    def test_generate_paragraph_stream(self):
+        response, events = self.stream(reverse('chapter-generate-paragraph-stream', args=[self.chapter.id]))
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual([data['text'] for event, data in events if event == 'token'], ['The ', 'story ', 'continues.'])
+        event, data = events[-1]
+        self.assertEqual(event, 'paragraph')
+        self.assertEqual(data['text'], 'The story continues.')
+        self.assertEqual(data['paragraph_number'], 2)
+        self.assertEqual(Paragraph.objects.filter(chapter=self.chapter).count(), 2)
+
+    def test_generate_next_page_stream(self):
+        response, events = self.stream(
+            reverse('chapter-generate-next-page-stream', args=[self.chapter.id]),
+            data={'current_page': 1}, format='json'
+        )
+
+        event, data = events[-1]
+        self.assertEqual(event, 'paragraph')
+        self.assertEqual((data['page'], data['paragraph_number']), (2, 1))
+        self.assertEqual(Paragraph.objects.filter(chapter=self.chapter, page=2).count(), 1)
+
+    def test_event_stream_accept_header(self):
+        for name in ('chapter-generate-paragraph-stream', 'chapter-generate-next-page-stream'):
+            response, events = self.stream(
+                reverse(name, args=[self.chapter.id]), HTTP_ACCEPT='text/event-stream'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertEqual(events[-1][0], 'paragraph')
+
+        response = self.client.post(
+            reverse('chapter-generate-paragraph-stream', args=[0]), HTTP_ACCEPT='text/event-stream'
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(parse_events(response.content.decode())[0][0], 'error')
+
+    def test_abandoned_stream_saves_nothing(self):
+        with FakeOpenAIServer(['The ', 'story ', 'continues.']) as server:
+            with mock.patch.object(tasks, 'client', OpenAI(base_url=server.base_url, api_key='test')):
+                stream = tasks.stream_next_paragraph(self.chapter.id)
+                next(stream)
+                stream.close()
+
+        self.assertEqual(Paragraph.objects.filter(chapter=self.chapter).count(), 1)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentParagraphNumberingTests(StoryTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.create_story()
+        self.first = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+
+    def slow_completion(self, **kwargs):
+        time.sleep(0.05)
+        return completion_response('Meanwhile...')
+
+    def test_concurrent_generation_never_collides(self):
+        with mock.patch.object(tasks.client.chat.completions, 'create', side_effect=self.slow_completion):
+            results, errors = run_concurrently(
+                20, lambda i: tasks.generate_next_paragraph(self.chapter.id, self.first.id)
+            )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(p.paragraph_number for p in results), list(range(2, 22)))
+
+    def test_concurrent_new_pages_never_collide(self):
+        with mock.patch.object(tasks.client.chat.completions, 'create', side_effect=self.slow_completion):
+            results, errors = run_concurrently(10, lambda i: tasks.generate_next_page(self.chapter.id, 1))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(p.paragraph_number for p in results), list(range(1, 11)))
+        self.assertEqual({p.page for p in results}, {2})
+
+    def test_concurrent_generation_keeps_page_index_exact(self):
+        def generate(i):
+            if i % 2:
+                return tasks.generate_next_page(self.chapter.id, 1)
+            return tasks.generate_next_paragraph(self.chapter.id, self.first.id)
+
+        with mock.patch.object(tasks.client.chat.completions, 'create', side_effect=self.slow_completion):
+            _, errors = run_concurrently(10, generate)
+
+        self.assertEqual(errors, [])
+        self.chapter.refresh_from_db()
+        self.assertEqual((self.chapter.page_count, self.chapter.paragraph_count), (2, 11))
+        self.assertEqual(rebuild_page_index([self.chapter.id]), 0)
+
+
+
+class GenerationCoalescingTests(StoryTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.create_story()
+        self.first = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+
+    def slow_completion(self, **kwargs):
+        time.sleep(0.2)
+        return completion_response('Meanwhile...')
+
+    def slow_stream(self, messages, temperature):
+        yield 'Mean'
+        time.sleep(0.2)
+        yield 'while...'
+
+    def post(self, name, **kwargs):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client.post(reverse(name, args=[self.chapter.id]), **kwargs)
+
+    def test_concurrent_requests_share_one_generation(self):
+        def generate(i):
+            response = self.post('chapter-generate-paragraph')
+            return response.status_code, response.json()['id']
+
+        with mock.patch.object(tasks.client.chat.completions, 'create', side_effect=self.slow_completion) as create:
+            results, errors = run_concurrently(10, generate)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(Paragraph.objects.filter(chapter=self.chapter).count(), 2)
+        new_id = Paragraph.objects.get(paragraph_number=2).id
+        self.assertEqual(results, [(201, new_id)] * 10)
+
+    def test_concurrent_streams_share_one_generation(self):
+        def generate(i):
+            response = self.post('chapter-generate-paragraph-stream')
+            events = parse_events(b"".join(response.streaming_content).decode())
+            return "".join(data['text'] for event, data in events if event == 'token'), events[-1]
+
+        with mock.patch.object(tasks, 'stream_completion', side_effect=self.slow_stream) as stream:
+            results, errors = run_concurrently(5, generate)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(stream.call_count, 1)
+        new_id = Paragraph.objects.get(paragraph_number=2).id
+        self.assertEqual(Paragraph.objects.filter(chapter=self.chapter).count(), 2)
+        for text, (event, data) in results:
+            self.assertEqual((text, event, data['id']), ('Meanwhile...', 'paragraph', new_id))
+
+    def test_abandoned_stream_fails_its_waiters(self):
+        with mock.patch.object(tasks, 'stream_completion', side_effect=self.slow_stream):
+            stream = stream_paragraph_once(self.chapter.id, self.first.id)
+            self.assertEqual(next(stream), 'Mean')
+            waiter = stream_paragraph_once(self.chapter.id, self.first.id)
+
+            def wait():
+                try:
+                    with self.assertRaisesMessage(RuntimeError, 'cancelled'):
+                        next(waiter)
+                finally:
+                    connection.close()
+
+            waiting = threading.Thread(target=wait)
+            waiting.start()
+            time.sleep(0.05)
+            stream.close()
+            waiting.join()
+
+            # Nothing was saved, and the next request generates afresh
+            self.assertEqual(Paragraph.objects.filter(chapter=self.chapter).count(), 1)
+            self.assertEqual(list(stream_paragraph_once(self.chapter.id, self.first.id)), ['Mean', 'while...'])
+
+    def test_generating_on_an_empty_page_does_not_return_old_text(self):
+        with mock.patch.object(tasks.client.chat.completions, 'create', return_value=completion_response('Anew.')):
+            response = self.post('chapter-generate-paragraph', QUERY_STRING='page=5')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['text'], 'Anew.')
+        self.assertNotEqual(response.json()['id'], self.first.id)
+
+    @skipUnless(connection.vendor == 'postgresql', 'advisory locks are PostgreSQL only')
+    def test_advisory_lock_coalesces_across_processes(self):
+        # Without the in-process layer, as if each thread were its own worker
+        page, after_id = generation_position(self.chapter.id, self.first.id)
+        with mock.patch.object(tasks.client.chat.completions, 'create', side_effect=self.slow_completion) as create:
+            results, errors = run_concurrently(
+                5, lambda i: generate_with_lock(self.chapter.id, page, self.first.id, after_id)
+            )
+
+        self.assertEqual(errors, [])
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual({paragraph.id for paragraph in results}, {Paragraph.objects.get(paragraph_number=2).id})
+
+    def test_waiting_callers_share_the_error(self):
+        flights = SingleFlight()
+        started = threading.Event()
+
+        def fail():
+            started.set()
+            time.sleep(0.1)
+            raise RuntimeError('model unavailable')
+
+        leader = threading.Thread(target=lambda: self.assertRaises(RuntimeError, flights.do, 'key', fail))
+        leader.start()
+        started.wait()
+        with self.assertRaisesMessage(RuntimeError, 'model unavailable'):
+            flights.do('key', lambda: 'not called')
+        leader.join()
+        self.assertEqual(flights.do('key', lambda: 'fresh'), 'fresh')
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentParagraphViewTests(StoryTestMixin, TransactionTestCase):
+    def test_parallel_reads_get_distinct_view_orders(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+
+        def read(i):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            return client.get(reverse('paragraph-detail', args=[paragraph.id])).status_code
+
+        results, errors = run_concurrently(10, read)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [200] * 10)
+        self.assertEqual(
+            sorted(ParagraphView.objects.filter(user=self.user).values_list('view_order', flat=True)),
+            list(range(1, 11))
+        )
+
+
+@override_settings(STORIES_SPECULATIVE_GENERATION=True)
+class SpeculativeGenerationTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.first = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        self.last = Paragraph.objects.create(chapter=self.chapter, text='It went on.', paragraph_number=1, page=2)
+
+    def speculation_jobs(self):
+        return Job.objects.filter(task='pregenerate_paragraph')
+
+    def pregenerate(self, text='Drafted ahead.'):
+        with mock.patch.object(tasks.client.chat.completions, 'create') as create:
+            create.return_value = completion_response(text)
+            return pregenerate_paragraph(self.chapter.id, self.last.id)
+
+    def test_reading_the_last_page_queues_one_draft(self):
+        url = reverse('chapter-paragraphs', args=[self.chapter.id])
+        self.client.get(url, {'page': 1})
+        self.assertFalse(self.speculation_jobs().exists())
+
+        self.client.get(url, {'page': 2})
+        self.client.get(url, {'page': 2})
+        self.assertEqual(
+            list(self.speculation_jobs().values_list('payload', flat=True)),
+            [{'chapter_id': self.chapter.id, 'previous_paragraph_id': self.last.id}]
+        )
+
+    @override_settings(STORIES_SPECULATIVE_GENERATION=False)
+    def test_disabled_by_default(self):
+        self.client.get(reverse('chapter-paragraphs', args=[self.chapter.id]), {'page': 2})
+        self.assertFalse(self.speculation_jobs().exists())
+
+    def test_generate_publishes_ready_draft_without_llm(self):
+        self.pregenerate()
+        DraftParagraph.objects.update(generation_ms=1500)
+
+        with mock.patch.object(tasks.client.chat.completions, 'create') as create:
+            response = self.client.post(reverse('chapter-generate-paragraph', args=[self.chapter.id]))
+
+        create.assert_not_called()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['text'], response.data['page'], response.data['paragraph_number']),
+                         ('Drafted ahead.', 2, 2))
+        self.assertEqual(draft_stats(), {
+            'published': 1, 'discarded': 0, 'failed': 0, 'waiting': 0, 'saved_ms': 1500, 'hit_rate': 1.0
+        })
+
+    def test_stream_publishes_ready_draft(self):
+        self.pregenerate()
+        response = self.client.post(reverse('chapter-generate-paragraph-stream', args=[self.chapter.id]))
+        events = parse_events(b"".join(response.streaming_content).decode())
+
+        self.assertEqual(events[0], ('token', {'text': 'Drafted ahead.'}))
+        self.assertEqual(events[-1][1]['text'], 'Drafted ahead.')
+
+    def test_draft_is_discarded_when_the_chapter_moves_on(self):
+        self.pregenerate()
+        tasks.save_next_paragraph(self.chapter, 2, 'Someone else wrote this.')
+
+        self.assertEqual(DraftParagraph.objects.get().status, DraftParagraph.STATUS_DISCARDED)
+        with mock.patch.object(tasks.client.chat.completions, 'create') as create:
+            create.return_value = completion_response('Fresh.')
+            response = self.client.post(reverse('chapter-generate-paragraph', args=[self.chapter.id]))
+        self.assertEqual(create.call_count, 1)
+        self.assertEqual(response.data['text'], 'Fresh.')
+        self.assertEqual(draft_stats()['discarded'], 1)
+
+        # A draft for a paragraph that is no longer last isn't generated at all
+        self.assertIsNone(self.pregenerate())
+
+    def test_failed_draft_is_retried(self):
+        with mock.patch.object(tasks.client.chat.completions, 'create', side_effect=RuntimeError('down')):
+            with self.assertRaises(RuntimeError):
+                pregenerate_paragraph(self.chapter.id, self.last.id)
+        self.assertEqual(DraftParagraph.objects.get().status, DraftParagraph.STATUS_FAILED)
+
+        self.pregenerate()
+        draft = DraftParagraph.objects.get()
+        self.assertEqual((draft.status, draft.text), (DraftParagraph.STATUS_READY, 'Drafted ahead.'))
+
+
+
+class ViewEventBufferTests(StoryTestMixin, TransactionTestCase):
+    def test_flush_writes_views_and_progress(self):
+        self.create_story()
+        paragraphs = [
+            Paragraph.objects.create(chapter=self.chapter, text=f'Paragraph {n}', paragraph_number=n, page=1)
+            for n in range(1, 4)
+        ]
+        buffer = ViewEventBuffer()
+        for paragraph in paragraphs + paragraphs[:1]:
+            buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+
+        self.assertEqual(buffer.flush(), 4)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(
+            list(ParagraphView.objects.filter(user=self.user).values_list('view_order', 'paragraph_id')),
+            [(1, paragraphs[0].id), (2, paragraphs[1].id), (3, paragraphs[2].id), (4, paragraphs[0].id)]
+        )
+        progress = ReadingProgress.objects.get(user=self.user, story=self.story)
+        self.assertEqual(
+            sorted(progress.viewed_paragraphs.values_list('id', flat=True)),
+            [p.id for p in paragraphs]
+        )
+
+    def test_bad_event_does_not_block_batch(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        buffer = ViewEventBuffer()
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id + 1000))
+
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(ParagraphView.objects.filter(user=self.user).count(), 1)
+
+    def started_buffer(self, **kwargs):
+        buffer = ViewEventBuffer(**kwargs)
+        with mock.patch('stories.tracking.atexit.register') as register:
+            buffer.start()
+        register.assert_called_once_with(buffer.stop)
+        self.addCleanup(buffer.stop)
+        return buffer
+
+    def wait_for_views(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while ParagraphView.objects.count() < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return ParagraphView.objects.count()
+
+    def test_views_keep_the_time_they_were_read(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        read_at = timezone.now() - timedelta(minutes=5)
+        buffer = ViewEventBuffer()
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id, viewed_at=read_at))
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+
+        buffer.flush()
+
+        first, second = ParagraphView.objects.order_by('view_order')
+        self.assertEqual(first.viewed_at, read_at)
+        self.assertGreater(second.viewed_at, read_at + timedelta(minutes=4))
+
+    def test_flusher_thread_flushes_when_full(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        buffer = self.started_buffer(flush_interval=60, flush_size=3)
+
+        for _ in range(2):
+            buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+        self.assertEqual(self.wait_for_views(1, timeout=0.3), 0)
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+        self.assertEqual(self.wait_for_views(3), 3)
+
+    def test_flusher_thread_flushes_on_interval(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        buffer = self.started_buffer(flush_interval=0.05, flush_size=1000)
+
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+
+        self.assertEqual(self.wait_for_views(1), 1)
+        self.assertEqual(buffer.events, [])
+
+    def test_stop_drains_the_buffer(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        buffer = self.started_buffer(flush_interval=60, flush_size=1000)
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+        thread = buffer.thread
+
+        buffer.stop()
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(ParagraphView.objects.count(), 1)
+
+        # Stopping doesn't stop it for good
+        with mock.patch('stories.tracking.atexit.register') as register:
+            buffer.start()
+        register.assert_not_called()
+        self.assertTrue(buffer.thread.is_alive())
+        buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+        buffer.wakeup.set()
+        self.assertEqual(self.wait_for_views(2), 2)
+
+    def test_transient_failure_keeps_events_queued(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        buffer = ViewEventBuffer()
+        for _ in range(3):
+            buffer.add(ViewEvent(self.user.id, self.story.id, self.chapter.id, paragraph.id))
+
+        with mock.patch('stories.tracking.write_view_events', side_effect=OperationalError('connection lost')), \
+                self.assertLogs('stories.tracking', 'WARNING'):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(buffer.events), 3)
+
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(ParagraphView.objects.count(), 3)
+
+    @override_settings(STORIES_BUFFER_VIEW_EVENTS=True)
+    def test_retrieve_buffers_the_view(self):
+        self.create_story()
+        paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        buffer = ViewEventBuffer(flush_interval=60, flush_size=1000)
+        self.addCleanup(buffer.stop)
+        self.client.force_login(self.user)
+
+        with mock.patch('stories.tracking.view_buffer', buffer), mock.patch('stories.tracking.atexit.register'):
+            before = timezone.now()
+            response = self.client.get(reverse('paragraph-detail', args=[paragraph.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ParagraphView.objects.exists())
+        [event] = buffer.events
+        self.assertEqual(event[:4], (self.user.id, self.story.id, self.chapter.id, paragraph.id))
+        self.assertGreaterEqual(event.viewed_at, before)
+
+        buffer.stop()
+        self.assertEqual(ParagraphView.objects.get().viewed_at, event.viewed_at)
+        self.assertTrue(ReadingProgress.objects.get(user=self.user).viewed_paragraphs.filter(id=paragraph.id).exists())
+
+
+@override_settings(STORIES_VIEWED_PARAGRAPHS_STORAGE='bitmap')
+class BitmapProgressStorageTests(StoryTestMixin, TestCase):
+    def test_mark_viewed_updates_bitmap(self):
+        self.create_story()
+        paragraphs = [
+            Paragraph.objects.create(chapter=self.chapter, text=f'Paragraph {n}', paragraph_number=n, page=1)
+            for n in range(1, 4)
+        ]
+        for paragraph in (paragraphs[2], paragraphs[0], paragraphs[2]):
+            self.client.post(reverse('mark-viewed'), {'story': self.story.id, 'paragraph': paragraph.id}, format='json')
+
+        progress = ReadingProgress.objects.get(user=self.user, story=self.story)
+        self.assertEqual(progress.viewed_paragraphs.count(), 0)
+
+        url = reverse('reading-progress-viewed-paragraphs')
+        response = self.client.get(url, {'story': self.story.id})
+        self.assertEqual(response.json(), {'viewed_paragraphs': [paragraphs[0].id, paragraphs[2].id]})
+
+        response = self.client.get(url, {'story': self.story.id, 'encoding': 'bitmap'})
+        bitmap = ParagraphBitmap.from_bytes(base64.b64decode(response.json()['viewed_bitmap']))
+        self.assertEqual(response.json()['count'], 2)
+        self.assertIn(paragraphs[2].id, bitmap)
+        self.assertNotIn(paragraphs[1].id, bitmap)
+
+    def test_rejects_paragraphs_outside_the_story(self):
+        self.create_story()
+        other_story = Story.objects.create(title='Exodus', description='Another story', author=self.user)
+        other_chapter = Chapter.objects.create(story=other_story, title='Chapter One', chapter_number=1)
+        foreign = Paragraph.objects.create(chapter=other_chapter, text='Elsewhere', paragraph_number=1, page=1)
+
+        for paragraph_id in (foreign.id, 100000000, -1):
+            for url, key in ((reverse('mark-viewed'), 'paragraph'), (reverse('reading-progress-list'), 'current_paragraph')):
+                response = self.client.post(url, {'story': self.story.id, key: paragraph_id}, format='json')
+                self.assertEqual(response.status_code, 400, (url, paragraph_id))
+
+        self.assertFalse(ReadingProgress.objects.filter(viewed_bitmap__isnull=False).exists())
+
+    def test_sync_copies_views_between_storages(self):
+        self.create_story()
+        paragraphs = [
+            Paragraph.objects.create(chapter=self.chapter, text=f'Paragraph {n}', paragraph_number=n, page=1)
+            for n in range(1, 4)
+        ]
+        progress = ReadingProgress.objects.create(user=self.user, story=self.story)
+        # Viewed while the M2M was configured
+        progress.viewed_paragraphs.add(paragraphs[0], paragraphs[1])
+
+        out = StringIO()
+        call_command('sync_viewed_paragraphs', stdout=out)
+        self.assertIn('Synced 1 reading progress rows', out.getvalue())
+        progress.refresh_from_db()
+        self.assertEqual(list(ParagraphBitmap.from_bytes(progress.viewed_bitmap)), [paragraphs[0].id, paragraphs[1].id])
+
+        self.client.post(reverse('mark-viewed'), {'story': self.story.id, 'paragraph': paragraphs[2].id}, format='json')
+        paragraphs[1].delete()
+        call_command('sync_viewed_paragraphs', to='m2m', stdout=StringIO())
+        self.assertEqual(
+            set(progress.viewed_paragraphs.values_list('id', flat=True)), {paragraphs[0].id, paragraphs[2].id}
+        )
+
+        # Nothing left to copy
+        self.assertEqual(sync_viewed_paragraphs(), 0)
+
+
+class MarkViewedBatchTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        self.create_story()
+        other_chapter = Chapter.objects.create(
+            story=Story.objects.create(title='Exodus', description='Another story', author=self.user),
+            title='Chapter One', chapter_number=1
+        )
+        Paragraph.objects.bulk_create(
+            [Paragraph(chapter=self.chapter, text='Text', paragraph_number=n, page=1) for n in range(1, 151)] +
+            [Paragraph(chapter=other_chapter, text='Text', paragraph_number=n, page=1) for n in range(1, 151)]
+        )
+        self.views = [
+            {'story': paragraph.chapter.story_id, 'paragraph': paragraph.id}
+            for paragraph in Paragraph.objects.select_related('chapter')
+        ]
+
+    def mark(self, views):
+        return self.client.post(reverse('reading-progress-mark-viewed-batch'), {'views': views}, format='json')
+
+    def test_query_count_is_independent_of_batch_size(self):
+        # Paragraph lookup, progress lookup, progress insert, progress
+        # re-lookup and link insert, plus the savepoint pair
+        with self.assertNumQueries(7):
+            self.mark(self.views[:10])
+        ReadingProgress.objects.all().delete()
+        with self.assertNumQueries(7):
+            response = self.mark(self.views)
+
+        self.assertEqual(response.json()['marked'], 300)
+        self.assertEqual(
+            ReadingProgress.viewed_paragraphs.through.objects.filter(readingprogress__user=self.user).count(), 300
+        )
+
+    def test_existing_progress_skips_inserts(self):
+        self.mark(self.views)
+        with self.assertNumQueries(5):
+            response = self.mark(self.views)
+        self.assertEqual(response.json()['marked'], 300)
+
+    def test_paragraphs_from_other_stories_are_ignored(self):
+        response = self.mark([{'story': self.story.id, 'paragraph': view['paragraph']} for view in self.views])
+        self.assertEqual(response.json(), {'status': 'success', 'marked': 150, 'ignored': 150})
+
+    def test_invalid_batches_are_rejected(self):
+        self.assertEqual(self.mark([]).status_code, 400)
+        self.assertEqual(self.mark([{'story': self.story.id}]).status_code, 400)
+
+
+class ChapterPageCacheTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        self.url = reverse('chapter-paragraphs', args=[self.chapter.id])
+
+    def test_etag_revalidation_skips_the_database(self):
+        response = self.client.get(self.url, {'page': 1})
+        etag = response['ETag']
+        self.assertEqual(response.json()['results'][0]['text'], 'It began.')
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'page': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'page': 1})
+        self.assertEqual(response.status_code, 200)
+
+    def test_saving_a_paragraph_invalidates_its_page(self):
+        etag = self.client.get(self.url, {'page': 1})['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.paragraph.text = 'It began again.'
+            self.paragraph.save()
+
+        response = self.client.get(self.url, {'page': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['results'][0]['text'], 'It began again.')
+
+    def test_moving_a_paragraph_refreshes_the_page_it_left(self):
+        Paragraph.objects.create(chapter=self.chapter, text='It went on.', paragraph_number=2, page=1)
+        self.assertEqual(len(self.client.get(self.url, {'page': 1}).json()['results']), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.paragraph.page = 2
+            self.paragraph.save()
+        self.assertEqual([p['text'] for p in self.client.get(self.url, {'page': 1}).json()['results']], ['It went on.'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Paragraph.objects.filter(pk=self.paragraph.pk).update(page=1)
+        self.assertEqual(len(self.client.get(self.url, {'page': 1}).json()['results']), 2)
+
+    def test_bulk_writes_refresh_cached_pages(self):
+        self.client.get(self.url, {'page': 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            Paragraph.objects.bulk_create([Paragraph(chapter=self.chapter, text='Later.', paragraph_number=2, page=1)])
+        self.assertEqual(len(self.client.get(self.url, {'page': 1}).json()['results']), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Paragraph.objects.filter(pk=self.paragraph.pk).update(text='It began again.')
+        self.assertEqual(self.client.get(self.url, {'page': 1}).json()['results'][0]['text'], 'It began again.')
+
+    def test_new_page_refreshes_has_next(self):
+        self.assertFalse(self.client.get(self.url, {'page': 1}).json()['has_next'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Paragraph.objects.create(chapter=self.chapter, text='Later.', paragraph_number=1, page=2)
+        self.assertTrue(self.client.get(self.url, {'page': 1}).json()['has_next'])
+
+
+class RevenueLedgerTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        self.create_story()
+        self.paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1, is_locked=True)
+        self.nft = NFT.objects.create(paragraph=self.paragraph, owner=self.user, revenue_share_percentage=25)
+
+    def unlock(self, amount):
+        Paragraph.objects.filter(id=self.paragraph.id).update(is_locked=True)
+        return self.client.post(reverse('paragraph-unlock', args=[self.paragraph.id]), {'amount': amount}, format='json')
+
+    def test_unlock_updates_ledger(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.unlock('2.00').status_code, 200)
+        # The owner's share is inserted with the payment, not added after
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "stories_payment"')])
+        self.assertEqual(Payment.objects.get().owner_share, Decimal('0.50'))
+        self.assertEqual(self.unlock('1.50').status_code, 200)
+
+        ledger = RevenueLedger.objects.get(paragraph=self.paragraph)
+        self.assertEqual(ledger.total_revenue, Decimal('3.50'))
+        self.assertEqual(ledger.owner_share, Decimal('0.88'))
+        self.assertEqual(ledger.payment_count, 2)
+
+        response = self.client.get(reverse('nft-revenue', args=[self.nft.id]))
+        self.assertEqual(response.json(), {'revenue': '3.50', 'owner_share': '0.88'})
+
+    def test_invalid_amount_records_nothing(self):
+        self.assertEqual(self.unlock('lots').status_code, 400)
+        self.assertFalse(Payment.objects.exists())
+        self.assertFalse(RevenueLedger.objects.exists())
+
+    def test_portfolio_is_one_query(self):
+        self.unlock('4.00')
+        other = Paragraph.objects.create(chapter=self.chapter, text='It went on.', paragraph_number=2, page=1)
+        NFT.objects.create(paragraph=other, owner=self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('nft-portfolio'))
+        self.assertEqual(len(queries), 1)
+        data = response.json()
+        self.assertEqual([nft['paragraph_id'] for nft in data['nfts']], [self.paragraph.id, other.id])
+        self.assertEqual(Decimal(str(data['total_revenue'])), Decimal('4.00'))
+        self.assertEqual(Decimal(str(data['total_owner_share'])), Decimal('1.00'))
+
+    def test_reconcile_finds_and_fixes_drift(self):
+        self.unlock('4.00')
+        self.assertEqual(reconcile(), [])
+
+        # A payment recorded outside unlock and a ledger row with no payments
+        Payment.objects.create(user=self.user, paragraph=self.paragraph, amount=2)
+        orphan = Paragraph.objects.create(chapter=self.chapter, text='Orphan.', paragraph_number=2, page=1)
+        RevenueLedger.objects.create(paragraph=orphan, total_revenue=9, payment_count=1)
+
+        mismatches = reconcile(fix=True)
+        self.assertEqual([paragraph_id for paragraph_id, _, _ in mismatches], [self.paragraph.id, orphan.id])
+        self.assertEqual(reconcile(), [])
+        ledger = RevenueLedger.objects.get(paragraph=self.paragraph)
+        self.assertEqual((ledger.total_revenue, ledger.owner_share, ledger.payment_count), (Decimal('6.00'), Decimal('1.50'), 2))
+        self.assertFalse(RevenueLedger.objects.filter(paragraph=orphan).exists())
+
+    def test_reconcile_adds_up_rounded_shares(self):
+        NFT.objects.filter(id=self.nft.id).update(revenue_share_percentage=10)
+        for _ in range(4):
+            self.unlock('1.25')
+        self.assertEqual(RevenueLedger.objects.get(paragraph=self.paragraph).owner_share, Decimal('0.48'))
+        self.assertEqual(reconcile(), [])
+
+        # Later payments accrue at the new share; earlier ones keep theirs
+        NFT.objects.filter(id=self.nft.id).update(revenue_share_percentage=50)
+        self.unlock('2.00')
+        self.assertEqual(reconcile(), [])
+        self.assertEqual(RevenueLedger.objects.get(paragraph=self.paragraph).owner_share, Decimal('1.48'))
+
+    def test_backfilled_shares_reconcile(self):
+        NFT.objects.filter(id=self.nft.id).update(revenue_share_percentage=10)
+        Payment.objects.bulk_create(Payment(user=self.user, paragraph=self.paragraph, amount='1.25') for _ in range(4))
+        # As left by the ledger backfill before shares were rounded per payment
+        RevenueLedger.objects.create(paragraph=self.paragraph, total_revenue=5, owner_share=Decimal('0.50'), payment_count=4)
+
+        migration = import_module('stories.migrations.0029_backfill_payment_owner_share')
+        migration.backfill_owner_shares(django_apps, None)
+
+        self.assertEqual(set(Payment.objects.values_list('owner_share', flat=True)), {Decimal('0.12')})
+        self.assertEqual(RevenueLedger.objects.get(paragraph=self.paragraph).owner_share, Decimal('0.48'))
+        self.assertEqual(reconcile(), [])
+
+    def test_revenue_without_payments(self):
+        response = self.client.get(reverse('nft-revenue', args=[self.nft.id]))
+        self.assertEqual(response.json(), {'revenue': '0.00', 'owner_share': '0.00'})
+
+        self.unlock('2.00')
+        response = self.client.get(reverse('nft-revenue', args=[self.nft.id]))
+        self.assertEqual(response.json(), {'revenue': '2.00', 'owner_share': '0.50'})
+
+
+class IdempotentUnlockTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1, is_locked=True)
+        self.url = reverse('paragraph-unlock', args=[self.paragraph.id])
+
+    def unlock(self, amount='2.00', key=None):
+        headers = {'Idempotency-Key': key} if key else None
+        return self.client.post(self.url, {'amount': amount}, format='json', headers=headers)
+
+    def test_retry_replays_stored_response(self):
+        first = self.unlock(key='abc')
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', first)
+
+        retry = self.unlock(amount='2', key='abc')
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_new_key_on_unlocked_paragraph_is_rejected(self):
+        self.unlock(key='abc')
+        response = self.unlock(key='def')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.unlock(key='def').json(), response.json())
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_key_reused_for_different_request(self):
+        self.unlock(key='abc')
+        self.assertEqual(self.unlock(amount='3.00', key='abc').status_code, 422)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_keys_are_scoped_to_the_user(self):
+        other = Paragraph.objects.create(chapter=self.chapter, text='It went on.', paragraph_number=2, page=1, is_locked=True)
+        self.unlock(key='abc')
+        someone = get_user_model().objects.create_user(username='someone')
+        client = APIClient()
+        client.force_authenticate(someone)
+        response = client.post(
+            reverse('paragraph-unlock', args=[other.id]), {'amount': '2.00'}, format='json',
+            headers={'Idempotency-Key': 'abc'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_unlock_drops_cached_page(self):
+        page_url = reverse('chapter-paragraphs', args=[self.chapter.id])
+        self.assertTrue(self.client.get(page_url).json()['results'][0]['is_locked'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.unlock()
+        self.assertFalse(self.client.get(page_url).json()['results'][0]['is_locked'])
+
+    def test_invalid_amounts(self):
+        for amount in ('lots', '-1', '0', 'NaN'):
+            with self.subTest(amount=amount):
+                self.assertEqual(self.unlock(amount=amount).status_code, 400)
+        self.assertFalse(Payment.objects.exists())
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentUnlockTests(StoryTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.create_story()
+        Paragraph.objects.bulk_create(
+            Paragraph(chapter=self.chapter, text='Locked.', paragraph_number=i + 1, page=1, is_locked=True)
+            for i in range(10)
+        )
+        self.paragraph_ids = list(Paragraph.objects.values_list('id', flat=True))
+
+    def post_unlock(self, client, paragraph_id, key):
+        return client.post(
+            reverse('paragraph-unlock', args=[paragraph_id]), {'amount': '1.00'}, format='json',
+            headers={'Idempotency-Key': key}
+        )
+
+    def test_contended_unlocks_charge_once_per_paragraph(self):
+        def unlock_all(i):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            # Each thread walks the paragraphs from a different starting point
+            order = self.paragraph_ids[i % 10:] + self.paragraph_ids[:i % 10]
+            return [self.post_unlock(client, paragraph_id, f"{i}-{paragraph_id}").status_code for paragraph_id in order]
+
+        results, errors = run_concurrently(12, unlock_all)
+
+        self.assertEqual(errors, [])
+        statuses = [code for codes in results for code in codes]
+        self.assertEqual(statuses.count(200), 10)
+        self.assertEqual(statuses.count(400), 110)
+        self.assertEqual(
+            sorted(Payment.objects.values_list('paragraph_id', flat=True)), sorted(self.paragraph_ids)
+        )
+        self.assertEqual(RevenueLedger.objects.filter(payment_count=1).count(), 10)
+
+    def test_concurrent_retries_share_one_key(self):
+        def retry(i):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            response = self.post_unlock(client, self.paragraph_ids[0], 'same-key')
+            return response.status_code, response.json()
+
+        results, errors = run_concurrently(10, retry)
+
+        self.assertEqual(errors, [])
+        self.assertEqual({code for code, _ in results}, {200})
+        self.assertEqual(len({body['payment'] for _, body in results}), 1)
+        self.assertEqual(Payment.objects.count(), 1)
+
+
+class CrossmintClientTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def make_client(self, server, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        client = CrossmintClient(api_key='key', base_url=server.base_url, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_calls_share_one_connection(self):
+        with FakeCrossmintServer() as server:
+            client = self.make_client(server)
+            for _ in range(10):
+                client.create_wallet('0xsigner')
+        self.assertEqual(len(server.requests), 10)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual({key for _, key, _ in server.requests}, {'key'})
+
+    def test_collection_is_created_once_per_chain(self):
+        with FakeCrossmintServer() as server:
+            client = self.make_client(server)
+            first = client.mint_nft()
+            client.mint_nft()
+            client.mint_nft(chain='polygon')
+        self.assertEqual(first['id'], 'nft-2')
+        self.assertEqual(server.paths(), [
+            '/api/2022-06-09/collections/',
+            '/api/2022-06-09/collections/collection-1/nfts',
+            '/api/2022-06-09/collections/collection-1/nfts',
+            '/api/2022-06-09/collections/',
+            '/api/2022-06-09/collections/collection-4/nfts',
+        ])
+        self.assertEqual(server.connections, 1)
+
+    def test_created_collection_is_shared_between_processes(self):
+        with FakeCrossmintServer() as server:
+            self.make_client(server).mint_nft()
+            # Another worker, with its own cache
+            cache.clear()
+            self.make_client(server).mint_nft()
+        self.assertEqual(server.paths(), [
+            '/api/2022-06-09/collections/',
+            '/api/2022-06-09/collections/collection-1/nfts',
+            '/api/2022-06-09/collections/collection-1/nfts',
+        ])
+        self.assertEqual(CrossmintCollection.objects.get(env='staging', chain='solana').collection_id, 'collection-1')
+
+    def test_collection_saved_first_by_another_process_is_used(self):
+        with FakeCrossmintServer() as server:
+            client = self.make_client(server)
+            create_collection = client.create_collection
+
+            def create_while_another_process_does(chain):
+                created = create_collection(chain=chain)
+                CrossmintCollection.objects.create(env='staging', chain=chain, collection_id='collection-other')
+                return created
+
+            with mock.patch.object(client, 'create_collection', create_while_another_process_does), \
+                    self.assertLogs('stories.crossmint', 'WARNING'):
+                client.mint_nft()
+        self.assertEqual(server.paths()[-1], '/api/2022-06-09/collections/collection-other/nfts')
+        self.assertEqual(CrossmintCollection.objects.get().collection_id, 'collection-other')
+
+    def test_retries_retryable_statuses(self):
+        with FakeCrossmintServer() as server:
+            server.failures = [503, 429]
+            with self.assertLogs('stories.crossmint', 'WARNING') as logs:
+                result = self.make_client(server).mint_nft(collection_id='existing', nft_id='nft-a')
+        self.assertEqual(result['id'], 'nft-a')
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_posts_are_only_retried_when_rejected(self):
+        with FakeCrossmintServer() as server:
+            server.failures = [429]
+            with self.assertLogs('stories.crossmint', 'WARNING'):
+                self.make_client(server).create_wallet('0xsigner')
+            self.assertEqual(len(server.requests), 2)
+
+            # A gateway error may come after the wallet was created
+            server.failures = [503]
+            with self.assertRaises(requests.exceptions.HTTPError), self.assertLogs('stories.crossmint', 'ERROR'):
+                self.make_client(server).create_wallet('0xsigner')
+            self.assertEqual(len(server.requests), 3)
+
+    def test_posts_are_retried_when_the_connection_fails(self):
+        client = CrossmintClient(base_url='http://127.0.0.1:9/api', backoff=0, max_retries=2)
+        self.addCleanup(client.close)
+        with mock.patch.object(client.session, 'request', wraps=client.session.request) as send:
+            with self.assertRaises(requests.exceptions.ConnectionError), self.assertLogs('stories.crossmint', 'WARNING'):
+                client.create_wallet('0xsigner')
+        self.assertEqual(send.call_count, 3)
+
+        # Dropped after sending: the wallet may exist already
+        dropped = requests.exceptions.ConnectionError('Connection aborted.')
+        with mock.patch.object(client.session, 'request', side_effect=dropped) as send:
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                client.create_wallet('0xsigner')
+        self.assertEqual(send.call_count, 1)
+
+    def test_gives_up_after_max_retries(self):
+        with FakeCrossmintServer() as server:
+            server.failures = [429] * 5
+            with self.assertRaises(requests.exceptions.HTTPError), self.assertLogs('stories.crossmint', 'WARNING'):
+                self.make_client(server, max_retries=2).create_wallet('0xsigner')
+        self.assertEqual(len(server.requests), 3)
+
+    def test_client_errors_and_read_timeouts_are_not_retried(self):
+        with FakeCrossmintServer() as server:
+            server.failures = [400]
+            with self.assertRaises(requests.exceptions.HTTPError), self.assertLogs('stories.crossmint', 'ERROR'):
+                self.make_client(server).create_wallet('0xsigner')
+        with FakeCrossmintServer(delay=0.5) as server:
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                self.make_client(server, timeout=(1, 0.1)).mint_nft(collection_id='existing')
+        self.assertEqual(len(server.requests), 1)
+
+    def test_backoff_is_jittered_and_capped(self):
+        client = CrossmintClient(backoff=1, max_backoff=5)
+        delays = [client.backoff_delay(attempt) for attempt in (1, 2, 3, 10) for _ in range(50)]
+        self.assertTrue(all(0 <= delay <= 5 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertEqual(client.backoff_delay(1, retry_after='2'), 2)
+
+    def test_async_mints_run_concurrently_over_the_pool(self):
+        async def mint_all(client):
+            async with AsyncCrossmintClient(client) as async_client:
+                return await asyncio.gather(*(async_client.mint_nft() for _ in range(20)))
+
+        with FakeCrossmintServer(delay=0.05) as server:
+            start = time.perf_counter()
+            results = asyncio.run(mint_all(self.make_client(server, pool_size=5)))
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(len({result['id'] for result in results}), 20)
+        self.assertEqual(server.paths().count('/api/2022-06-09/collections/'), 1)
+        self.assertLessEqual(server.connections, 5)
+        # 21 calls of 50ms each, five at a time
+        self.assertLess(elapsed, 21 * 0.05)
+
+
+class WalletPoolTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.url = reverse('auth-login')
+
+    def fill_pool(self, count):
+        PooledWallet.objects.bulk_create(
+            PooledWallet(address=f"0xpool{i}", chain='evm-smart-wallet') for i in range(count)
+        )
+
+    @override_settings(STORIES_WALLET_POOL_LOW_WATERMARK=2)
+    def test_login_claims_pooled_wallet(self):
+        self.fill_pool(5)
+        with mock.patch('stories.views.create_wallet', side_effect=AssertionError('called Crossmint')):
+            response = self.client.post(self.url, {'email': 'new@example.com'}, format='json')
+
+        self.assertEqual(response.json()['wallet_address'], '0xpool0')
+        reader = Reader.objects.get(email='new@example.com')
+        self.assertEqual((reader.wallet_address, reader.wallet_chain), ('0xpool0', 'evm-smart-wallet'))
+        self.assertEqual(PooledWallet.objects.get(address='0xpool0').reader, reader)
+        self.assertEqual(pool_depth()['available'], 4)
+        self.assertFalse(Job.objects.filter(task='refill_wallet_pool').exists())
+
+    @override_settings(STORIES_WALLET_POOL_LOW_WATERMARK=2)
+    def test_refill_queued_below_low_watermark(self):
+        self.fill_pool(2)
+        self.client.post(self.url, {'email': 'new@example.com'}, format='json')
+        self.client.post(self.url, {'email': 'other@example.com'}, format='json')
+        self.assertEqual(Job.objects.filter(task='refill_wallet_pool', status=Job.STATUS_PENDING).count(), 1)
+
+    def test_empty_pool_falls_back_to_crossmint(self):
+        wallet = {'address': '0xfresh', 'type': 'evm-smart-wallet'}
+        with mock.patch('stories.views.create_wallet', return_value=wallet) as create_wallet, \
+                self.assertLogs('stories.wallets', 'WARNING'):
+            response = self.client.post(self.url, {'email': 'new@example.com'}, format='json')
+
+        create_wallet.assert_called_once()
+        self.assertEqual(response.json()['wallet_address'], '0xfresh')
+        self.assertTrue(Job.objects.filter(task='refill_wallet_pool').exists())
+
+    @override_settings(STORIES_WALLET_POOL_LOW_WATERMARK=5)
+    def test_failed_login_returns_the_wallet_to_the_pool(self):
+        self.fill_pool(1)
+        with mock.patch('stories.wallets.request_refill', side_effect=DatabaseError('queue unavailable')), \
+                self.assertLogs('stories.views', 'ERROR'):
+            response = self.client.post(self.url, {'email': 'new@example.com'}, format='json')
+
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Reader.objects.exists())
+        self.assertEqual(pool_depth()['available'], 1)
+
+        response = self.client.post(self.url, {'email': 'new@example.com'}, format='json')
+        self.assertEqual(response.json()['wallet_address'], '0xpool0')
+
+    def test_refill_tops_up_to_high_watermark(self):
+        cache.clear()
+        self.fill_pool(3)
+        with FakeCrossmintServer() as server:
+            client = CrossmintClient(base_url=server.base_url, backoff=0)
+            self.addCleanup(client.close)
+            self.assertEqual(refill_wallet_pool(target=10, concurrency=4, client=client), 7)
+            self.assertEqual(refill_wallet_pool(target=10, client=client), 0)
+
+        self.assertEqual(len(server.requests), 7)
+        self.assertLessEqual(server.connections, 4)
+        self.assertEqual(pool_depth()['available'], 10)
+
+    def test_refill_keeps_wallets_created_before_a_failure(self):
+        with FakeCrossmintServer() as server:
+            server.failures = [400]
+            client = CrossmintClient(base_url=server.base_url, backoff=0)
+            self.addCleanup(client.close)
+            with self.assertRaises(requests.exceptions.HTTPError), self.assertLogs('stories.crossmint', 'ERROR'):
+                refill_wallet_pool(target=4, concurrency=1, client=client)
+        self.assertEqual(pool_depth()['available'], 3)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentWalletClaimTests(TransactionTestCase):
+    def test_each_wallet_is_claimed_once(self):
+        PooledWallet.objects.bulk_create(
+            PooledWallet(address=f"0xpool{i}", chain='evm-smart-wallet') for i in range(5)
+        )
+        readers = [Reader.objects.create(email=f"reader{i}@example.com") for i in range(10)]
+
+        results, errors = run_concurrently(10, lambda i: claim_wallet(readers[i]))
+
+        self.assertEqual(errors, [])
+        claimed = [wallet.address for wallet in results if wallet is not None]
+        self.assertEqual(sorted(claimed), [f"0xpool{i}" for i in range(5)])
+        self.assertEqual(PooledWallet.objects.filter(reader__isnull=False).count(), 5)
+
+
+class BatchMintTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        Paragraph.objects.bulk_create(
+            Paragraph(chapter=self.chapter, text=f"<p>Paragraph {i}</p>", page=i // 5 + 1, paragraph_number=i % 5 + 1)
+            for i in range(12)
+        )
+        self.paragraphs = Paragraph.objects.filter(chapter=self.chapter)
+        get_user_model().objects.filter(id=self.user.id).update(email='reader@example.com')
+        Reader.objects.create(email='reader@example.com', wallet_address='5FHwAuthorWallet', wallet_chain='solana')
+
+    def mint(self, server, **kwargs):
+        client = CrossmintClient(base_url=server.base_url, backoff=0)
+        self.addCleanup(client.close)
+        kwargs.setdefault('rate', 0)
+        return mint_paragraphs(self.paragraphs, client=client, batch_size=5, **kwargs)
+
+    def mint_paths(self, server):
+        return [path for path, method in zip(server.paths(), server.methods) if method == 'PUT']
+
+    def test_mints_chapter_in_bulk(self):
+        with FakeCrossmintServer() as server:
+            with CaptureQueriesContext(connection) as queries:
+                totals = self.mint(server, concurrency=3)
+
+        self.assertEqual(totals, {'queued': 12, 'minted': 12, 'failed': 0})
+        ids = sorted(self.paragraphs.values_list('id', flat=True))
+        self.assertEqual(sorted(NFT.objects.values_list('paragraph_id', flat=True)), ids)
+        self.assertEqual(set(self.paragraphs.values_list('nft_owner', flat=True)), {self.user.id})
+        self.assertEqual(server.methods.count('POST'), 1)
+        self.assertEqual(len(self.mint_paths(server)), 12)
+        self.assertLessEqual(server.connections, 3)
+
+        body = next(body for path, _, body in server.requests if path.endswith(f"/stories-paragraph-{ids[0]}"))
+        self.assertEqual(body['recipient'], 'solana:5FHwAuthorWallet')
+        metadata = body['metadata']
+        self.assertEqual(metadata['description'], 'Paragraph 0')
+        self.assertEqual(metadata['name'], 'Genesis 1.1.1')
+        # Wallet lookup, collection, queue, list and three batches of a fixed
+        # number of queries each
+        self.assertLess(len(queries), 40)
+
+    def test_owner_without_a_wallet_is_not_minted_for(self):
+        Reader.objects.all().delete()
+        with FakeCrossmintServer() as server:
+            with self.assertRaisesMessage(MissingWallet, 'No wallet to mint to for reader'):
+                self.mint(server)
+            self.assertEqual(server.requests, [])
+            self.assertFalse(NFTMint.objects.exists())
+
+            self.mint(server, recipient='solana:5FHwGallery')
+        self.assertEqual(
+            {body['recipient'] for path, _, body in server.requests if '/nfts/' in path}, {'solana:5FHwGallery'}
+        )
+
+    def test_owner_is_minted_for_only_on_their_wallet_chain(self):
+        Reader.objects.update(wallet_address='0xAuthorWallet', wallet_chain='evm-smart-wallet')
+        with FakeCrossmintServer() as server:
+            with self.assertRaisesMessage(MissingWallet, 'No wallet to mint to for reader'):
+                self.mint(server)
+            self.assertEqual(server.requests, [])
+
+            self.mint(server, chain='polygon')
+        self.assertEqual(
+            {body['recipient'] for path, _, body in server.requests if '/nfts/' in path}, {'polygon:0xAuthorWallet'}
+        )
+
+    def test_queued_run_keeps_chain_and_rate(self):
+        call_command(
+            'mint_nfts', '--story', str(self.story.id), '--queue', '--chain', 'polygon', '--concurrency', '2',
+            '--rate', '5', stdout=StringIO()
+        )
+        self.assertEqual(Job.objects.get(task='mint_nfts').payload, {
+            'chapter_id': None, 'story_id': self.story.id, 'owner_id': None, 'recipient': None,
+            'chain': 'polygon', 'concurrency': 2, 'rate': 5.0,
+        })
+
+    def test_failed_mints_are_retried_on_the_next_run(self):
+        with FakeCrossmintServer() as server:
+            server.failures = [200, 400]
+            with self.assertLogs('stories.crossmint', 'ERROR'):
+                first = self.mint(server, concurrency=1)
+            second = self.mint(server)
+
+        self.assertEqual(first, {'queued': 12, 'minted': 11, 'failed': 1})
+        self.assertEqual(second, {'queued': 0, 'minted': 1, 'failed': 0})
+        self.assertEqual(NFT.objects.count(), 12)
+        mint_paths = self.mint_paths(server)
+        self.assertEqual(len(mint_paths), 13)
+        self.assertEqual(mint_paths[0], mint_paths[-1])
+        self.assertEqual(NFTMint.objects.get(crossmint_id=mint_paths[0].rsplit('/', 1)[1]).attempts, 2)
+
+    def test_crashed_run_resumes_with_the_same_ids(self):
+        original = minting.save_results
+        calls = []
+
+        def crash_on_second_batch(mints, results):
+            calls.append(len(mints))
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return original(mints, results)
+
+        with FakeCrossmintServer() as server:
+            with mock.patch.object(minting, 'save_results', crash_on_second_batch), self.assertRaises(KeyboardInterrupt):
+                self.mint(server)
+            self.assertEqual(NFT.objects.count(), 5)
+            self.assertEqual(self.mint(server), {'queued': 0, 'minted': 7, 'failed': 0})
+
+        self.assertEqual(NFT.objects.count(), 12)
+        # The batch in flight at the crash is resubmitted under the same ids
+        mint_paths = self.mint_paths(server)
+        self.assertEqual(len(mint_paths), 17)
+        self.assertEqual(len(set(mint_paths)), 12)
+
+    def test_minting_drops_cached_pages(self):
+        url = reverse('chapter-paragraphs', args=[self.chapter.id])
+        self.assertIsNone(self.client.get(url).json()['results'][0]['nft_owner'])
+        with FakeCrossmintServer() as server, self.captureOnCommitCallbacks(execute=True):
+            self.mint(server)
+        self.assertEqual(self.client.get(url).json()['results'][0]['nft_owner'], self.user.id)
+
+    def test_rate_limit_spaces_submissions(self):
+        with FakeCrossmintServer() as server:
+            start = time.perf_counter()
+            self.mint(server, rate=100, concurrency=12)
+            elapsed = time.perf_counter() - start
+        # 12 mints in three batches of up to five, 10ms apart within a batch
+        self.assertGreaterEqual(elapsed, 9 * 0.01)
+
+
+class CompletionCacheTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        self.create_story()
+        self.cache = CompletionCache([MemoryTier(max_entries=2), DatabaseTier(max_entries=3, prune_every=1)])
+        patcher = mock.patch.object(tasks, 'completion_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def analyze(self, text):
+        with mock.patch('stories.signals.enqueue'):
+            paragraph = Paragraph.objects.create(chapter=self.chapter, text=text, paragraph_number=1 + Paragraph.objects.count(), page=1)
+        return tasks.analyze_and_add_links(paragraph.id)
+
+    def test_repeated_link_analysis_is_served_from_cache(self):
+        with mock.patch.object(
+            tasks.client.chat.completions, 'create', return_value=completion_response('<a>Mara</a> ran.')
+        ) as create:
+            self.assertEqual(self.analyze('Mara ran.'), '<a>Mara</a> ran.')
+            self.assertEqual(self.analyze('Mara ran.'), '<a>Mara</a> ran.')
+            self.analyze('Mara walked.')
+
+        self.assertEqual(create.call_count, 2)
+        # The reply doesn't match 'Mara walked.', so it isn't saved there
+        self.assertEqual(Paragraph.objects.filter(text_with_links='<a>Mara</a> ran.').count(), 2)
+        self.assertEqual(self.cache.stats(), {'memory_hits': 1, 'database_hits': 0, 'misses': 2, 'hit_rate': 1 / 3})
+
+    def test_database_tier_backs_the_memory_tier(self):
+        key = CompletionCache.key('gpt-4', [{'role': 'user', 'content': 'hi'}], 0.3)
+        self.cache.set(key, 'hello', 'gpt-4')
+        self.cache.tiers[0].clear()
+
+        self.assertEqual(self.cache.get(key), 'hello')
+        self.assertEqual(self.cache.get(key), 'hello')
+        self.assertEqual(self.cache.stats()['database_hits'], 1)
+        self.assertEqual(self.cache.stats()['memory_hits'], 1)
+        self.assertEqual(CompletionCacheEntry.objects.get(key=key).hits, 1)
+
+    def test_key_covers_model_messages_and_temperature(self):
+        messages = [{'role': 'system', 'content': 'a'}, {'role': 'user', 'content': 'b'}]
+        key = CompletionCache.key('gpt-4', messages, 0.3)
+        self.assertEqual(key, CompletionCache.key('gpt-4', [dict(m) for m in messages], 0.3))
+        self.assertNotEqual(key, CompletionCache.key('gpt-4o', messages, 0.3))
+        self.assertNotEqual(key, CompletionCache.key('gpt-4', messages, 0.7))
+        self.assertNotEqual(key, CompletionCache.key('gpt-4', messages[::-1], 0.3))
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        memory = MemoryTier(max_entries=2)
+        memory.set('a', 1)
+        memory.set('b', 2)
+        memory.get('a')
+        memory.set('c', 3)
+        self.assertEqual((memory.get('a'), memory.get('b'), memory.get('c')), (1, None, 3))
+
+    def test_memory_tier_expires_entries(self):
+        memory = MemoryTier(ttl=timedelta(minutes=1))
+        with mock.patch('stories.completion_cache.time.monotonic', return_value=1000):
+            memory.set('a', 1)
+        with mock.patch('stories.completion_cache.time.monotonic', return_value=1059):
+            self.assertEqual(memory.get('a'), 1)
+        with mock.patch('stories.completion_cache.time.monotonic', return_value=1060):
+            self.assertIsNone(memory.get('a'))
+        self.assertEqual(len(memory.entries), 0)
+
+    def test_command_reports_lookups(self):
+        key = CompletionCache.key('gpt-4', [{'role': 'user', 'content': 'hi'}], 0.3)
+        self.cache.get(key)
+        self.cache.set(key, 'hello', 'gpt-4')
+        self.cache.get(key)
+        out = StringIO()
+        with mock.patch('stories.management.commands.completion_cache.completion_cache', self.cache):
+            call_command('completion_cache', stdout=out)
+        self.assertIn('Entries: 1', out.getvalue())
+        self.assertIn('This process: memory_hits 1, database_hits 0, misses 1, hit rate 50%', out.getvalue())
+
+    def test_database_tier_expires_and_evicts(self):
+        database = self.cache.tiers[1]
+        for key in 'abc':
+            database.set(key, key.upper(), 'gpt-4')
+        CompletionCacheEntry.objects.filter(key='a').update(last_used_at=timezone.now() - timedelta(hours=1))
+        database.set('d', 'D', 'gpt-4')
+        self.assertEqual(sorted(CompletionCacheEntry.objects.values_list('key', flat=True)), ['b', 'c', 'd'])
+
+        CompletionCacheEntry.objects.filter(key='b').update(created_at=timezone.now() - timedelta(days=31))
+        self.assertIsNone(database.get('b'))
+        self.assertEqual(database.prune(), 1)
+        self.assertEqual(database.get('c'), 'C')
+
+
+def link_first_words(body):
+    """
+    Batch link analysis reply that links the first word of each paragraph.
+    """
+    paragraphs = json.loads(body['messages'][1]['content'])
+    return json.dumps({'paragraphs': [
+        {'id': p['id'], 'html': '<a href="/wiki/{0}">{0}</a> {1}'.format(*p['text'].split(' ', 1))}
+        for p in paragraphs
+    ]})
+
+
+class BatchLinkAnalysisTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        with mock.patch('stories.signals.enqueue'):
+            for i in range(10):
+                Paragraph.objects.create(
+                    chapter=self.chapter, text=f"Word{i} and the rest of paragraph {i}.", paragraph_number=i + 1, page=1
+                )
+        self.paragraphs = Paragraph.objects.filter(chapter=self.chapter)
+
+    def test_packs_paragraphs_into_few_requests(self):
+        with FakeOpenAIServer([], respond=link_first_words) as server:
+            client = OpenAI(base_url=server.base_url, api_key='sk-test', max_retries=0)
+            with CaptureQueriesContext(connection) as queries:
+                totals = analyze_links_in_batches(self.paragraphs, max_paragraphs=4, concurrency=2, client=client)
+
+        self.assertEqual(totals, {
+            'paragraphs': 10, 'local': 0, 'batches': 3, 'requests': 3, 'annotated': 10, 'rejected': 0, 'failed': 0
+        })
+        self.assertEqual(len(server.requests), 3)
+        first = self.paragraphs.first()
+        self.assertEqual(first.text_with_links, '<a href="/wiki/Word0">Word0</a> and the rest of paragraph 0.')
+        # Paragraph and term index reads, then a bulk update, the lookup of the
+        # cached pages it invalidates and a term index upsert per batch
+        self.assertLessEqual(len(queries), 2 + 3 * 5)
+
+    def test_invalid_html_is_rejected(self):
+        def tamper(body):
+            reply = json.loads(link_first_words(body))
+            reply['paragraphs'][0]['html'] = '<script>alert(1)</script>' + reply['paragraphs'][0]['html']
+            reply['paragraphs'][1]['html'] = 'Rewritten entirely.'
+            reply['paragraphs'][2]['html'] = reply['paragraphs'][2]['html'].replace('</a>', '')
+            del reply['paragraphs'][3]
+            return json.dumps(reply)
+
+        with FakeOpenAIServer([], respond=tamper) as server, self.assertLogs('stories.link_analysis', 'WARNING'):
+            client = OpenAI(base_url=server.base_url, api_key='sk-test', max_retries=0)
+            totals = analyze_links_in_batches(self.paragraphs, client=client)
+
+        self.assertEqual((totals['annotated'], totals['rejected']), (6, 4))
+        self.assertEqual(self.paragraphs.filter(text_with_links__isnull=True).count(), 4)
+
+    def test_truncated_reply_splits_the_batch(self):
+        def reply(model, messages, temperature):
+            batch = json.loads(messages[1]['content'])
+            if len(batch) > 3:
+                response = completion_response('{"paragraphs": [{"id": ')
+                response.choices[0].finish_reason = 'length'
+                return response
+            response = completion_response(link_first_words({'messages': messages}))
+            response.choices[0].finish_reason = 'stop'
+            return response
+
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = reply
+        totals = analyze_links_in_batches(self.paragraphs, concurrency=1, client=client)
+
+        # 10 -> 5 + 5 -> 2 + 3 + 2 + 3
+        self.assertEqual((totals['batches'], totals['requests'], totals['annotated']), (1, 7, 10))
+
+    def test_pack_batches_respects_token_budget(self):
+        paragraphs = [(1, 'x' * 400), (2, 'x' * 400), (3, 'x' * 2000), (4, 'x' * 40)]
+        self.assertEqual(
+            [[pid for pid, _ in batch] for batch in pack_batches(paragraphs, token_budget=250)],
+            [[1, 2], [3], [4]]
+        )
+
+    def test_updates_drop_cached_pages(self):
+        url = reverse('chapter-paragraphs', args=[self.chapter.id])
+        self.assertIsNone(self.client.get(url).json()['results'][0]['text_with_links'])
+        with FakeOpenAIServer([], respond=link_first_words) as server, self.captureOnCommitCallbacks(execute=True):
+            client = OpenAI(base_url=server.base_url, api_key='sk-test', max_retries=0)
+            analyze_links_in_batches(self.paragraphs, client=client)
+        self.assertIsNotNone(self.client.get(url).json()['results'][0]['text_with_links'])
+
+
+
+class TermIndexTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+
+    def add_paragraph(self, text, number):
+        with mock.patch('stories.signals.enqueue'):
+            return Paragraph.objects.create(chapter=self.chapter, text=text, paragraph_number=number, page=1)
+
+    def test_automaton_prefers_leftmost_longest_whole_words(self):
+        automaton = TermAutomaton({
+            'Mara': '/wiki/Mara', 'Mara Quill': '/wiki/Mara_Quill', 'Quill': '/wiki/Quill',
+            'harbour': '/wiki/Harbour', 'bour': '/wiki/Bour',
+        })
+        text = 'Mara Quill left the harbour; Maradona and Quill did not.'
+        self.assertEqual(
+            [phrase for _, _, phrase in automaton.find(text)],
+            ['Mara Quill', 'harbour', 'Quill']
+        )
+
+    def test_automaton_links_each_phrase_once_and_escapes(self):
+        automaton = TermAutomaton({'Mara': '/wiki/Mara', 'ledger': '/wiki/Ledger'})
+        html, count = automaton.annotate('Mara & the ledger, then Mara again.')
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            html, '<a href="/wiki/Mara">Mara</a> &amp; the <a href="/wiki/Ledger">ledger</a>, then Mara again.'
+        )
+        self.assertEqual(extract_links(html), [('Mara', '/wiki/Mara'), ('ledger', '/wiki/Ledger')])
+
+    def test_index_links_invalidates_the_compiled_automaton(self):
+        self.assertEqual(len(story_automaton(self.story.id)), 0)
+        index_links({self.story.id: [('Mara', '/wiki/Mara'), ('of', '/wiki/Of')]})
+        self.assertEqual(story_automaton(self.story.id).terms, {'Mara': '/wiki/Mara'})
+
+        index_links({self.story.id: [('Mara', '/wiki/Mara_Quill')]})
+        self.assertEqual(story_automaton(self.story.id).terms, {'Mara': '/wiki/Mara_Quill'})
+        self.assertEqual(StoryTerm.objects.filter(story=self.story).count(), 1)
+
+    def test_matching_paragraph_skips_the_llm(self):
+        index_links({self.story.id: [('Mara', '/wiki/Mara'), ('ledger', '/wiki/Ledger')]})
+        paragraph = self.add_paragraph('Mara closed the ledger.', 1)
+
+        with mock.patch.object(tasks.client.chat.completions, 'create') as create:
+            tasks.analyze_and_add_links(paragraph.id)
+
+        create.assert_not_called()
+        paragraph.refresh_from_db()
+        self.assertEqual(
+            paragraph.text_with_links, '<a href="/wiki/Mara">Mara</a> closed the <a href="/wiki/Ledger">ledger</a>.'
+        )
+
+    def test_llm_links_are_indexed_for_later_paragraphs(self):
+        first = self.add_paragraph('Mara crossed the harbour with the ledger.', 1)
+        second = self.add_paragraph('Later the harbour was quiet and the ledger safe.', 2)
+        reply = 'Mara crossed the <a href="/wiki/Harbour">harbour</a> with the <a href="/wiki/Ledger">ledger</a>.'
+
+        with mock.patch.object(tasks.client.chat.completions, 'create') as create:
+            create.return_value = completion_response(reply)
+            tasks.analyze_and_add_links(first.id)
+            tasks.analyze_and_add_links(second.id)
+
+        self.assertEqual(create.call_count, 1)
+        second.refresh_from_db()
+        self.assertEqual(second.text_with_links.count('<a href='), 2)
+
+    def test_unsafe_llm_links_are_not_saved_or_indexed(self):
+        paragraph = self.add_paragraph('Mara rowed across the harbour with the ledger.', 1)
+        reply = (
+            'Mara rowed across the <a href="javascript:alert(1)">harbour</a> with the '
+            '<a href="/wiki/Ledger">ledger</a>.'
+        )
+        with mock.patch.object(tasks.client.chat.completions, 'create', return_value=completion_response(reply)):
+            self.assertIsNone(tasks.analyze_and_add_links(paragraph.id))
+
+        paragraph.refresh_from_db()
+        self.assertIsNone(paragraph.text_with_links)
+        self.assertFalse(StoryTerm.objects.exists())
+
+        index_links({self.story.id: [('harbour', 'javascript:alert(1)'), ('ledger', '/wiki/Ledger')]})
+        self.assertEqual(story_automaton(self.story.id).terms, {'ledger': '/wiki/Ledger'})
+
+    @override_settings(STORIES_MAX_CACHED_AUTOMATA=2)
+    def test_compiled_automata_are_bounded(self):
+        stories = [self.story.id] + [
+            Story.objects.create(title=f'Story {i}', description='', author=self.user).id for i in range(2)
+        ]
+        with mock.patch.dict(term_index._automata, clear=True):
+            for story_id in stories:
+                story_automaton(story_id)
+            self.assertEqual(list(term_index._automata), stories[1:])
+            story_automaton(stories[1])
+            story_automaton(stories[0])
+            self.assertEqual(list(term_index._automata), [stories[1], stories[0]])
+
+    def test_batches_only_send_unmatched_paragraphs(self):
+        index_links({self.story.id: [('Word1', '/wiki/Word1'), ('paragraph', '/wiki/Paragraph')]})
+        for i in range(4):
+            self.add_paragraph(f'Word{i} and the rest of paragraph {i}.', i + 1)
+        self.add_paragraph('Nothing known here.', 5)
+
+        with FakeOpenAIServer([], respond=link_first_words) as server:
+            client = OpenAI(base_url=server.base_url, api_key='sk-test', max_retries=0)
+            totals = analyze_links_in_batches(Paragraph.objects.filter(chapter=self.chapter), client=client)
+
+        # Only Word1's paragraph has two known terms
+        self.assertEqual((totals['local'], totals['annotated'], totals['requests']), (1, 5, 1))
+        self.assertEqual(len(json.loads(server.requests[0]['messages'][1]['content'])), 4)
+        self.assertIn('Nothing', story_automaton(self.story.id).terms)
+
+
+
+class SearchTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        texts = [
+            'The lighthouse keeper rowed out past the reef.',
+            'A storm broke over the lighthouse, and the lighthouse keeper lit the lamp.',
+            'The keeper of the ledger counted coins by candlelight.',
+            'Nothing happened at the harbour <today>.',
+        ]
+        with mock.patch('stories.signals.enqueue'):
+            self.paragraphs = [
+                Paragraph.objects.create(chapter=self.chapter, text=text, paragraph_number=i + 1, page=1)
+                for i, text in enumerate(texts)
+            ]
+
+    def search_ids(self, query, **kwargs):
+        return [result['id'] for result in search_paragraphs(query, **kwargs)[0]]
+
+    def test_tokenize_drops_case_punctuation_and_stopwords(self):
+        self.assertEqual(tokenize("The Keeper's lamp, and THE reef!"), ['keeper', 's', 'lamp', 'reef'])
+
+    def test_index_follows_text_changes(self):
+        paragraph = self.paragraphs[0]
+        self.assertEqual(self.search_ids('reef'), [paragraph.id])
+
+        paragraph.text = 'The keeper rowed out past the sandbar.'
+        paragraph.save()
+        self.assertEqual(self.search_ids('reef'), [])
+        self.assertEqual(self.search_ids('sandbar'), [paragraph.id])
+
+        paragraph.delete()
+        self.assertEqual(self.search_ids('sandbar'), [])
+
+    def test_link_updates_do_not_reindex(self):
+        paragraph = self.paragraphs[0]
+        with CaptureQueriesContext(connection) as queries:
+            paragraph.text_with_links = '<a href="/wiki/Reef">reef</a>'
+            paragraph.save(update_fields=['text_with_links'])
+        self.assertFalse([q for q in queries if 'stories_paragraphterm' in q['sql']])
+
+    def test_all_terms_must_match_and_better_matches_rank_first(self):
+        lighthouse_keeper = self.search_ids('lighthouse keeper')
+        self.assertEqual(lighthouse_keeper, [self.paragraphs[1].id, self.paragraphs[0].id])
+        self.assertEqual(self.search_ids('keeper ledger'), [self.paragraphs[2].id])
+        self.assertEqual(self.search_ids('keeper dragon'), [])
+        self.assertEqual(self.search_ids('the and'), [])
+
+    def test_endpoint_pages_and_highlights(self):
+        url = reverse('paragraph-search')
+        response = self.client.get(url, {'q': 'Keeper', 'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['has_next'])
+        self.assertEqual(len(response.data['results']), 2)
+        first = response.data['results'][0]
+        self.assertEqual((first['chapter'], first['story'], first['page']), (self.chapter.id, self.story.id, 1))
+        self.assertIn('<mark>keeper</mark>', first['snippet'])
+
+        response = self.client.get(url, {'q': 'keeper', 'page_size': 2, 'page': 2})
+        self.assertFalse(response.data['has_next'])
+        self.assertEqual(len(response.data['results']), 1)
+
+        response = self.client.get(url, {'q': 'harbour'})
+        self.assertEqual(
+            response.data['results'][0]['snippet'], 'Nothing happened at the <mark>harbour</mark> &lt;today&gt;.'
+        )
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {'q': 'keeper', 'page_size': 1000}).status_code, 400)
+
+    def test_snippet_is_centred_on_the_first_match(self):
+        text = ' '.join(['filler'] * 100) + ' the treasure lies here ' + ' '.join(['filler'] * 100)
+        excerpt = snippet(text, {'treasure'}, width=80)
+        self.assertTrue(excerpt.startswith('...') and excerpt.endswith('...'))
+        self.assertIn('<mark>treasure</mark>', excerpt)
+        self.assertLessEqual(len(excerpt), 80 + len('<mark></mark>') + 6)
+
+    def test_bulk_writes_are_indexed(self):
+        reef, = Paragraph.objects.bulk_create([
+            Paragraph(chapter=self.chapter, text='A hidden reef.', paragraph_number=10, page=2)
+        ])
+        self.assertEqual(self.search_ids('hidden'), [reef.id])
+
+        self.paragraphs[0].text = 'A hidden cove.'
+        Paragraph.objects.bulk_update([self.paragraphs[0]], ['text'])
+        Paragraph.objects.filter(pk=reef.pk).update(text='A sunken reef.')
+        self.assertEqual(self.search_ids('hidden'), [self.paragraphs[0].id])
+        self.assertEqual(self.search_ids('sunken'), [reef.id])
+        self.assertEqual(ParagraphTerm.objects.filter(term='lighthouse').count(), 1)
+
+    def test_rebuild_indexes_every_paragraph(self):
+        ParagraphTerm.objects.all().delete()
+        self.assertEqual(len(self.search_ids('lighthouse')), 0)
+        self.assertEqual(rebuild_search_index(batch_size=2), 4)
+        self.assertEqual(ParagraphTerm.objects.filter(term='lighthouse').count(), 2)
+
+    def test_admin_search_uses_the_index(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        admin_client = self.client_class()
+        admin_client.force_login(self.user)
+        url = reverse('admin:stories_paragraph_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = admin_client.get(url, {'q': 'lighthouse'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.paragraphs[0], self.paragraphs[1]])
+        text_scan = re.compile(r'"stories_paragraph"\."text"(::text)?\)? LIKE')
+        self.assertFalse([q for q in queries if text_scan.search(q['sql'])])
+        self.assertTrue([q for q in queries if 'stories_paragraphterm' in q['sql']])
+
+
+
+class KeysetPaginationTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        self.create_story()
+        with mock.patch('stories.signals.enqueue'):
+            self.paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+
+    def collect(self, url, params=None):
+        """
+        Follow next links from url, returning the pages' results and the
+        SQL of each page's query.
+        """
+        pages, statements = [], []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.json()['results'])
+            if not response.json()['next']:
+                return pages
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(response.json()['next'])
+            statements.extend(q['sql'] for q in queries)
+            self.assertFalse([sql for sql in statements if 'OFFSET' in sql])
+
+    def test_navigation_history_pages_in_view_order(self):
+        ParagraphView.objects.bulk_create(
+            ParagraphView(user=self.user, story=self.story, chapter=self.chapter, paragraph=self.paragraph, view_order=i)
+            for i in range(1, 12)
+        )
+        pages = self.collect(reverse('reading-progress-navigation-history'), {'story': self.story.id, 'page_size': 5})
+
+        self.assertEqual([len(page) for page in pages], [5, 5, 1])
+        self.assertEqual([view['view_order'] for page in pages for view in page], list(range(1, 12)))
+
+    def test_payments_newest_first_with_ties(self):
+        Payment.objects.bulk_create(Payment(user=self.user, paragraph=self.paragraph, amount=i) for i in range(7))
+        same_time = timezone.now()
+        Payment.objects.filter(amount__lt=4).update(payment_date=same_time)
+        Payment.objects.filter(amount__gte=4).update(payment_date=same_time - timedelta(days=1))
+
+        pages = self.collect(reverse('payment-list'), {'page_size': 3})
+
+        expected = list(Payment.objects.order_by('-payment_date', '-id').values_list('id', flat=True))
+        self.assertEqual([payment['id'] for page in pages for payment in page], expected)
+
+    def test_chapters_page_by_story_and_number(self):
+        other = Story.objects.create(title='Exodus', description='Another', author=self.user)
+        for number in range(2, 5):
+            Chapter.objects.create(story=self.story, title='More', chapter_number=number)
+            Chapter.objects.create(story=other, title='More', chapter_number=number - 1)
+
+        pages = self.collect(reverse('chapter-list'), {'page_size': 2})
+        self.assertEqual(
+            [(chapter['story'], chapter['chapter_number']) for page in pages for chapter in page],
+            [(self.story.id, n) for n in range(1, 5)] + [(other.id, n) for n in range(1, 4)]
+        )
+
+        pages = self.collect(reverse('story-chapters', args=[self.story.id]), {'page_size': 3})
+        self.assertEqual([chapter['chapter_number'] for page in pages for chapter in page], [1, 2, 3, 4])
+
+    def test_invalid_cursor(self):
+        url = reverse('story-list')
+        self.assertEqual(self.client.get(url, {'cursor': 'not a cursor'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'cursor': encode_cursor([1, 2])}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'cursor': encode_cursor(['one'])}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('payment-list'), {'cursor': encode_cursor(['soon', 1])}).status_code, 404)
+
+
+class BundleTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.client.force_login(self.user)
+        self.second = Chapter.objects.create(story=self.story, title='Exodus', chapter_number=2)
+        with mock.patch('stories.signals.enqueue'):
+            for chapter in (self.chapter, self.second):
+                for number in range(1, 4):
+                    Paragraph.objects.create(
+                        chapter=chapter, text=f'Paragraph {number}.', paragraph_number=number, page=(number + 1) // 2
+                    )
+
+    def fetch(self, params=None, **extra):
+        response = self.client.get(reverse('story-bundle', args=[self.story.id]), params, **extra)
+        if response.status_code != 200:
+            return response, None
+        body = b''.join(response.streaming_content)
+        if response.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return response, [json.loads(line) for line in body.decode().splitlines()]
+
+    def paragraph_ids(self, records):
+        return [record['id'] for record in records if record['type'] == 'paragraph']
+
+    def test_whole_story_gzipped(self):
+        response, records = self.fetch(HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(records[0]['type'], 'bundle')
+        self.assertEqual(records[0]['story']['title'], self.story.title)
+        self.assertEqual(records[0]['version'], response['X-Bundle-Version'])
+        self.assertFalse(records[0]['delta'])
+        self.assertEqual([record['chapter_number'] for record in records if record['type'] == 'chapter'], [1, 2])
+        expected = list(Paragraph.objects.order_by('chapter__chapter_number', 'page', 'paragraph_number').values_list(
+            'id', flat=True
+        ))
+        self.assertEqual(self.paragraph_ids(records), expected)
+        self.assertEqual(records[-1], {'type': 'end', 'paragraphs': 6})
+
+    def test_plain_without_accept_encoding(self):
+        response, records = self.fetch()
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(records[-1]['paragraphs'], 6)
+
+    def test_chapter_range(self):
+        _, records = self.fetch({'from_chapter': 2})
+        self.assertEqual([record['chapter_number'] for record in records if record['type'] == 'chapter'], [2])
+        self.assertEqual(
+            self.paragraph_ids(records),
+            list(self.second.paragraphs.order_by('page', 'paragraph_number').values_list('id', flat=True))
+        )
+        _, records = self.fetch({'to_chapter': 1})
+        self.assertEqual(len(self.paragraph_ids(records)), 3)
+        self.assertEqual(self.client.get(
+            reverse('story-bundle', args=[self.story.id]), {'from_chapter': 'one'}
+        ).status_code, 400)
+
+    def test_unchanged_version_is_not_modified(self):
+        response, _ = self.fetch()
+        version = response['X-Bundle-Version']
+
+        self.assertEqual(self.fetch(HTTP_IF_NONE_MATCH=response['ETag'])[0].status_code, 304)
+        self.assertEqual(self.fetch({'since': version})[0].status_code, 304)
+
+        Paragraph.objects.filter(chapter=self.second, paragraph_number=1).update(text='Edited.', updated_at=timezone.now())
+        response, _ = self.fetch(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['X-Bundle-Version'], version)
+
+    def test_delta_since_version(self):
+        response, _ = self.fetch()
+        version = response['X-Bundle-Version']
+        edited = self.chapter.paragraphs.get(paragraph_number=2)
+        edited.text = 'Edited.'
+        edited.save()
+        added = Paragraph.objects.create(chapter=self.second, text='Later.', paragraph_number=4, page=2)
+
+        response, records = self.fetch({'since': version})
+
+        self.assertTrue(records[0]['delta'])
+        self.assertEqual(records[0]['since'], version)
+        self.assertEqual(self.paragraph_ids(records), [edited.id, added.id])
+        self.assertEqual(
+            [record['text'] for record in records if record['type'] == 'paragraph'], ['Edited.', 'Later.']
+        )
+
+        # The delta's version picks up where it left off
+        self.assertEqual(self.fetch({'since': response['X-Bundle-Version']})[0].status_code, 304)
+
+    def test_renamed_chapter_and_story_change_the_version(self):
+        response, _ = self.fetch()
+        version = response['X-Bundle-Version']
+        Chapter.objects.filter(pk=self.second.pk).update(title='Leaving')
+
+        response, records = self.fetch({'since': version})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(records[0]['delta'])
+        self.assertEqual(self.paragraph_ids(records), [])
+        self.assertEqual([record['title'] for record in records if record['type'] == 'chapter'], ['Chapter One', 'Leaving'])
+
+        version = response['X-Bundle-Version']
+        self.story.description = 'Told again.'
+        self.story.save()
+        response, records = self.fetch(HTTP_IF_NONE_MATCH=f'"{version}"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(records[0]['story']['description'], 'Told again.')
+
+    def test_deletion_sends_full_bundle(self):
+        response, _ = self.fetch()
+        self.second.paragraphs.get(paragraph_number=3).delete()
+        Paragraph.objects.create(chapter=self.second, text='Replacement.', paragraph_number=3, page=2)
+
+        _, records = self.fetch({'since': response['X-Bundle-Version']})
+
+        self.assertFalse(records[0]['delta'])
+        self.assertEqual(len(self.paragraph_ids(records)), 6)
+
+        _, records = self.fetch({'since': 'not a version'})
+        self.assertFalse(records[0]['delta'])
+        self.assertEqual(len(self.paragraph_ids(records)), 6)
+
+
+class SlimSerializerTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.client.force_login(self.user)
+        with mock.patch('stories.signals.enqueue'):
+            self.paragraphs = [
+                Paragraph.objects.create(
+                    chapter=self.chapter, text=f'Paragraph {number}.', text_with_links=f'<p>{number}</p>',
+                    paragraph_number=number, page=1, nft_owner=self.user if number == 1 else None
+                )
+                for number in range(1, 4)
+            ]
+
+    def render(self, data):
+        return json.loads(JSONRenderer().render(data))
+
+    def test_values_serializer_matches_model_serializer(self):
+        Payment.objects.create(user=self.user, paragraph=self.paragraphs[0], amount=Decimal('1.50'))
+        for model, serializer_class in (
+            (Story, StorySerializer), (Chapter, ChapterSerializer), (Paragraph, ParagraphSerializer),
+            (Payment, PaymentSerializer),
+        ):
+            with self.subTest(model=model.__name__):
+                queryset = model.objects.order_by('id')
+                serializer = ValuesSerializer(model)
+                self.assertEqual(
+                    self.render(serializer.to_representation(serializer.values(queryset))),
+                    self.render(serializer_class(queryset, many=True).data)
+                )
+
+    def test_fast_renderer_matches_json_renderer(self):
+        data = {
+            'when': timezone.now(), 'amount': Decimal('2.50'), 'label': gettext_lazy('Story'),
+            'text': 'line\u2028separated \u00e9', 1: None, 'nested': [{'date': timezone.now().date()}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONRenderer().render(data, 'application/json; indent=2'),
+            JSONRenderer().render(data, 'application/json; indent=2')
+        )
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_list_endpoints_match_and_read_sparse_columns(self):
+        response = self.client.get(reverse('paragraph-list'))
+        self.assertEqual(response.json()['results'], self.render(ParagraphSerializer(self.paragraphs, many=True).data))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('paragraph-list'), {'fields': 'id,text'})
+        self.assertEqual(
+            response.json()['results'], [{'id': p.id, 'text': p.text} for p in self.paragraphs]
+        )
+        self.assertNotIn('text_with_links', queries[-1]['sql'])
+
+        response = self.client.get(reverse('story-chapters', args=[self.story.id]), {'fields': 'title'})
+        self.assertEqual(response.json()['results'], [{'title': self.chapter.title}])
+        response = self.client.get(reverse('chapter-list'), {'fields': 'chapter_number', 'page_size': 1})
+        self.assertEqual(response.json()['results'], [{'chapter_number': 1}])
+
+    def test_sparse_detail(self):
+        response = self.client.get(reverse('paragraph-detail', args=[self.paragraphs[0].id]), {'fields': 'id, nft_owner'})
+        self.assertEqual(response.json(), {'id': self.paragraphs[0].id, 'nft_owner': self.user.id})
+        response = self.client.get(reverse('story-detail', args=[self.story.id]), {'fields': 'title'})
+        self.assertEqual(response.json(), {'title': self.story.title})
+
+    def test_unknown_field(self):
+        for url in (
+            reverse('paragraph-list'), reverse('story-detail', args=[self.story.id]),
+            reverse('chapter-paragraphs', args=[self.chapter.id]),
+        ):
+            with self.subTest(url=url):
+                response = self.client.get(url, {'fields': 'id,secret'})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('secret', response.json()['fields'][0])
+
+    def test_sparse_chapter_page_has_its_own_etag(self):
+        url = reverse('chapter-paragraphs', args=[self.chapter.id])
+        full = self.client.get(url)
+        self.assertEqual(full.json()['results'], self.render(ParagraphSerializer(self.paragraphs, many=True).data))
+
+        response = self.client.get(url, {'fields': 'id'})
+        self.assertEqual(response.json(), {'results': [{'id': p.id} for p in self.paragraphs], 'has_next': False})
+        self.assertNotEqual(response['ETag'], full['ETag'])
+
+        self.assertEqual(self.client.get(url, {'fields': 'id'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get(url, {'fields': 'id,text'}, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+class PageIndexTests(StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.client.force_login(self.user)
+        self.paragraphs = {}
+        with mock.patch('stories.signals.enqueue'):
+            for page, number in ((1, 1), (1, 2), (2, 1), (1, 3), (3, 1), (3, 2)):
+                self.paragraphs[page, number] = Paragraph.objects.create(
+                    chapter=self.chapter, text=f'Page {page}, paragraph {number}.', page=page, paragraph_number=number
+                )
+
+    def entry(self, count, page, number):
+        return {'paragraphs': count, 'last_paragraph': self.paragraphs[page, number].id, 'last_number': number}
+
+    def test_index_follows_inserts(self):
+        self.chapter.refresh_from_db()
+        self.assertEqual(self.chapter.page_count, 3)
+        self.assertEqual(self.chapter.paragraph_count, 6)
+        self.assertEqual(self.chapter.page_index, [self.entry(3, 1, 3), self.entry(1, 2, 1), self.entry(2, 3, 2)])
+
+        # A paragraph numbered before the page's last doesn't replace it
+        last = Paragraph.objects.create(chapter=self.chapter, text='Later.', page=4, paragraph_number=5)
+        Paragraph.objects.create(chapter=self.chapter, text='Inserted.', page=4, paragraph_number=4)
+        self.chapter.refresh_from_db()
+        self.assertEqual(self.chapter.page_index[3], {'paragraphs': 2, 'last_paragraph': last.id, 'last_number': 5})
+
+    def test_index_follows_deletes(self):
+        self.paragraphs[1, 3].delete()
+        Paragraph.objects.filter(chapter=self.chapter, page=3).delete()
+        self.chapter.refresh_from_db()
+
+        self.assertEqual(self.chapter.page_count, 2)
+        self.assertEqual(self.chapter.paragraph_count, 3)
+        self.assertEqual(self.chapter.page_index, [self.entry(2, 1, 2), self.entry(1, 2, 1)])
+
+        # Deleting the chapter doesn't try to maintain its index
+        self.chapter.delete()
+        self.assertFalse(Paragraph.objects.exists())
+
+    def test_serialized_with_chapter(self):
+        data = self.client.get(reverse('chapter-detail', args=[self.chapter.id])).json()
+        self.assertEqual((data['page_count'], data['paragraph_count']), (3, 6))
+        self.assertEqual(data['page_index'][2], self.entry(2, 3, 2))
+        results = self.client.get(reverse('story-chapters', args=[self.story.id])).json()['results']
+        self.assertEqual(results[0]['page_index'], data['page_index'])
+
+    def test_navigation_reads_the_index(self):
+        url = reverse('chapter-paragraphs', args=[self.chapter.id])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.get(url, {'page': 2}).json()['has_next'])
+        self.assertFalse([query for query in queries if 'stories_paragraph"."page" = 3' in query['sql']])
+        self.assertFalse(self.client.get(url, {'page': 3}).json()['has_next'])
+
+        generated = self.paragraphs[1, 1]
+        with mock.patch('stories.views.generate_paragraph_once', return_value=generated) as generate:
+            self.client.post(reverse('chapter-generate-paragraph', args=[self.chapter.id]))
+            self.client.post(reverse('chapter-generate-paragraph', args=[self.chapter.id]) + '?page=1')
+            self.client.post(reverse('chapter-generate-paragraph', args=[self.chapter.id]) + '?page=9')
+        self.assertEqual(
+            [call.args for call in generate.call_args_list],
+            [(self.chapter.id, self.paragraphs[3, 2].id), (self.chapter.id, self.paragraphs[1, 3].id), (self.chapter.id, None)]
+        )
+
+    def test_index_follows_bulk_writes_and_moves(self):
+        other = Chapter.objects.create(story=self.story, title='Chapter Two', chapter_number=2)
+        bulk = Paragraph.objects.bulk_create(
+            Paragraph(chapter=self.chapter, text='Bulk.', page=4, paragraph_number=number) for number in (1, 2)
+        )
+        self.chapter.refresh_from_db()
+        self.assertEqual((self.chapter.page_count, self.chapter.paragraph_count), (4, 8))
+        self.assertEqual(last_paragraph_on_page(self.chapter), bulk[1].id)
+
+        # Moved by a queryset update, then by a save
+        Paragraph.objects.filter(chapter=self.chapter, page=4).update(page=2, paragraph_number=F('paragraph_number') + 1)
+        self.paragraphs[3, 2].chapter = other
+        self.paragraphs[3, 2].page = 1
+        self.paragraphs[3, 2].save()
+
+        self.chapter.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.chapter.page_index, [
+            self.entry(3, 1, 3), {'paragraphs': 3, 'last_paragraph': bulk[1].id, 'last_number': 3}, self.entry(1, 3, 1)
+        ])
+        self.assertEqual(other.page_index, [self.entry(1, 3, 2)])
+        self.assertEqual(rebuild_page_index(), 0)
+
+        # Saves that can't move a paragraph don't look it up
+        with CaptureQueriesContext(connection) as queries:
+            self.paragraphs[1, 1].save(update_fields=['text'])
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT "stories_paragraph"."chapter_id"')])
+        with CaptureQueriesContext(connection) as queries:
+            self.paragraphs[1, 1].save()
+        self.assertTrue([query for query in queries if query['sql'].startswith('SELECT "stories_paragraph"."chapter_id"')])
+
+    def test_rebuild_repairs_drift(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {Paragraph._meta.db_table} (chapter_id, text, page, paragraph_number, is_locked, updated_at)"
+                " VALUES (%s, 'Raw.', 4, 1, false, %s), (%s, 'Raw.', 4, 2, false, %s)",
+                [self.chapter.id, timezone.now(), self.chapter.id, timezone.now()]
+            )
+        empty = Chapter.objects.create(story=self.story, title='Empty', chapter_number=2)
+        Chapter.objects.filter(id=empty.id).update(page_count=1, paragraph_count=1, page_index=[{'paragraphs': 1}])
+
+        out = StringIO()
+        call_command('rebuild_page_index', stdout=out)
+        self.assertIn('Repaired 2', out.getvalue())
+
+        self.chapter.refresh_from_db()
+        empty.refresh_from_db()
+        self.assertEqual((self.chapter.page_count, self.chapter.paragraph_count), (4, 8))
+        self.assertEqual(self.chapter.page_index[3]['last_number'], 2)
+        self.assertEqual((empty.page_count, empty.paragraph_count, empty.page_index), (0, 0, []))
+        self.assertEqual(rebuild_page_index(), 0)
+
+
+class QueryBudgetMixin:
+    """
+    Assert that an endpoint runs a fixed number of queries however much data
+    it covers. Subclasses provide grow(size), which adds size more rows of
+    everything the endpoints read.
+    """
+    budget_sizes = (1, 5, 20)
+
+    def assertQueryBudget(self, budget, request):
+        for size in self.budget_sizes:
+            self.grow(size)
+            with self.subTest(size=size), CaptureQueriesContext(connection) as queries:
+                response = request()
+                self.assertLess(response.status_code, 400)
+            self.assertEqual(
+                len(queries), budget,
+                f"{len(queries)} queries with {size} more rows, budget is {budget}:\n" +
+                "\n".join(query['sql'] for query in queries.captured_queries)
+            )
+
+
+class EndpointQueryBudgetTests(QueryBudgetMixin, StoryTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.create_story()
+        self.client.force_login(self.user)
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.paragraph = Paragraph.objects.create(chapter=self.chapter, text='It began.', paragraph_number=1, page=1)
+        self.nft = NFT.objects.create(paragraph=self.paragraph, owner=self.user)
+        self.progress = ReadingProgress.objects.create(user=self.user, story=self.story)
+
+    def grow(self, size):
+        for _ in range(size):
+            story = Story.objects.create(title='More', description='More', author=self.user)
+            chapter = Chapter.objects.create(story=story, title='More', chapter_number=1)
+            paragraph = Paragraph.objects.create(chapter=chapter, text='More.', paragraph_number=1, page=1, nft_owner=self.user)
+            Chapter.objects.create(story=self.story, title='More', chapter_number=Chapter.objects.filter(story=self.story).count() + 1)
+            Paragraph.objects.create(
+                chapter=self.chapter, text='More.', page=1,
+                paragraph_number=Paragraph.objects.filter(chapter=self.chapter).count() + 1
+            )
+            NFT.objects.create(paragraph=paragraph, owner=self.user)
+            Payment.objects.create(user=self.user, paragraph=self.paragraph, amount=1)
+            Payment.objects.create(user=self.user, paragraph=paragraph, amount=1)
+            ReadingProgress.objects.create(user=self.user, story=story).viewed_paragraphs.add(paragraph)
+            self.progress.viewed_paragraphs.add(paragraph)
+            self.client.get(reverse('paragraph-detail', args=[paragraph.id]))
+        cache.clear()
+
+    def test_story_endpoints(self):
+        self.assertQueryBudget(1, lambda: self.client.get(reverse('story-list')))
+        self.assertQueryBudget(2, lambda: self.client.get(reverse('story-chapters', args=[self.story.id])))
+
+    def test_story_bundle(self):
+        def fetch():
+            response = self.client.get(reverse('story-bundle', args=[self.story.id]))
+            b''.join(response.streaming_content)
+            return response
+        # Story, version (paragraph totals and the chapter outline), chapters
+        # and paragraphs
+        self.assertQueryBudget(5, fetch)
+
+    def test_chapter_endpoints(self):
+        self.assertQueryBudget(1, lambda: self.client.get(reverse('chapter-list')))
+        # Chapter, with its page index, and the page's paragraphs
+        self.assertQueryBudget(2, lambda: self.client.get(reverse('chapter-paragraphs', args=[self.chapter.id])))
+
+    def test_paragraph_endpoints(self):
+        self.assertQueryBudget(1, lambda: self.client.get(reverse('paragraph-list')))
+        # Paragraph read plus the view and reading progress writes
+        self.assertQueryBudget(8, lambda: self.client.get(reverse('paragraph-detail', args=[self.paragraph.id])))
+        # Term frequencies, corpus statistics, ranking and the matched paragraphs
+        self.assertQueryBudget(5, lambda: self.client.get(reverse('paragraph-search'), {'q': 'more'}))
+
+    def test_reading_progress_endpoints(self):
+        self.assertQueryBudget(2, lambda: self.client.get(reverse('reading-progress-list')))
+        self.assertQueryBudget(2, lambda: self.client.get(
+            reverse('reading-progress-viewed-paragraphs'), {'story': self.story.id}
+        ))
+        self.assertQueryBudget(1, lambda: self.client.get(
+            reverse('reading-progress-navigation-history'), {'story': self.story.id}
+        ))
+
+    def test_payment_and_nft_endpoints(self):
+        self.assertQueryBudget(1, lambda: self.client.get(reverse('payment-list')))
+        self.assertQueryBudget(1, lambda: self.client.get(reverse('nft-list')))
+        self.assertQueryBudget(2, lambda: self.client.get(reverse('nft-revenue', args=[self.nft.id])))
+        self.assertQueryBudget(1, lambda: self.client.get(reverse('nft-portfolio')))
+
+    def test_admin_changelists(self):
+        admin_client = self.client_class()
+        admin_client.force_login(self.user)
+        # Session and user, count, list query, filter choices, related lookups
+        budgets = {Story: 5, Chapter: 5, Paragraph: 7, ReadingProgress: 6, Payment: 5, NFT: 6, ParagraphView: 7}
+        for model, budget in budgets.items():
+            with self.subTest(model=model.__name__):
+                url = reverse(f'admin:stories_{model._meta.model_name}_changelist')
+                self.assertQueryBudget(budget, lambda: admin_client.get(url))
@@ -0,0 +1,304 @@
+import atexit
+import logging
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .bitmaps import ParagraphBitmap
+from .models import Paragraph, ParagraphView, ReadingProgress
+from .sequences import allocate_view_order
+
+logger = logging.getLogger(__name__)
+
+# viewed_at defaults to when the event is written, for callers that don't
+# record when the paragraph was read
+ViewEvent = namedtuple(
+    'ViewEvent', ['user_id', 'story_id', 'chapter_id', 'paragraph_id', 'viewed_at'], defaults=[None]
+)
+
+
+def resolve_progress_ids(pairs):
+    """
+    Map (user_id, story_id) pairs to ReadingProgress ids, creating any rows
+    that don't exist yet. Costs two queries plus one insert when rows are missing.
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return {}
+
+    def lookup():
+        rows = ReadingProgress.objects.filter(
+            user_id__in={user_id for user_id, _ in pairs},
+            story_id__in={story_id for _, story_id in pairs}
+        ).values_list('user_id', 'story_id', 'id')
+        return {(user_id, story_id): pk for user_id, story_id, pk in rows if (user_id, story_id) in pairs}
+
+    progress_ids = lookup()
+    missing = pairs - progress_ids.keys()
+    if missing:
+        ReadingProgress.objects.bulk_create(
+            [ReadingProgress(user_id=user_id, story_id=story_id) for user_id, story_id in missing],
+            ignore_conflicts=True
+        )
+        progress_ids = lookup()
+    return progress_ids
+
+
+def uses_bitmap_storage():
+    return getattr(settings, 'STORIES_VIEWED_PARAGRAPHS_STORAGE', 'm2m') == 'bitmap'
+
+
+def add_viewed_paragraphs(links):
+    """
+    Add (progress_id, paragraph_id) links to each ReadingProgress's viewed
+    set, in whichever storage is configured. With the M2M this is a single
+    insert that skips existing links; with bitmaps the affected progress rows
+    are locked, updated in memory and written back with one bulk update.
+    """
+    links = set(links)
+    if not links:
+        return
+
+    if not uses_bitmap_storage():
+        Through = ReadingProgress.viewed_paragraphs.through
+        Through.objects.bulk_create(
+            [Through(readingprogress_id=progress_id, paragraph_id=paragraph_id) for progress_id, paragraph_id in links],
+            ignore_conflicts=True
+        )
+        return
+
+    by_progress = defaultdict(set)
+    for progress_id, paragraph_id in links:
+        by_progress[progress_id].add(paragraph_id)
+
+    with transaction.atomic():
+        progresses = list(
+            ReadingProgress.objects.select_for_update().filter(id__in=by_progress).order_by('id').only('id', 'viewed_bitmap')
+        )
+        for progress in progresses:
+            bitmap = ParagraphBitmap.from_bytes(progress.viewed_bitmap)
+            bitmap.update(by_progress[progress.id])
+            progress.viewed_bitmap = bitmap.to_bytes()
+        ReadingProgress.objects.bulk_update(progresses, ['viewed_bitmap'])
+
+
+def sync_viewed_paragraphs(to=None, batch_size=1000):
+    """
+    Copy viewed paragraphs recorded in the other storage into the configured
+    one, or into ``to`` ('m2m' or 'bitmap'). Only ever adds, so it is safe to
+    rerun; run it after changing STORIES_VIEWED_PARAGRAPHS_STORAGE, as views
+    recorded before the switch are otherwise hidden. Returns the number of
+    progress rows updated.
+    """
+    to = to or ('bitmap' if uses_bitmap_storage() else 'm2m')
+    Through = ReadingProgress.viewed_paragraphs.through
+    if to == 'bitmap':
+        ids = Through.objects.values_list('readingprogress_id', flat=True).distinct().order_by('readingprogress_id')
+    else:
+        ids = ReadingProgress.objects.filter(viewed_bitmap__isnull=False).order_by('id').values_list('id', flat=True)
+    ids = list(ids)
+
+    synced = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with transaction.atomic():
+            progresses = list(
+                ReadingProgress.objects.select_for_update().filter(id__in=batch).order_by('id').only('id', 'viewed_bitmap')
+            )
+            links = defaultdict(set)
+            for progress_id, paragraph_id in Through.objects.filter(readingprogress_id__in=batch).values_list(
+                'readingprogress_id', 'paragraph_id'
+            ):
+                links[progress_id].add(paragraph_id)
+
+            if to == 'bitmap':
+                changed = []
+                for progress in progresses:
+                    bitmap = ParagraphBitmap.from_bytes(progress.viewed_bitmap)
+                    if links[progress.id] - set(bitmap):
+                        bitmap.update(links[progress.id])
+                        progress.viewed_bitmap = bitmap.to_bytes()
+                        changed.append(progress)
+                ReadingProgress.objects.bulk_update(changed, ['viewed_bitmap'])
+                synced += len(changed)
+            else:
+                missing = {
+                    progress.id: set(ParagraphBitmap.from_bytes(progress.viewed_bitmap)) - links[progress.id]
+                    for progress in progresses
+                }
+                # Bitmaps have no foreign key, so skip paragraphs deleted since
+                existing = set(Paragraph.objects.filter(
+                    id__in=set().union(*missing.values())
+                ).values_list('id', flat=True))
+                new_links = [
+                    Through(readingprogress_id=progress_id, paragraph_id=paragraph_id)
+                    for progress_id, paragraph_ids in missing.items()
+                    for paragraph_id in paragraph_ids & existing
+                ]
+                Through.objects.bulk_create(new_links, ignore_conflicts=True)
+                synced += len({link.readingprogress_id for link in new_links})
+    return synced
+
+
+def viewed_paragraph_set(progress):
+    """
+    The paragraphs a ReadingProgress has viewed, as a ParagraphBitmap.
+    """
+    if uses_bitmap_storage():
+        return ParagraphBitmap.from_bytes(progress.viewed_bitmap)
+    return ParagraphBitmap(progress.viewed_paragraphs.values_list('id', flat=True))
+
+
+def write_view_events(events):
+    """
+    Persist a batch of paragraph views: the ParagraphView rows and the matching
+    reading progress. The number of queries depends on the number of distinct
+    users in the batch, not on the number of events.
+    """
+    by_user = defaultdict(list)
+    for event in events:
+        by_user[event.user_id].append(event)
+
+    now = timezone.now()
+    with transaction.atomic():
+        views = []
+        # Allocate in a stable order so concurrent flushers can't deadlock on
+        # each other's view counters
+        for user_id in sorted(by_user):
+            user_events = by_user[user_id]
+            first_order = allocate_view_order(user_id, len(user_events))
+            views.extend(
+                ParagraphView(
+                    user_id=user_id,
+                    story_id=event.story_id,
+                    chapter_id=event.chapter_id,
+                    paragraph_id=event.paragraph_id,
+                    viewed_at=event.viewed_at or now,
+                    view_order=first_order + i
+                )
+                for i, event in enumerate(user_events)
+            )
+        ParagraphView.objects.bulk_create(views)
+
+        progress_ids = resolve_progress_ids((event.user_id, event.story_id) for event in events)
+        add_viewed_paragraphs(
+            (progress_ids[(event.user_id, event.story_id)], event.paragraph_id) for event in events
+        )
+
+
+class ViewEventBuffer:
+    """
+    In-process write-behind buffer for paragraph views. Events are flushed by
+    a background thread every flush_interval seconds, or sooner once
+    flush_size events are waiting, and on interpreter shutdown. A stopped
+    buffer can be started again.
+    """
+
+    def __init__(self, flush_interval=0.5, flush_size=500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.events = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.exit_registered = False
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+            full = len(self.events) >= self.flush_size
+        if full:
+            self.wakeup.set()
+
+    def start(self):
+        """
+        Start the flusher thread if it isn't running yet.
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name='view-event-flusher', daemon=True)
+            self.thread.start()
+            register_exit, self.exit_registered = not self.exit_registered, True
+        if register_exit:
+            atexit.register(self.stop)
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                close_old_connections()
+                self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        """
+        Write out everything buffered so far. Returns the number of events written.
+        """
+        with self.lock:
+            events, self.events = self.events, []
+        if not events:
+            return 0
+
+        try:
+            write_view_events(events)
+            return len(events)
+        except Exception as e:
+            logger.error(f"Failed to flush {len(events)} view events, retrying individually: {e}", exc_info=True)
+
+        # Isolate bad events (e.g. a paragraph deleted since it was read) so
+        # they don't hold back the rest of the batch. Anything else, such as
+        # a lost connection, leaves the event queued for the next flush.
+        written = 0
+        for i, event in enumerate(events):
+            try:
+                write_view_events([event])
+                written += 1
+            except IntegrityError as e:
+                logger.error(f"Dropping view event {event}: {e}")
+            except Exception as e:
+                logger.warning(f"Requeuing {len(events) - i} view events: {e}")
+                with self.lock:
+                    self.events[:0] = events[i:]
+                break
+        return written
+
+    def stop(self):
+        """
+        Stop the flusher thread and write any remaining events.
+        """
+        self.stopping.set()
+        self.wakeup.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=10)
+        with self.lock:
+            if thread is self.thread and (thread is None or not thread.is_alive()):
+                self.thread = None
+        self.wakeup.clear()
+        self.flush()
+
+
+view_buffer = ViewEventBuffer(
+    flush_interval=getattr(settings, 'STORIES_VIEW_FLUSH_INTERVAL', 0.5),
+    flush_size=getattr(settings, 'STORIES_VIEW_FLUSH_SIZE', 500),
+)
+
+
+def record_view(event):
+    """
+    Record a paragraph view. With STORIES_BUFFER_VIEW_EVENTS enabled the write
+    is deferred to the background flusher; otherwise it happens immediately.
+    """
+    if getattr(settings, 'STORIES_BUFFER_VIEW_EVENTS', False):
+        view_buffer.start()
+        view_buffer.add(event)
+    else:
+        write_view_events([event])
@@ -0,0 +1,79 @@
+import hashlib
+from collections import namedtuple
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .cache import invalidate_chapter_pages
+from .ledger import record_payment
+from .models import Paragraph, Payment, UnlockRequest
+
+UnlockResult = namedtuple('UnlockResult', ['status', 'body', 'replayed'])
+
+
+def request_fingerprint(paragraph_id, amount):
+    return hashlib.sha256(f"{paragraph_id}:{amount}".encode()).hexdigest()
+
+
+def claim_idempotency_key(user, key, paragraph_id, fingerprint):
+    """
+    Insert the UnlockRequest row for key, or lock and return the existing one.
+    A concurrent request holding the same key blocks on the unique index until
+    it commits, so by the time the existing row is read it holds a response.
+    Returns (unlock_request, created).
+    """
+    try:
+        with transaction.atomic():
+            return UnlockRequest.objects.create(
+                user=user, key=key, paragraph_id=paragraph_id, fingerprint=fingerprint
+            ), True
+    except IntegrityError:
+        return UnlockRequest.objects.select_for_update().get(user=user, key=key), False
+
+
+def unlock_paragraph(user, paragraph, amount, idempotency_key=None):
+    """
+    Charge user amount to unlock paragraph. The paragraph is flipped with a
+    conditional UPDATE, so of any number of concurrent unlocks exactly one
+    sees is_locked and records a payment; the rest get "already unlocked".
+
+    With an idempotency key the outcome is stored alongside the request
+    fingerprint and replayed for retries.
+    """
+    fingerprint = request_fingerprint(paragraph.id, amount)
+    with transaction.atomic():
+        if idempotency_key:
+            unlock_request, created = claim_idempotency_key(user, idempotency_key, paragraph.id, fingerprint)
+            if not created:
+                if unlock_request.fingerprint != fingerprint:
+                    return UnlockResult(
+                        422, {"detail": "Idempotency-Key was already used for a different request"}, False
+                    )
+                return UnlockResult(unlock_request.response_status, unlock_request.response_body, True)
+
+        flipped = Paragraph.objects.filter(id=paragraph.id, is_locked=True).update(
+            is_locked=False, updated_at=timezone.now()
+        )
+        payment = None
+        if flipped:
+            # Record payment and add it to the paragraph's revenue ledger
+            payment = record_payment(Payment(
+                user=user,
+                paragraph=paragraph,
+                amount=amount,
+                successful=True
+            ))
+
+            # update() skips the post_save signal that normally drops the cached page
+            chapter_id, page = paragraph.chapter_id, paragraph.page
+            transaction.on_commit(lambda: invalidate_chapter_pages(chapter_id, [page]))
+            result = UnlockResult(200, {"detail": "Paragraph unlocked successfully", "payment": payment.id}, False)
+        else:
+            result = UnlockResult(400, {"detail": "Paragraph already unlocked"}, False)
+
+        if idempotency_key:
+            unlock_request.payment = payment
+            unlock_request.response_status = result.status
+            unlock_request.response_body = result.body
+            unlock_request.save(update_fields=['payment', 'response_status', 'response_body'])
+    return result
@@ -3,79 +3,225 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.shortcuts import get_object_or_404
-from .models import Story, Chapter, Paragraph, ReadingProgress, Payment, NFT, ParagraphView, Reader
-from .serializers import StorySerializer, ChapterSerializer, ParagraphSerializer, ReadingProgressSerializer, PaymentSerializer, NFTSerializer
+from .models import Story, Chapter, Paragraph, ReadingProgress, Payment, NFT, ParagraphView, Reader, RevenueLedger
+from .serializers import StorySerializer, ChapterSerializer, ParagraphSerializer, ReadingProgressSerializer, PaymentSerializer, NFTSerializer, ValuesSerializer, requested_fields, sparse
 from django.views.generic import TemplateView
-from django.db.models import Max
-from .tasks import generate_next_paragraph, generate_next_page, create_wallet
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import parse_etags
+from rest_framework.utils.encoders import JSONEncoder
+from .bundles import bundle_querysets, bundle_records, bundle_version, changed_since, gzip_stream, ndjson
+from .cache import get_chapter_page, set_chapter_page, variant_etag
+from .coalescing import generate_paragraph_once, stream_paragraph_once
+from .ledger import portfolio
+from .page_index import has_page, last_paragraph_on_page
+from .pagination import KeysetPagination
+from .renderers import READ_RENDERERS, STREAM_RENDERERS
+from .search import search_paragraphs
+from .speculation import speculate, speculation_enabled
+from .unlocks import unlock_paragraph
+from .wallets import provision_wallet
+from .tracking import ViewEvent, record_view, add_viewed_paragraphs, resolve_progress_ids, uses_bitmap_storage, viewed_paragraph_set
+from .tasks import generate_next_page, stream_next_page, create_wallet
 from django.contrib.auth import login
 from django.contrib.auth import get_user_model
+import base64
+import json
 import logging
+from decimal import Decimal, InvalidOperation
 
 logger = logging.getLogger(__name__)
 
-class StoryViewSet(viewsets.ReadOnlyModelViewSet):
+MAX_MARK_VIEWED_BATCH = 1000
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+MAX_SEARCH_PAGE_SIZE = 100
+
+
+def sse_event(event, data):
+    """
+    Format a single server-sent event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n"
+
+
+def paragraph_event_stream(token_stream):
+    """
+    Relay a paragraph generation stream as server-sent events: one 'token' event
+    per chunk of text, then a 'paragraph' event with the saved paragraph.
+    """
+    try:
+        while True:
+            yield sse_event('token', {'text': next(token_stream)})
+    except StopIteration as done:
+        yield sse_event('paragraph', ParagraphSerializer(done.value).data)
+    except Exception as e:
+        logger.error(f"Paragraph stream failed: {str(e)}", exc_info=True)
+        yield sse_event('error', {'error': f"Failed to generate paragraph: {str(e)}"})
+
+
+def event_stream_response(events):
+    """
+    Wrap an iterable of server-sent events in an unbuffered streaming response.
+    """
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Stop proxies from buffering the stream
+    return response
+
+
+class ValuesListMixin:
+    """
+    List from values() rows through ValuesSerializer rather than from model
+    instances through serializer_class. The output is the same, with ?fields=
+    limiting both the columns read and the fields returned.
+    """
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = ValuesSerializer(
+            queryset.model, requested_fields(request, ValuesSerializer.field_names(queryset.model))
+        )
+        rows = self.paginate_queryset(serializer.values(queryset, *self.keyset_ordering))
+        return self.get_paginated_response(serializer.to_representation(rows))
+
+
+class StoryViewSet(ValuesListMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing stories.
     """
     queryset = Story.objects.all()
     serializer_class = StorySerializer
+    renderer_classes = READ_RENDERERS
+    pagination_class = KeysetPagination
+    keyset_ordering = ('id',)
 
     @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
     def chapters(self, request, pk=None):
         story = self.get_object()
-        chapters = story.chapters.all()
-        serializer = ChapterSerializer(chapters, many=True)
-        return Response(serializer.data)
+        serializer = ValuesSerializer(Chapter, requested_fields(request, ValuesSerializer.field_names(Chapter)))
+        paginator = KeysetPagination(ordering=('chapter_number',))
+        chapters = paginator.paginate_queryset(
+            serializer.values(story.chapters.all(), 'chapter_number'), request, view=self
+        )
+        return paginator.get_paginated_response(serializer.to_representation(chapters))
+
+    @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
+    def bundle(self, request, pk=None):
+        """
+        The whole story, or chapters from_chapter to to_chapter, in one
+        response: newline-delimited JSON records, gzipped when the client
+        accepts it. The response carries the bundle's version as its ETag.
+        Passing a previous version as since returns the story, its chapters
+        and only the paragraphs added or edited after it, or the full bundle
+        again (with delta false) if paragraphs have been deleted since.
+        """
+        story = self.get_object()
+        try:
+            chapter_range = [
+                int(request.query_params[name]) if request.query_params.get(name) else None
+                for name in ('from_chapter', 'to_chapter')
+            ]
+        except ValueError:
+            return Response({"detail": "Invalid chapter number"}, status=status.HTTP_400_BAD_REQUEST)
+
+        chapters, paragraphs = bundle_querysets(story.id, *chapter_range)
+        version = bundle_version(story, chapters, paragraphs)
+        headers = {'ETag': f'"{version}"', 'X-Bundle-Version': version, 'Vary': 'Accept-Encoding'}
+        since = request.query_params.get('since')
+        if_none_match = request.headers.get('If-None-Match')
+        if since == version or (if_none_match and headers['ETag'] in parse_etags(if_none_match)):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        changed = changed_since(paragraphs, since) if since else None
+        stream = ndjson(bundle_records(
+            story, chapters, paragraphs if changed is None else changed, version, since, delta=changed is not None
+        ))
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            response = StreamingHttpResponse(gzip_stream(stream), content_type='application/x-ndjson')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = StreamingHttpResponse(stream, content_type='application/x-ndjson')
+        for name, value in headers.items():
+            response[name] = value
+        return response
 
 
-class ChapterViewSet(viewsets.ReadOnlyModelViewSet):
+class ChapterViewSet(ValuesListMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing chapters of a story.
     """
     queryset = Chapter.objects.all()
     serializer_class = ChapterSerializer
+    renderer_classes = READ_RENDERERS
+    pagination_class = KeysetPagination
+    keyset_ordering = ('story_id', 'chapter_number')
 
     @action(detail=True, methods=['get'], permission_classes=[IsAuthenticated])
     def paragraphs(self, request, pk=None):
-        chapter = self.get_object()
-        page = request.query_params.get('page', 1)
-        paragraphs = chapter.paragraphs.filter(page=page)
-        
-        # Add pagination information
-        has_next = chapter.paragraphs.filter(page=int(page) + 1).exists()
-        
-        serializer = ParagraphSerializer(paragraphs, many=True)
-        return Response({
-            'results': serializer.data,
-            'has_next': has_next
-        })
+        """
+        One page of a chapter's paragraphs. Pages are cached until a paragraph
+        on them changes, and carry an ETag so clients can revalidate with
+        If-None-Match; a matching tag is answered with 304 straight from the cache.
+
+        With STORIES_SPECULATIVE_GENERATION on, reading the last page queues
+        generation of a draft of the next paragraph.
+        """
+        try:
+            page = int(request.query_params.get('page', 1))
+        except ValueError:
+            return Response({"detail": "Invalid page"}, status=status.HTTP_400_BAD_REQUEST)
+
+        fields = requested_fields(request, ValuesSerializer.field_names(Paragraph))
+
+        entry = get_chapter_page(pk, page)
+        if entry is None:
+            chapter = self.get_object()
+            serializer = ValuesSerializer(Paragraph)
+            paragraphs = serializer.values(chapter.paragraphs.filter(page=page))
+
+            # Add pagination information
+            has_next = has_page(chapter, page + 1)
+
+            entry = set_chapter_page(chapter.id, page, {
+                'results': serializer.to_representation(paragraphs),
+                'has_next': has_next
+            })
+
+        if speculation_enabled() and entry['data']['results'] and not entry['data']['has_next']:
+            speculate(int(pk), entry['data']['results'][-1]['id'])
+
+        etag = entry['etag'] if fields is None else variant_etag(entry['etag'], ','.join(fields))
+        headers = {'ETag': etag}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in parse_etags(if_none_match)):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        if fields is None:
+            return Response(entry['data'], headers=headers)
+        return Response(dict(entry['data'], results=sparse(entry['data']['results'], fields)), headers=headers)
+
+    def get_last_paragraph_id(self, chapter, request):
+        """
+        Find the paragraph that new generated text should follow.
+        """
+        # Get the current page from query params or default to the last page,
+        # and its last paragraph from the chapter's page index
+        current_page = request.query_params.get('page')
+        return last_paragraph_on_page(chapter, int(current_page) if current_page else None)
 
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def generate_paragraph(self, request, pk=None):
         """
-        Generate a new paragraph for the chapter using AI.
+        Generate a new paragraph for the chapter using AI, or publish the draft
+        generated ahead of time if there is one. Concurrent requests to extend
+        the same paragraph all get the one paragraph generated for it.
         """
         chapter = self.get_object()
-        
-        # Get the current page from query params or default to the last page
-        current_page = request.query_params.get('page')
-        if current_page:
-            current_page = int(current_page)
-        else:
-            # Find the last page for this chapter
-            last_page = chapter.paragraphs.aggregate(Max('page'))['page__max'] or 1
-            current_page = last_page
-
-        # Get the last paragraph on the current page
-        last_paragraph = chapter.paragraphs.filter(
-            page=current_page
-        ).order_by('-paragraph_number').first()
-        
-        last_paragraph_id = last_paragraph.id if last_paragraph else None
+        last_paragraph_id = self.get_last_paragraph_id(chapter, request)
 
         try:
-            new_paragraph = generate_next_paragraph(chapter.id, last_paragraph_id)
+            new_paragraph = generate_paragraph_once(chapter.id, last_paragraph_id)
             serializer = ParagraphSerializer(new_paragraph)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         except Exception as e:
@@ -102,68 +248,116 @@ class ChapterViewSet(viewsets.ReadOnlyModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated], renderer_classes=STREAM_RENDERERS)
+    def generate_paragraph_stream(self, request, pk=None):
+        """
+        Streaming variant of generate_paragraph. Tokens are sent as server-sent
+        events while the model writes, followed by the saved paragraph.
+        Concurrent requests are coalesced as in generate_paragraph.
+        """
+        chapter = self.get_object()
+        last_paragraph_id = self.get_last_paragraph_id(chapter, request)
+        return event_stream_response(paragraph_event_stream(stream_paragraph_once(chapter.id, last_paragraph_id)))
 
-class ParagraphViewSet(viewsets.ReadOnlyModelViewSet):
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated], renderer_classes=STREAM_RENDERERS)
+    def generate_next_page_stream(self, request, pk=None):
+        """
+        Streaming variant of generate_next_page.
+        """
+        chapter = self.get_object()
+        current_page = int(request.data.get('current_page', 1))
+        return event_stream_response(
+            paragraph_event_stream(stream_next_page(chapter.id, current_page))
+        )
+
+
+class ParagraphViewSet(ValuesListMixin, viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing and unlocking paragraphs.
     """
-    queryset = Paragraph.objects.all()
+    queryset = Paragraph.objects.select_related('chapter')
     serializer_class = ParagraphSerializer
+    renderer_classes = READ_RENDERERS
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('id',)
 
     def retrieve(self, request, *args, **kwargs):
         # Get the paragraph
         paragraph = self.get_object()
         
-        # Get the next view order number for this user
-        last_view = ParagraphView.objects.filter(user=request.user).aggregate(Max('view_order'))
-        next_order = (last_view['view_order__max'] or 0) + 1
-
-        # Create the paragraph view record
-        ParagraphView.objects.create(
-            user=request.user,
-            story=paragraph.chapter.story,
-            chapter=paragraph.chapter,
-            paragraph=paragraph,
-            view_order=next_order
-        )
+        # Record the view and reading progress, written behind the response
+        # when view buffering is enabled
+        record_view(ViewEvent(
+            user_id=request.user.id,
+            story_id=paragraph.chapter.story_id,
+            chapter_id=paragraph.chapter_id,
+            paragraph_id=paragraph.id,
+            viewed_at=timezone.now()
+        ))
 
-        # Update reading progress
-        progress, _ = ReadingProgress.objects.get_or_create(
-            user=request.user,
-            story=paragraph.chapter.story
-        )
-        progress.viewed_paragraphs.add(paragraph)
-        
         serializer = self.get_serializer(paragraph)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Paragraphs matching every word of ?q=, best match first, with the
+        matching words highlighted in a snippet. Paged with ?page= and
+        ?page_size=.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"detail": "q is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            page = int(request.query_params.get('page', 1))
+            page_size = int(request.query_params.get('page_size', 20))
+        except ValueError:
+            return Response({"detail": "Invalid page"}, status=status.HTTP_400_BAD_REQUEST)
+        if page < 1 or not 0 < page_size <= MAX_SEARCH_PAGE_SIZE:
+            return Response({"detail": "Invalid page"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results, has_next = search_paragraphs(query, page=page, page_size=page_size)
+        return Response({'results': results, 'page': page, 'has_next': has_next})
+
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
     def unlock(self, request, pk=None):
         """
         Unlocks a paragraph by processing a payment.
         """
         paragraph = self.get_object()
-        if not paragraph.is_locked:
-            return Response({"detail": "Paragraph already unlocked"}, status=status.HTTP_400_BAD_REQUEST)
 
         # Simulate a payment process here (e.g., interact with payment gateway or blockchain)
         amount = request.data.get('amount')
         if not amount:
             return Response({"detail": "Amount required"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Record payment
-        payment = Payment.objects.create(
-            user=request.user,
-            paragraph=paragraph,
-            amount=amount,
-            successful=True
-        )
-        # Unlock paragraph
-        paragraph.is_locked = False
-        paragraph.save()
+        try:
+            amount = Decimal(str(amount)).quantize(Decimal('0.01'))
+            if not amount > 0:
+                raise InvalidOperation
+        except InvalidOperation:
+            return Response({"detail": "Invalid amount"}, status=status.HTTP_400_BAD_REQUEST)
+
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is not None and not 0 < len(idempotency_key) <= MAX_IDEMPOTENCY_KEY_LENGTH:
+            return Response(
+                {"detail": f"Idempotency-Key must be 1 to {MAX_IDEMPOTENCY_KEY_LENGTH} characters"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        return Response({"detail": "Paragraph unlocked successfully"}, status=status.HTTP_200_OK)
+        result = unlock_paragraph(request.user, paragraph, amount, idempotency_key=idempotency_key)
+        response = Response(result.body, status=result.status)
+        if result.replayed:
+            response['Idempotent-Replayed'] = 'true'
+        return response
+
+
+def story_has_paragraph(story_id, paragraph_id):
+    """
+    Whether paragraph_id is a paragraph of story_id. Bitmap storage has no
+    foreign key to catch made-up ids, so they are checked before storing.
+    """
+    return Paragraph.objects.filter(id=int(paragraph_id), chapter__story_id=int(story_id)).exists()
 
 
 class ReadingProgressViewSet(viewsets.ModelViewSet):
@@ -172,9 +366,17 @@ class ReadingProgressViewSet(viewsets.ModelViewSet):
     """
     serializer_class = ReadingProgressSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    # Unique per user, and the second column of the (user, story) index
+    keyset_ordering = ('story_id',)
 
     def get_queryset(self):
-        return ReadingProgress.objects.filter(user=self.request.user)
+        queryset = ReadingProgress.objects.filter(user=self.request.user)
+        if not uses_bitmap_storage():
+            queryset = queryset.prefetch_related(
+                Prefetch('viewed_paragraphs', queryset=Paragraph.objects.only('id'))
+            )
+        return queryset
 
     def create(self, request):
         """Handle POST requests to /api/reading-progress/"""
@@ -190,7 +392,9 @@ class ReadingProgressViewSet(viewsets.ModelViewSet):
             )
 
             if paragraph_id:
-                progress.viewed_paragraphs.add(paragraph_id)
+                if not story_has_paragraph(story_id, paragraph_id):
+                    return Response({"error": "Paragraph not found in this story"}, status=status.HTTP_400_BAD_REQUEST)
+                add_viewed_paragraphs([(progress.id, int(paragraph_id))])
 
             return Response({'status': 'success'})
         except Exception as e:
@@ -213,6 +417,9 @@ class ReadingProgressViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            if not story_has_paragraph(story_id, paragraph_id):
+                return Response({"error": "Paragraph not found in this story"}, status=status.HTTP_400_BAD_REQUEST)
+
             # Get or create reading progress
             progress, _ = ReadingProgress.objects.get_or_create(
                 user=request.user,
@@ -220,7 +427,7 @@ class ReadingProgressViewSet(viewsets.ModelViewSet):
             )
             
             # Add paragraph to viewed paragraphs
-            progress.viewed_paragraphs.add(paragraph_id)
+            add_viewed_paragraphs([(progress.id, int(paragraph_id))])
             
             return Response({'status': 'success'})
         except Exception as e:
@@ -229,20 +436,64 @@ class ReadingProgressViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+    @action(detail=False, methods=['post'])
+    def mark_viewed_batch(self, request):
+        """
+        Mark many paragraphs as viewed in one request. Expects
+        {"views": [{"story": <id>, "paragraph": <id>}, ...]} and costs the same
+        handful of queries whatever the batch size.
+        """
+        views = request.data.get('views')
+        if not isinstance(views, list) or not views:
+            return Response({"error": "A non-empty list of views is required"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(views) > MAX_MARK_VIEWED_BATCH:
+            return Response(
+                {"error": f"At most {MAX_MARK_VIEWED_BATCH} views can be marked per request"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            pairs = {(int(view['story']), int(view['paragraph'])) for view in views}
+        except (KeyError, TypeError, ValueError):
+            return Response({"error": "Each view needs integer story and paragraph IDs"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Keep only paragraphs that really belong to the story they were sent with
+        known = set(Paragraph.objects.filter(
+            id__in={paragraph_id for _, paragraph_id in pairs}
+        ).values_list('chapter__story_id', 'id'))
+        pairs &= known
+
+        with transaction.atomic():
+            progress_ids = resolve_progress_ids((request.user.id, story_id) for story_id, _ in pairs)
+            add_viewed_paragraphs(
+                (progress_ids[(request.user.id, story_id)], paragraph_id) for story_id, paragraph_id in pairs
+            )
+
+        return Response({'status': 'success', 'marked': len(pairs), 'ignored': len(views) - len(pairs)})
+
     @action(detail=False, methods=['get'])
     def viewed_paragraphs(self, request):
+        """
+        Viewed paragraph ids for a story. With ?encoding=bitmap the set is
+        returned as a base64 encoded ParagraphBitmap instead of an id list.
+        """
         story_id = request.query_params.get('story')
         progress = get_object_or_404(
             ReadingProgress,
             user=request.user,
             story_id=story_id
         )
-        viewed = list(progress.viewed_paragraphs.values_list('id', flat=True))
-        return Response({'viewed_paragraphs': viewed})
+        viewed = viewed_paragraph_set(progress)
+        if request.query_params.get('encoding') == 'bitmap':
+            return Response({
+                'viewed_bitmap': base64.b64encode(viewed.to_bytes()).decode(),
+                'count': len(viewed)
+            })
+        return Response({'viewed_paragraphs': list(viewed)})
 
     @action(detail=False, methods=['get'])
     def navigation_history(self, request):
-        """Get user's navigation history for a story"""
+        """Get user's navigation history for a story, a page at a time"""
         story_id = request.query_params.get('story')
         if not story_id:
             return Response({"detail": "Story ID required"}, status=status.HTTP_400_BAD_REQUEST)
@@ -250,14 +501,16 @@ class ReadingProgressViewSet(viewsets.ModelViewSet):
         history = ParagraphView.objects.filter(
             user=request.user,
             story_id=story_id
-        ).order_by('view_order').values(
+        ).values(
             'paragraph_id',
             'chapter_id',
             'view_order',
             'viewed_at'
         )
-        
-        return Response(list(history))
+
+        # Walks the (user, view_order) unique index
+        paginator = KeysetPagination(ordering=('view_order',))
+        return paginator.get_paginated_response(paginator.paginate_queryset(history, request, view=self))
 
 
 class PaymentViewSet(viewsets.ReadOnlyModelViewSet):
@@ -266,6 +519,8 @@ class PaymentViewSet(viewsets.ReadOnlyModelViewSet):
     """
     serializer_class = PaymentSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-payment_date', '-id')
 
     def get_queryset(self):
         return Payment.objects.filter(user=self.request.user)
@@ -277,6 +532,8 @@ class NFTViewSet(viewsets.ReadOnlyModelViewSet):
     """
     serializer_class = NFTSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    keyset_ordering = ('-id',)
 
     def get_queryset(self):
         return NFT.objects.filter(owner=self.request.user)
@@ -287,8 +544,24 @@ class NFTViewSet(viewsets.ReadOnlyModelViewSet):
         View revenue generated by the NFT.
         """
         nft = self.get_object()
-        revenue = nft.paragraph.payments.aggregate(total_revenue=models.Sum('amount'))['total_revenue']
-        return Response({"revenue": revenue or 0.0})
+        ledger = RevenueLedger.objects.filter(paragraph_id=nft.paragraph_id).first() or RevenueLedger()
+        # Decimal strings, like the serializers' DecimalFields, with or without a ledger row
+        return Response({
+            "revenue": f"{ledger.total_revenue:.2f}",
+            "owner_share": f"{ledger.owner_share:.2f}"
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAuthenticated])
+    def portfolio(self, request):
+        """
+        Revenue totals for all of the user's NFTs.
+        """
+        nfts = list(portfolio(request.user))
+        return Response({
+            "nfts": nfts,
+            "total_revenue": sum(nft['total_revenue'] for nft in nfts),
+            "total_owner_share": sum(nft['owner_share'] for nft in nfts)
+        })
 
 
 class StoryReaderView(TemplateView):
@@ -322,13 +595,13 @@ class AuthViewSet(viewsets.ViewSet):
             if created:
                 logger.info(f"New reader created with email: {email}")
                 try:
-                    wallet_data = create_wallet()
-                    reader.wallet_address = wallet_data['address']
-                    reader.wallet_chain = wallet_data['type']
-                    reader.save()
-                    logger.info(f"Wallet created for reader {email}: {wallet_data['address']}")
+                    pooled = provision_wallet(reader, create_wallet)
+                    logger.info(
+                        f"Wallet {'claimed from pool' if pooled else 'created'} for reader {email}: {reader.wallet_address}"
+                    )
                 except Exception as e:
                     logger.error(f"Wallet creation failed for reader {email}: {str(e)}", exc_info=True)
+                    # Safe to delete: a failed provision leaves no pooled wallet claimed
                     reader.delete()
                     return Response(
                         {'error': f'Failed to create wallet: {str(e)}'}, 
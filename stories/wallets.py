@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .crossmint import AsyncCrossmintClient, get_client
+from .jobs import enqueue, register
+from .models import PooledWallet
+
+logger = logging.getLogger(__name__)
+
+REFILL_DEDUPE_KEY = 'refill_wallet_pool'
+
+
+def low_watermark():
+    return getattr(settings, 'STORIES_WALLET_POOL_LOW_WATERMARK', 20)
+
+
+def high_watermark():
+    return getattr(settings, 'STORIES_WALLET_POOL_HIGH_WATERMARK', 100)
+
+
+def available_wallets():
+    return PooledWallet.objects.filter(claimed_at__isnull=True).count()
+
+
+def pool_depth():
+    available = available_wallets()
+    return {
+        'available': available,
+        'claimed': PooledWallet.objects.filter(claimed_at__isnull=False).count(),
+        'low_watermark': low_watermark(),
+        'high_watermark': high_watermark(),
+        'needs_refill': available < low_watermark(),
+    }
+
+
+def request_refill():
+    """
+    Queue a refill job unless one is already pending or running.
+    """
+    return enqueue('refill_wallet_pool', dedupe_key=REFILL_DEDUPE_KEY)
+
+
+def claim_wallet(reader):
+    """
+    Hand the oldest available pooled wallet to reader. Wallets locked by
+    concurrent logins are skipped rather than waited for. Returns the
+    PooledWallet, or None if the pool is empty.
+    """
+    with transaction.atomic():
+        wallet = PooledWallet.objects.select_for_update(skip_locked=True).filter(
+            claimed_at__isnull=True
+        ).order_by('id').first()
+        if wallet is None:
+            return None
+        wallet.reader = reader
+        wallet.claimed_at = timezone.now()
+        wallet.save(update_fields=['reader', 'claimed_at'])
+    return wallet
+
+
+def provision_wallet(reader, create_wallet):
+    """
+    Give a new reader a wallet, from the pool when possible and otherwise by
+    calling create_wallet() inline. Queues a refill once the pool drops below
+    its low watermark. The claim, the reader's update and the refill request
+    commit together, so a failure leaves the pooled wallet available and the
+    reader can be deleted. Returns True if the wallet came from the pool.
+    """
+    with transaction.atomic():
+        wallet = claim_wallet(reader)
+        if wallet is not None:
+            reader.wallet_address, reader.wallet_chain = wallet.address, wallet.chain
+            reader.save(update_fields=['wallet_address', 'wallet_chain'])
+            if available_wallets() < low_watermark():
+                request_refill()
+            return True
+
+    # Crossmint is called outside the transaction, so no locks are held meanwhile
+    logger.warning(f"Wallet pool is empty, creating a wallet inline for {reader.email}")
+    wallet_data = create_wallet()
+    with transaction.atomic():
+        reader.wallet_address, reader.wallet_chain = wallet_data['address'], wallet_data['type']
+        reader.save(update_fields=['wallet_address', 'wallet_chain'])
+        request_refill()
+    return False
+
+
+async def create_wallets(count, client, concurrency):
+    async_client = AsyncCrossmintClient(client)
+    semaphore = asyncio.Semaphore(concurrency)
+    signer = os.environ.get('SIGNER_PUBLIC_KEY')
+
+    async def create():
+        async with semaphore:
+            return await async_client.create_wallet(signer)
+
+    return await asyncio.gather(*(create() for _ in range(count)), return_exceptions=True)
+
+
+@register('refill_wallet_pool')
+def refill_wallet_pool(target=None, concurrency=None, client=None):
+    """
+    Create wallets concurrently until the pool holds target available ones
+    (the high watermark by default). Wallets that were created are kept even
+    if some calls fail; the first failure is then re-raised so the job retries.
+    Returns the number of wallets added.
+    """
+    target = high_watermark() if target is None else target
+    missing = target - available_wallets()
+    if missing <= 0:
+        return 0
+
+    concurrency = concurrency or getattr(settings, 'STORIES_WALLET_POOL_REFILL_CONCURRENCY', 5)
+    results = asyncio.run(create_wallets(missing, client or get_client(), concurrency))
+    errors = [result for result in results if isinstance(result, Exception)]
+    created = PooledWallet.objects.bulk_create(
+        [
+            PooledWallet(address=result['address'], chain=result['type'])
+            for result in results if not isinstance(result, Exception)
+        ],
+        ignore_conflicts=True
+    )
+    logger.info(f"Added {len(created)} wallets to the pool, {len(errors)} failed")
+    if errors:
+        raise errors[0]
+    return len(created)